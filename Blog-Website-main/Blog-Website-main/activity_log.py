@@ -0,0 +1,161 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on Windows, where the app runs as a single process anyway
+    fcntl = None
+
+_STOP = object()
+
+
+class ActivityLog:
+    """JSON-lines activity log written by a background thread.
+
+    Callers only put a record on a bounded queue; the writer thread drains
+    it in batches, writes each batch with a single append and rotates the
+    file by size or age. When the queue is full records are dropped (and
+    counted) or the caller blocks, depending on `policy`.
+
+    Each process gets its own writer thread, started lazily, so the log is
+    safe to use after a pre-fork server forks its workers. Appends are
+    O_APPEND writes and a writer that finds the file rotated by another
+    process reopens it. Rotation holds an flock on `<path>.lock`, so two
+    workers crossing the limit together rotate the file once.
+    """
+
+    def __init__(self, path, max_queue=10000, policy='drop', batch_size=256,
+                 flush_interval=0.5, max_bytes=10 * 1024 * 1024, max_age=24 * 3600, backups=5):
+        if policy not in ('drop', 'block'):
+            raise ValueError("policy must be 'drop' or 'block'")
+        self.path = path
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.stats = {'written': 0, 'dropped': 0, 'write_seconds': 0.0}
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._file = None
+        self._opened_at = None
+        atexit.register(self.close)
+
+    def write(self, **fields):
+        self._ensure_writer()
+        record = {'time': datetime.datetime.now().isoformat(), **fields}
+        if self.policy == 'block':
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    # inherited across fork: the parent's queue and file are not ours
+                    self._queue = queue.Queue(self._queue.maxsize)
+                    self._file = None
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=f'activity-log:{self.path}', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if any(record is _STOP for record in batch):
+                batch = [record for record in batch if record is not _STOP]
+                stopping = True
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        started = time.perf_counter()
+        data = ''.join(json.dumps(record) + '\n' for record in batch).encode()
+        try:
+            self._open()
+            os.write(self._file, data)
+            self.stats['written'] += len(batch)
+            self._maybe_rotate()
+        except OSError:
+            self.stats['dropped'] += len(batch)
+            self._close_file()
+        self.stats['write_seconds'] += time.perf_counter() - started
+
+    def _open(self):
+        if self._file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._file).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self._close_file()
+        self._file = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._opened_at = time.time()
+
+    def _close_file(self):
+        if self._file is not None:
+            os.close(self._file)
+            self._file = None
+
+    def _due(self):
+        size = os.fstat(self._file).st_size
+        return size >= self.max_bytes or time.time() - self._opened_at >= self.max_age
+
+    def _maybe_rotate(self):
+        if not self._due():
+            return
+        lock = os.open(f'{self.path}.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current != os.fstat(self._file).st_ino:
+                # another worker rotated while we waited: our file is already a backup
+                self._close_file()
+                return
+            self._close_file()
+            for n in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{n}'):
+                    os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        finally:
+            os.close(lock)
+
+    def close(self, timeout=5):
+        """Flush what is queued and stop the writer thread."""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._close_file()
+
+
+activity_log = ActivityLog('log.txt', policy=os.environ.get('BLOG_LOG_POLICY', 'drop'))
+admin_log = ActivityLog('admin_log.txt', policy=os.environ.get('BLOG_LOG_POLICY', 'drop'))
@@ -1,6 +1,25 @@
 from flask import Flask
-from routes import app  # Import the app instance from routes.py
+
+
+def create_app(config=None):
+    """Build the app. Services are created on first use and migrations are left to `flask migrate`."""
+    from json_provider import BlogJSONProvider
+    from methods import close_db
+    from routes import bp
+
+    app = Flask(__name__)
+    app.json = BlogJSONProvider(app)
+    app.teardown_appcontext(close_db)
+    app.secret_key = 'secret'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(config or {})
+    app.register_blueprint(bp)
+    return app
+
 
 if __name__ == '__main__':
-    app.app_context().push()  # Ensure an app context is available
+    from routes import migrate_all
+    migrate_all()
+    app = create_app()
     app.run(debug=True,host='0.0.0.0')
@@ -0,0 +1,278 @@
+import datetime
+import glob
+import os
+import sqlite3
+import time
+import zlib
+from contextlib import ExitStack
+
+from shards import ARCHIVE_DIR, index_path, shard_path
+from methods import migrate_posts_schema
+from rendering import rerender_shard
+
+POST_COLUMNS = "post_title, post_content, post_markdown, post_excerpt, render_version, post_author, tags, timestamp"
+
+# what happens to deleted_posts rows older than the retention window
+DELETED_POLICIES = ('compress', 'purge', 'keep')
+
+
+def closed_months(months, now=None):
+    """Months that ended more than a day ago, so no create_post can still be writing to them."""
+    cutoff = ((now or datetime.datetime.now()) - datetime.timedelta(days=1)).strftime('%Y_%m')
+    return [month for month in months if month < cutoff]
+
+
+def archive_stem(month, merge_years, now=None):
+    year = month[:4]
+    if merge_years and year < (now or datetime.datetime.now()).strftime('%Y'):
+        return f'Posts_{year}'
+    return f'Post_{month}'
+
+
+def stem_of(path):
+    return os.path.basename(path).split('.')[0]
+
+
+def file_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+class Compactor:
+    """Moves closed months of posts into read-only archive files.
+
+    Each archive is built next to the live files from a snapshot of its
+    sources, so readers and writers are not held up while rows are copied,
+    expired deleted_posts are compressed or purged, old renders are brought
+    up to date and the file is ANALYZEd and VACUUMed. Only the final switch
+    takes locks: the write lock of each live month being archived (which
+    delete_post checks under), then the index database's, long enough to
+    copy in the deletes that happened meanwhile and repoint the catalog.
+    The current month is never locked.
+
+    Archives are written under a new versioned name every time, since
+    processes keep their immutable connections to the old file open.
+    Superseded files are removed by a later run once they are older than
+    the grace period. Run one compaction at a time.
+    """
+
+    def __init__(self, posts, retention_days=30, deleted='compress', merge_years=False, rebuild=False, now=None):
+        if deleted not in DELETED_POLICIES:
+            raise ValueError(f"deleted must be one of {', '.join(DELETED_POLICIES)}")
+        self.posts = posts
+        self.catalog = posts.catalog
+        self.deleted = deleted
+        self.merge_years = merge_years
+        self.rebuild = rebuild
+        self.now = now or datetime.datetime.now()
+        expired = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=retention_days)
+        self.expired = expired.strftime('%Y-%m-%d %H:%M:%S')
+
+    def plan(self):
+        """{archive stem: months} for every closed month, grouped by target file."""
+        locations = self.catalog.locations()
+        groups = {}
+        for month in sorted(closed_months(locations, self.now)):
+            # a year merged once stays merged
+            merged = locations[month].archived and stem_of(locations[month].path).startswith('Posts_')
+            groups.setdefault(archive_stem(month, self.merge_years or merged, self.now), []).append(month)
+        return groups
+
+    def needs_build(self, stem, months, locations, buried_months):
+        sources = {locations[month].path for month in months}
+        if self.rebuild or any(not locations[month].archived for month in months):
+            return True
+        if len(sources) > 1 or stem_of(sources.pop()) != stem or buried_months & set(months):
+            return True
+        if self.deleted == 'keep':
+            return False
+        query = "SELECT 1 FROM deleted_posts WHERE COALESCE(deleted_at, timestamp) < ?"
+        if self.deleted == 'compress':
+            query += " AND typeof(post_content) = 'text'"
+        with self.posts.read_shard(locations[months[0]]) as db:
+            return db.execute(query + " LIMIT 1", (self.expired,)).fetchone() is not None
+
+    def run(self):
+        """Archive what needs it and tidy the open months; returns one summary per archive written."""
+        locations = self.catalog.locations()
+        closed = set(closed_months(locations, self.now))
+        with self.catalog.pool.connection(index_path()) as db:
+            buried_months = {row['month'] for row in db.execute('SELECT DISTINCT month FROM tombstones')}
+        results = []
+        for stem, months in self.plan().items():
+            if self.needs_build(stem, months, locations, buried_months):
+                results.append(self.build(stem, months, locations))
+                locations = self.catalog.locations()
+        for month, shard in locations.items():
+            if month not in closed and not shard.archived and os.path.exists(shard.path):
+                # cheap upkeep only; VACUUM would lock out writers to the open months
+                with self.posts.connect_to_db(month) as db:
+                    db.execute('PRAGMA optimize')
+                    db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        return results
+
+    def build(self, stem, months, locations):
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        stamp = self.now.strftime('%Y%m%d%H%M%S')
+        name, attempt = f'{stem}.{stamp}.db', 1
+        while os.path.exists(os.path.join(ARCHIVE_DIR, name)):
+            attempt += 1
+            name = f'{stem}.{stamp}-{attempt}.db'
+        path = os.path.join(ARCHIVE_DIR, name)
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        for month in months:
+            if not locations[month].archived:
+                # opening through the pool adds any missing columns to older files
+                with self.posts.connect_to_db(month):
+                    pass
+        sources = {locations[month].path for month in months}
+        result = {'archive': name, 'months': months, 'bytes_before': sum(file_size(source) for source in sources)}
+
+        out = sqlite3.connect(tmp, isolation_level=None)
+        out.row_factory = sqlite3.Row
+        try:
+            migrate_posts_schema(out)
+            for month in months:
+                self.copy_month(out, month, locations[month])
+            # tombstones are applied again under the lock in switch(), for any added meanwhile
+            self.move_to_deleted(out, self.buried(months))
+            result.update(self.expire_deleted(out))
+        finally:
+            out.close()
+        result['rendered'] = sum(rerender_shard(tmp))
+        out = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            out.execute('ANALYZE')
+            out.execute('VACUUM')
+        finally:
+            out.close()
+
+        result['posts'] = self.switch(tmp, path, name, months, locations)
+        result['bytes_after'] = os.path.getsize(path)
+        return result
+
+    def copy_month(self, out, month, source):
+        low, high = source.month_range(month)
+        out.execute('ATTACH DATABASE ? AS src', (source.path,))
+        try:
+            # one transaction, so a post deleted meanwhile is in exactly one of the two tables
+            out.execute('BEGIN')
+            out.execute(f"""INSERT INTO posts (post_id, {POST_COLUMNS})
+                            SELECT post_id + ?, {POST_COLUMNS} FROM src.posts WHERE post_id > ? AND post_id < ?""",
+                        (source.offset, low, high))
+            out.execute(f"""INSERT INTO deleted_posts (post_id, {POST_COLUMNS}, deleted_at)
+                            SELECT post_id + ?, {POST_COLUMNS}, deleted_at FROM src.deleted_posts WHERE post_id > ? AND post_id < ?""",
+                        (source.offset, low, high))
+            out.execute('COMMIT')
+        finally:
+            out.execute('DETACH DATABASE src')
+
+    def expire_deleted(self, out):
+        expired = "COALESCE(deleted_at, timestamp) < ?"
+        if self.deleted == 'purge':
+            return {'purged': out.execute(f"DELETE FROM deleted_posts WHERE {expired}", (self.expired,)).rowcount}
+        if self.deleted == 'keep':
+            return {}
+        rows = out.execute(f"""SELECT post_id, post_content, post_markdown FROM deleted_posts
+                               WHERE {expired} AND typeof(post_content) = 'text'""", (self.expired,)).fetchall()
+        out.execute('BEGIN')
+        out.executemany("UPDATE deleted_posts SET post_content = ?, post_markdown = ?, post_excerpt = NULL WHERE post_id = ?",
+                        [(zlib.compress(row['post_content'].encode(), 9),
+                          zlib.compress(row['post_markdown'].encode(), 9) if row['post_markdown'] is not None else None,
+                          row['post_id']) for row in rows])
+        out.execute('COMMIT')
+        return {'compressed': len(rows)}
+
+    def switch(self, tmp, path, name, months, locations):
+        out = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            with ExitStack() as stack:
+                live = {}
+                for month in months:
+                    if not locations[month].archived:
+                        db = stack.enter_context(self.posts.connect_to_db(month))
+                        db.execute('BEGIN IMMEDIATE')
+                        live[month] = db
+                out.execute('BEGIN')
+                for month, db in live.items():
+                    self.catch_up(out, month, locations[month], db)
+                index = stack.enter_context(self.catalog.pool.connection(index_path()))
+                index.execute('BEGIN IMMEDIATE')
+                self.move_to_deleted(out, self.buried(months, index))
+                placeholders = ','.join('?' * len(months))
+                out.execute('COMMIT')
+                count = out.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+                out.close()
+                os.chmod(tmp, 0o444)
+                os.replace(tmp, path)
+                index.execute(f"UPDATE shards SET archive = ?, retired_at = ? WHERE month IN ({placeholders})", [name, time.time(), *months])
+                index.execute(f"DELETE FROM tombstones WHERE month IN ({placeholders})", months)
+                index.commit()
+                for db in live.values():
+                    db.rollback()
+        finally:
+            out.close()
+        return count
+
+    def catch_up(self, out, month, source, db):
+        """Apply deletes (and any late insert) made to a live month since it was copied."""
+        low, high = source.month_range(month)
+        current = {row[0] + source.offset for row in db.execute('SELECT post_id FROM posts')}
+        copied = {row[0] for row in out.execute('SELECT post_id FROM posts WHERE post_id > ? AND post_id < ?',
+                                                (low + source.offset, high + source.offset))}
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self.move_to_deleted(out, [(post_id, now) for post_id in copied - current])
+        added = sorted(current - copied)
+        if added:
+            rows = db.execute(f"SELECT post_id, {POST_COLUMNS} FROM posts WHERE post_id IN (%s)" % ','.join('?' * len(added)),
+                              [post_id - source.offset for post_id in added]).fetchall()
+            out.executemany(f"INSERT INTO posts (post_id, {POST_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(row[0] + source.offset, *row[1:]) for row in rows])
+
+    def buried(self, months, index=None):
+        """(post_id, deleted_at) of tombstoned posts in months."""
+        query = "SELECT post_id, deleted_at FROM tombstones WHERE month IN (%s)" % ','.join('?' * len(months))
+        if index is not None:
+            return [tuple(row) for row in index.execute(query, months)]
+        with self.catalog.pool.connection(index_path()) as db:
+            return [tuple(row) for row in db.execute(query, months)]
+
+    def move_to_deleted(self, out, deletes):
+        for post_id, deleted_at in deletes:
+            out.execute(f"""INSERT OR REPLACE INTO deleted_posts (post_id, {POST_COLUMNS}, deleted_at)
+                            SELECT post_id, {POST_COLUMNS}, ? FROM posts WHERE post_id = ?""", (deleted_at, post_id))
+            out.execute("DELETE FROM posts WHERE post_id = ?", (post_id,))
+
+
+def remove_retired(catalog, grace_seconds):
+    """Delete archives and live files nothing points at any more, once the grace period has passed since they were switched away from.
+
+    A file's mtime says nothing about when readers stopped being sent to it,
+    so the clock starts at the switch, recorded in shards.retired_at.
+    """
+    catalog.ensure_discovered()
+    now = time.time()
+    with catalog.pool.connection(index_path()) as db:
+        # archived before retired_at was recorded: start their grace period now
+        db.execute("UPDATE shards SET retired_at = ? WHERE archive IS NOT NULL AND retired_at IS NULL", (now,))
+        db.commit()
+        rows = db.execute("SELECT month, archive, retired_at FROM shards WHERE archive IS NOT NULL").fetchall()
+    referenced = {row['archive'] for row in rows}
+    cutoff = now - grace_seconds
+    candidates = []
+    # which months an old archive served is not recorded, so it waits for the latest switch;
+    # its mtime covers a build still in progress
+    latest = max((row['retired_at'] for row in rows), default=0)
+    if latest < cutoff:
+        candidates.extend(path for path in glob.glob(os.path.join(ARCHIVE_DIR, '*'))
+                          if os.path.basename(path) not in referenced and os.path.getmtime(path) < cutoff)
+    for row in rows:
+        if row['retired_at'] < cutoff:
+            candidates.extend(shard_path(row['month']) + suffix for suffix in ('', '-wal', '-shm'))
+    removed = []
+    for path in candidates:
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    # without the brotli package only gzip variants are built
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# what the templates load; the rest of static/bootstrap (unminified builds,
+# RTL variants, source maps) never makes it into the served set
+ASSETS = (
+    'bootstrap/css/bootstrap.min.css',
+    'bootstrap/js/bootstrap.bundle.min.js',
+    'styles.css',
+    'scripts.js',
+)
+
+# (Accept-Encoding token, file suffix), most preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+SOURCE_MAP_RE = re.compile(rb'\s*/[*/]# sourceMappingURL=\S+?(?: \*/)?\s*$')
+CSS_URL_RE = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+
+def fingerprint(name, data):
+    root, ext = posixpath.splitext(name)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, 9, mtime=0)
+
+
+def rewrite_css_urls(name, css, manifest):
+    """Point url(...) references at assets already built to their fingerprinted names."""
+    base = posixpath.dirname(name)
+
+    def replace(match):
+        quote, target = match.groups()
+        resolved = posixpath.normpath(posixpath.join(base, target))
+        if resolved not in manifest:
+            return match.group(0)
+        return f'url({quote}{posixpath.relpath(manifest[resolved], base or ".")}{quote})'
+
+    return CSS_URL_RE.sub(replace, css.decode()).encode()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(static_folder, assets=ASSETS, prune=False):
+    """Write fingerprinted and precompressed copies of `assets` to static/dist.
+
+    Returns the manifest of logical name -> fingerprinted name. Files from
+    earlier builds are kept unless `prune`, so pages cached before a deploy
+    can still load the assets they reference.
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+    written = {MANIFEST}
+    # built in order, so a stylesheet can refer to one listed before it
+    for name in assets:
+        with open(os.path.join(static_folder, name), 'rb') as f:
+            data = SOURCE_MAP_RE.sub(b'\n', f.read())
+        if name.endswith('.css'):
+            data = rewrite_css_urls(name, data, manifest)
+        target = fingerprint(name, data)
+        manifest[name] = target
+        _write(os.path.join(dist, target), data)
+        written.add(target)
+        for encoding, suffix in ENCODINGS:
+            if encoding == 'br' and brotli is None:
+                continue
+            packed = compress(data, encoding)
+            if len(packed) < len(data):
+                _write(os.path.join(dist, target + suffix), packed)
+                written.add(target + suffix)
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2).encode())
+    if prune:
+        for root, dirs, files in os.walk(dist):
+            for file in files:
+                path = os.path.relpath(os.path.join(root, file), dist).replace(os.sep, '/')
+                if path not in written:
+                    os.remove(os.path.join(root, file))
+    return manifest
+
+
+class AssetManifest:
+    """Fingerprinted asset names from the last build, read once at startup.
+
+    Without a build every lookup falls back to the plain static file, so a
+    checkout works before `flask build-assets` has been run.
+    """
+
+    def __init__(self, static_folder):
+        self.dist = os.path.join(static_folder, DIST_DIR)
+        try:
+            with open(os.path.join(self.dist, MANIFEST)) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        self.files = set(self.entries.values())
+
+    def lookup(self, name):
+        return self.entries.get(name)
+
+    def variant(self, filename, accepts):
+        """(file to send, Content-Encoding or None, mimetype) for a built asset.
+
+        `accepts(token)` returns the client's quality for an encoding. Returns
+        None for anything that is not part of the current build.
+        """
+        if filename not in self.files:
+            return None
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        for encoding, suffix in ENCODINGS:
+            if accepts(encoding) and os.path.exists(os.path.join(self.dist, filename + suffix)):
+                return filename + suffix, encoding, mimetype
+        return filename, None, mimetype
@@ -0,0 +1,973 @@
+"""Benchmarks and load tests.
+
+Runs the app against a throwaway working directory, so nothing under
+static/POSTS or User.db is touched.
+
+    python bench.py reads --posts 500 --requests 2000 --threads 8
+    python bench.py payloads --sizes 100 1000 10000
+    python bench.py load --posts 100000 --months 24 --concurrency 16 --output load.json
+    python bench.py load --posts 10000 --server wsgi --scenarios get_posts post
+    python bench.py login --costs 12 14 15 --requests 200 --concurrency 16
+    python bench.py users --users 1000000
+    python bench.py bulk --pending 10000 --batch 1000
+    python bench.py scaling --workers 1 2 4 8 --posts 100000
+    python bench.py feed --posts 100000 --months 48
+    python bench.py archive --posts 100000 --months 48 --merge-years
+    python bench.py metrics --rounds 15 --repeat 5000
+    python bench.py writes --writers 1 8 64 --posts 2000 --windows 0 2
+    python bench.py transfer --posts 100000 --months 24 --workers 1 4
+    python bench.py startup --runs 20
+    python bench.py views --posts 1000 --threads 1 8 --requests 4000
+
+`load` generates synthetic users and posts spread over many monthly
+shards, drives the hot routes through the Flask test client or a local
+threaded WSGI server and reports p50/p95/p99 latency, throughput and peak
+RSS per route. --output also writes the results as JSON so runs can be
+compared between commits.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LOAD_PASSWORD = 'load-password'
+LOAD_TAGS = ['python', 'flask', 'sqlite', 'gaming', 'travel', 'college life', 'daily life', 'adventure', 'rust', 'web']
+LOAD_MARKDOWN = [
+    '# Synthetic post\n\nA short post with **bold** text and a [link](https://example.com).\n',
+    '## Synthetic post\n\n' + 'A *longer* paragraph of filler text. ' * 40 + '\n\n- one\n- two\n- three\n',
+    '# Synthetic post\n\n```python\nprint("hello")\n```\n\n' + 'Closing words. ' * 15 + '\n',
+]
+
+
+def setup_workdir():
+    workdir = tempfile.mkdtemp(prefix='blog-bench-')
+    os.makedirs(os.path.join(workdir, 'static', 'POSTS'))
+    os.chdir(workdir)
+    sys.path.insert(0, APP_DIR)
+    return workdir
+
+
+def make_app():
+    """The app as a worker sees it, after `flask migrate` has run."""
+    from app import create_app
+    from routes import migrate_all
+    migrate_all()
+    return create_app()
+
+
+def seed_posts(count):
+    from methods import POSTS
+    posts = POSTS()
+    return [posts.create_post(f'Post {i}', f'# Post {i}\n\nSome *markdown* body for post {i}.', f'author{i % 10}', 'bench')
+            for i in range(count)]
+
+
+def recent_months(count):
+    """YYYY_MM for the current month and the count - 1 months before it."""
+    year, month = map(int, datetime.date.today().strftime('%Y %m').split())
+    months = []
+    for _ in range(count):
+        months.append(f'{year:04d}_{month:02d}')
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months
+
+
+def generate_dataset(post_count, month_count, user_count, index=False, batch_size=5000, seed=1234):
+    """Bulk load synthetic posts and approved users straight into the databases.
+
+    Each Markdown sample is rendered once and reused, so a million posts
+    load in minutes rather than hours. Returns the usernames and a sample of
+    existing global post ids.
+    """
+    import sqlite3
+    from methods import POSTS, User, DATABASE
+    from rendering import render, RENDERER_VERSION
+    from shards import global_id
+    from migrations import migrate
+
+    rng = random.Random(seed)
+    posts = POSTS()
+    usernames = [f'user{n}' for n in range(user_count)]
+    rendered = [render(source) for source in LOAD_MARKDOWN]
+    months = recent_months(month_count)
+    per_month, extra = divmod(post_count, month_count)
+    post_ids = []
+    for n, month in enumerate(months):
+        count = per_month + (1 if n < extra else 0)
+        if not count:
+            continue
+        year, mon = map(int, month.split('_'))
+        first_day = datetime.datetime(year, mon, 1)
+        with posts.connect_to_db(month) as db:
+            start = db.execute("SELECT COALESCE(MAX(post_id), 0) FROM posts").fetchone()[0]
+            for offset in range(0, count, batch_size):
+                rows = []
+                for i in range(offset, min(offset + batch_size, count)):
+                    sample = i % len(LOAD_MARKDOWN)
+                    html, excerpt = rendered[sample]
+                    # ascending with post_id and inside the month, like real inserts
+                    timestamp = first_day + datetime.timedelta(seconds=i * 27 * 86400 // count)
+                    rows.append((f'Post {i} of {month}', html, LOAD_MARKDOWN[sample], excerpt, RENDERER_VERSION,
+                                 rng.choice(usernames), ', '.join(rng.sample(LOAD_TAGS, 2)), timestamp.strftime('%Y-%m-%d %H:%M:%S')))
+                db.executemany("""INSERT INTO posts (post_title, post_content, post_markdown, post_excerpt, render_version,
+                                                     post_author, tags, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+                db.commit()
+        posts.catalog.ensure_discovered()
+        posts.catalog.adjust(month, count)
+        post_ids.extend(global_id(month, start + rng.randint(1, count)) for _ in range(min(count, 1000)))
+    if index:
+        posts.tags.backfill(months)
+        posts.search.rebuild(months)
+
+    user = User()
+    password = user.hash_password(LOAD_PASSWORD)
+    db = sqlite3.connect(DATABASE)
+    migrate(db)
+    db.executemany("INSERT INTO users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                   [(name, user.hash_username(name), password, f'{name}@example.com', 30, f'555{n:07d}')
+                    for n, name in enumerate(usernames)])
+    db.commit()
+    db.close()
+    return usernames, post_ids
+
+
+class ClientTransport:
+    """Requests go through the Flask test client, in process."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self, username=None):
+        client = self.app.test_client()
+        if username:
+            with client.session_transaction() as session:
+                session['credentials'] = username
+        return client
+
+    def request(self, client, method, path, form=None):
+        return client.open(path, method=method, data=form).status_code
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """Requests go over HTTP to a server already listening on a local port."""
+
+    def __init__(self, port):
+        self.port = port
+
+    def session(self, username=None):
+        cookies = {}
+        if username:
+            self.request(cookies, 'POST', '/login', {'username': username, 'password': LOAD_PASSWORD})
+        return cookies
+
+    def request(self, cookies, method, path, form=None):
+        headers = {}
+        if cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in cookies.items())
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+        for name, value in response.getheaders():
+            if name.lower() == 'set-cookie':
+                cookie, _, _ = value.partition(';')
+                key, _, cookie_value = cookie.partition('=')
+                cookies[key] = cookie_value
+        return response.status
+
+    def close(self):
+        pass
+
+
+class WSGITransport(HTTPTransport):
+    """HTTPTransport to a threaded werkzeug server on a free local port, in process."""
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        super().__init__(self.server.server_port)
+
+    def close(self):
+        self.server.shutdown()
+
+
+def load_scenarios(usernames, post_ids):
+    """name -> (needs a logged in session, rng -> (method, path, form)).
+
+    login starts from a fresh anonymous session on every request; the other
+    logged in scenarios reuse one session per worker.
+    """
+    titles = iter(range(10 ** 12))
+    return {
+        'get_posts': (False, lambda rng: ('GET', '/get_posts', None)),
+        'get_posts_excerpt': (False, lambda rng: ('GET', '/get_posts?body=excerpt', None)),
+        'post': (False, lambda rng: ('GET', f'/post/{rng.choice(post_ids)}', None)),
+        'get_user_post': (True, lambda rng: ('POST', '/get_user_post', None)),
+        'login': (False, lambda rng: ('POST', '/login', {'username': rng.choice(usernames), 'password': LOAD_PASSWORD})),
+        'create_post': (True, lambda rng: ('POST', '/create_post', {'post_title': f'Load post {next(titles)}',
+                                                                    'post_content': LOAD_MARKDOWN[0], 'tags': 'load, bench'})),
+    }
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_scenario(transport, usernames, needs_login, make_request, total, concurrency):
+    per_worker = max(1, total // concurrency)
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+
+    def worker(n):
+        rng = random.Random(n)
+        session = transport.session(rng.choice(usernames) if needs_login else None)
+        for _ in range(per_worker):
+            method, path, form = make_request(rng)
+            if path == '/login':
+                session = transport.session()
+            start = time.perf_counter()
+            status = transport.request(session, method, path, form)
+            latencies[n].append(time.perf_counter() - start)
+            if status >= 400:
+                errors[n] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    ordered = sorted(latency for worker_latencies in latencies for latency in worker_latencies)
+    return {
+        'requests': len(ordered),
+        'errors': sum(errors),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(ordered) / elapsed, 1),
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run_requests(app, paths, total, threads):
+    per_thread = total // threads
+    errors = []
+
+    def worker(offset):
+        client = app.test_client()
+        for i in range(per_thread):
+            response = client.get(paths[(offset + i) % len(paths)])
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed, len(errors)
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_reads(args):
+    post_ids = seed_posts(args.posts)
+    app = make_app()
+    for name, paths in (('/get_posts', ['/get_posts']),
+                        ('/post/<postid>', [f'/post/{i}' for i in post_ids])):
+        rps, errors = run_requests(app, paths, args.requests, args.threads)
+        print(f'{name:<16} {rps:10.1f} req/s  ({errors} errors)')
+
+
+def bench_payloads(args):
+    from flask import jsonify
+    seed_posts(max(args.sizes))
+    app = make_app()
+    from routes import posts
+    client = app.test_client()
+    print(f'{"posts":>8} {"dumps+loads+jsonify":>20} {"jsonify once":>13} {"GET stream":>11}')
+    for size in args.sizes:
+        rows = list(posts.iter_posts(limit=size))
+        with app.app_context():
+            # what every route did before: the data layer dumps, the route loads and jsonify dumps again
+            round_trip = timed(lambda: jsonify(json.loads(json.dumps({"status": 200, "data": [post.to_dict() for post in rows]}))), args.repeat)
+            once = timed(lambda: jsonify({"status": 200, "data": rows}), args.repeat)
+        http = timed(lambda: client.get(f'/get_posts?stream=1&limit={size}').get_data(), args.repeat)
+        print(f'{size:>8} {round_trip:>17.2f} ms {once:>10.2f} ms {http:>8.2f} ms')
+
+
+def bench_load(args):
+    app = make_app()
+    start = time.perf_counter()
+    usernames, post_ids = generate_dataset(args.posts, args.months, args.users, args.index)
+    generate_seconds = time.perf_counter() - start
+    print(f'generated {args.posts} posts in {args.months} shards and {args.users} users in {generate_seconds:.1f}s')
+
+    transport = WSGITransport(app) if args.server == 'wsgi' else ClientTransport(app)
+    scenarios = load_scenarios(usernames, post_ids)
+    results = {}
+    try:
+        for name in args.scenarios:
+            needs_login, make_request = scenarios[name]
+            result = results[name] = run_scenario(transport, usernames, needs_login, make_request, args.requests, args.concurrency)
+            print(f'{name:<18} {result["throughput_rps"]:9.1f} req/s  p50 {result["p50_ms"]:8.2f} ms  p95 {result["p95_ms"]:8.2f} ms  '
+                  f'p99 {result["p99_ms"]:8.2f} ms  rss {result["peak_rss_mb"]:7.1f} MB  ({result["errors"]} errors)')
+    finally:
+        transport.close()
+
+    if args.output:
+        report = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('func', 'command')},
+            'generate_seconds': round(generate_seconds, 2),
+            'scenarios': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'wrote {args.output}')
+
+
+def bench_login(args):
+    import sqlite3
+    from methods import User, DATABASE
+    from passwords import password_hasher
+    seed_posts(20)
+    app = make_app()
+    user = User()
+    transport = ClientTransport(app)
+    print(f'{password_hasher.workers} hash workers')
+    for cost in args.costs:
+        # stored at the current cost, so logins verify without rehashing
+        password_hasher.cost = cost
+        usernames = [f'cost{cost}-{n}' for n in range(args.concurrency)]
+        db = sqlite3.connect(DATABASE)
+        db.executemany("INSERT INTO users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(name, user.hash_username(name), password_hasher.hash(LOAD_PASSWORD), f'{name}@example.com', 30, name)
+                        for name in usernames])
+        db.commit()
+        db.close()
+        login = load_scenarios(usernames, [])['login']
+        reads = load_scenarios(usernames, [])['get_posts']
+        # page reads running next to the login flood show whether hashing starves them
+        during = {}
+        reader = threading.Thread(target=lambda: during.update(run_scenario(transport, usernames, *reads, args.requests, 2)))
+        reader.start()
+        result = run_scenario(transport, usernames, *login, args.requests, args.concurrency)
+        reader.join()
+        print(f'cost 2^{cost:<3} login {result["throughput_rps"]:8.1f} req/s  p50 {result["p50_ms"]:8.2f} ms  p99 {result["p99_ms"]:8.2f} ms  '
+              f'| /get_posts meanwhile p50 {during["p50_ms"]:6.2f} ms  p99 {during["p99_ms"]:7.2f} ms  ({result["errors"]} errors)')
+
+
+# the User.db lookups on the request path, checked with EXPLAIN QUERY PLAN by `users`
+USER_LOOKUPS = {
+    'login': ("SELECT user_id, password FROM users WHERE hashed_username = ?", lambda n: (f'hash{n}',)),
+    'approve check': ("""SELECT p.user_id, EXISTS (SELECT 1 FROM users u WHERE u.username = p.username)
+                                          OR EXISTS (SELECT 1 FROM users u WHERE u.hashed_username = p.hashed_username)
+                                          OR EXISTS (SELECT 1 FROM users u WHERE u.email = p.email)
+                                          OR EXISTS (SELECT 1 FROM users u WHERE u.phone_number = p.phone_number) AS taken
+                         FROM pending_users p WHERE p.user_id IN (SELECT value FROM json_each(?))""",
+                      lambda n: (json.dumps([n % 1000 + 1]),)),
+    'reset_password': ("UPDATE users SET password = password WHERE username = ?", lambda n: (f'user{n}',)),
+    'approve': ("""INSERT OR IGNORE INTO users (username, hashed_username, password, email, age, phone_number)
+                   SELECT username, hashed_username, password, email, age, phone_number FROM pending_users WHERE user_id = ?""",
+                lambda n: (n % 1000 + 1,)),
+}
+
+
+def table_scans(db, query, params):
+    """(plan, scans): the EXPLAIN QUERY PLAN of query and the steps that read a whole table."""
+    steps = [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + query, params)]
+    # json_each is the list of ids being looked up, not a table
+    return ' / '.join(steps), [step for step in steps if step.startswith('SCAN ') and not step.startswith('SCAN json_each')]
+
+
+def bench_users(args):
+    import sqlite3
+    from migrations import migrate
+    db = sqlite3.connect('User.db')
+    migrate(db, target=1)
+    start = time.perf_counter()
+    db.executemany("INSERT INTO users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                   ((f'user{n}', f'hash{n}', 'x', f'user{n}@example.com', 30, f'555{n:07d}') for n in range(args.users)))
+    # half of the pending users collide with an existing account
+    db.executemany("INSERT INTO pending_users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                   ((f'user{n}' if n % 2 else f'new{n}', f'phash{n}', 'x', f'new{n}@example.com', 30, f'new{n}') for n in range(1000)))
+    db.commit()
+    print(f'inserted {args.users} users in {time.perf_counter() - start:.1f}s')
+
+    def measure(label, repeat):
+        print(label)
+        scans = []
+        for name, (query, params) in USER_LOOKUPS.items():
+            plan, table_scan = table_scans(db, query, params(0))
+            if table_scan:
+                scans.append(name)
+            per_op_ms = timed(lambda: [db.execute(query, params(random.randrange(args.users))) for _ in range(repeat)], 1) / repeat
+            db.rollback()
+            print(f'  {name:<16} {per_op_ms * 1000:10.1f} us/op  {plan}')
+        return scans
+
+    measure('before (schema version 1, no indexes)', args.repeat_scan)
+    start = time.perf_counter()
+    migrate(db)
+    print(f'migrated to the latest version in {time.perf_counter() - start:.1f}s')
+    scans = measure('after', args.repeat)
+    db.close()
+    if scans:
+        sys.exit(f'full table scan left in: {", ".join(scans)}')
+
+
+def bench_bulk(args):
+    import sqlite3
+    from methods import DATABASE
+    seed_posts(1)
+    app = make_app()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['admin'] = 'admin'
+
+    def seed_pending(prefix):
+        db = sqlite3.connect(DATABASE)
+        # one in twenty collides with an already registered account
+        db.executemany("INSERT INTO users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(f'{prefix}taken{n}', f'{prefix}htaken{n}', 'x', f'{prefix}taken{n}@example.com', 30, f'{prefix}t{n}')
+                        for n in range(0, args.pending, 20)])
+        db.executemany("INSERT INTO pending_users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(f'{prefix}taken{n}' if n % 20 == 0 else f'{prefix}user{n}', f'{prefix}h{n}', 'x', f'{prefix}user{n}@example.com', 30,
+                         f'{prefix}p{n}') for n in range(args.pending)])
+        db.commit()
+        ids = [row[0] for row in db.execute("SELECT user_id FROM pending_users WHERE username LIKE ? ORDER BY user_id", (f'{prefix}%',))]
+        db.close()
+        return ids
+
+    def single(path, ids):
+        start = time.perf_counter()
+        for user_id in ids:
+            client.post(path, json={'user_id': user_id})
+        return len(ids) / (time.perf_counter() - start)
+
+    def bulk(path, ids):
+        start = time.perf_counter()
+        for offset in range(0, len(ids), args.batch):
+            response = client.post(path, json={'user_ids': ids[offset:offset + args.batch]})
+            assert response.status_code == 200, response.get_data()
+        return len(ids) / (time.perf_counter() - start)
+
+    print(f'{args.pending} pending users, bulk batches of {args.batch}')
+    ids = seed_pending('a')
+    sample = ids[:args.single]
+    print(f'approve  one per request {single("/approve_user", sample):10.1f} users/s  bulk {bulk("/approve_users", ids[len(sample):]):10.1f} users/s')
+    ids = seed_pending('d')
+    print(f'deny     one per request {single("/deny_user", ids[:args.single]):10.1f} users/s  bulk {bulk("/deny_users", ids[args.single:]):10.1f} users/s')
+    db = sqlite3.connect(DATABASE)
+    ids = [row[0] for row in db.execute("SELECT user_id FROM users ORDER BY user_id")]
+    db.close()
+    print(f'delete   one per request {single("/delete_user", ids[:args.single]):10.1f} users/s  bulk {bulk("/delete_users", ids[args.single:]):10.1f} users/s')
+
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_scaling(args):
+    """Throughput of the production entry point (gunicorn, wsgi:app) at 1..N workers."""
+    import signal
+    from urllib.request import urlopen
+    usernames, post_ids = generate_dataset(args.posts, args.months, args.users)
+    print(f'{args.posts} posts, {args.threads} threads per worker, {args.concurrency} concurrent clients, {os.cpu_count()} cores')
+    scenarios = load_scenarios(usernames, post_ids)
+    baseline = {}
+    for workers in args.workers:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(APP_DIR, 'gunicorn.conf.py'),
+                                   '--pythonpath', APP_DIR, '-b', f'127.0.0.1:{port}', '-w', str(workers),
+                                   '--threads', str(args.threads), 'wsgi:app'],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 30
+            while True:
+                try:
+                    urlopen(f'http://127.0.0.1:{port}/readyz', timeout=1).read()
+                    break
+                except OSError:
+                    if time.time() > deadline or server.poll() is not None:
+                        raise SystemExit('gunicorn did not become ready; is it installed?')
+                    time.sleep(0.2)
+            transport = HTTPTransport(port)
+            line = []
+            for name in args.scenarios:
+                needs_login, make_request = scenarios[name]
+                result = run_scenario(transport, usernames, needs_login, make_request, args.requests, args.concurrency)
+                baseline.setdefault(name, result['throughput_rps'])
+                line.append(f'{name} {result["throughput_rps"]:8.1f} req/s (x{result["throughput_rps"] / baseline[name]:.2f}, '
+                            f'p99 {result["p99_ms"]:.1f} ms, {result["errors"]} errors)')
+            print(f'{workers:>3} workers  ' + '  '.join(line))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+
+def bench_feed(args):
+    usernames, post_ids = generate_dataset(args.posts, args.months, args.users, index=True)
+    from methods import POSTS
+    posts = POSTS()
+    print(f'{args.posts} posts in {args.months} shards, first page of {args.limit} excerpts')
+    for name, author, tag in (('homepage', None, None), ('author', usernames[0], None), ('tag', None, LOAD_TAGS[0])):
+        if tag:
+            merged = lambda: posts.get_posts_by_ids([ref.post_id for ref in posts.tags.page([tag], limit=args.limit + 1)], 'excerpt')
+        else:
+            merged = lambda: list(posts.iter_posts(author, limit=args.limit + 1, body='excerpt'))
+        feed = lambda: posts.get_feed(author, tag, args.limit + 1)
+        feed()
+        print(f'{name:<9} shards/index {timed(merged, args.repeat):8.3f} ms   feed {timed(feed, args.repeat):8.3f} ms')
+
+
+def bench_archive(args):
+    from methods import POSTS
+    from shards import encode_cursor, split_id, current_month
+    from archive import Compactor, remove_retired
+    usernames, post_ids = generate_dataset(args.posts, args.months, args.users)
+    posts = POSTS()
+    rng = random.Random(1)
+    old_ids = [post_id for post_id in post_ids if split_id(post_id)[0] != current_month()]
+    cursors = [encode_cursor(post) for post in posts.get_posts_by_ids(rng.sample(old_ids, 200))]
+
+    def files():
+        paths = [os.path.join(root, name) for root, _, names in os.walk('static/POSTS') for name in names
+                 if not name.startswith('index.db')]
+        return len(paths), sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+
+    def measure():
+        lookup = lambda: posts.get_post_by_id(rng.choice(old_ids))
+        deep_page = lambda: posts.get_page(cursor=rng.choice(cursors), limit=20, body='excerpt')
+        return timed(lookup, args.repeat), timed(deep_page, args.repeat)
+
+    print(f'{args.posts} posts in {args.months} shards')
+    count, size = files()
+    lookup, page = measure()
+    print(f'live     {count:4d} files {size:9.1f} MiB   old post {lookup:7.3f} ms   deep page {page:7.3f} ms')
+    start = time.perf_counter()
+    Compactor(posts, merge_years=args.merge_years).run()
+    elapsed = time.perf_counter() - start
+    remove_retired(posts.catalog, 0)
+    count, size = files()
+    lookup, page = measure()
+    print(f'archived {count:4d} files {size:9.1f} MiB   old post {lookup:7.3f} ms   deep page {page:7.3f} ms   (compaction {elapsed:.1f} s)')
+
+
+def interleaved(variants, rounds, repeat):
+    """Median ms per call of each variant, run in shuffled rounds so machine noise hits all of them alike."""
+    import gc
+    samples = {name: [] for name in variants}
+    order = list(variants)
+    for _ in range(rounds):
+        random.shuffle(order)
+        for name in order:
+            setup, func = variants[name]
+            setup()
+            gc.collect()
+            gc.disable()
+            try:
+                samples[name].append(timed(func, repeat))
+            finally:
+                gc.enable()
+    return {name: sorted(values)[len(values) // 2] for name, values in samples.items()}
+
+
+def bench_metrics(args):
+    """Whole requests on a shared host vary by more than the hooks cost, so each piece is timed on its own."""
+    import sqlite3
+    seed_posts(args.posts)
+    import metrics
+    app = make_app()
+    from shards import shard_path, current_month
+    response = app.response_class('ok')
+    hooks = [func for funcs in (app.before_request_funcs, app.after_request_funcs, app.teardown_request_funcs)
+             for func in funcs.get(None, [])]
+    profiler = metrics.SamplingProfiler('profiles', threshold=float('inf'))
+
+    def request(run_hooks):
+        def call():
+            with app.test_request_context('/posts?tag=bench'):
+                if run_hooks:
+                    hooks[0]()
+                    hooks[1](response)
+                    hooks[2](None)
+        return call
+
+    def profiled():
+        profiler.begin()
+        profiler.end('GET /posts', 0.0)
+
+    plain = sqlite3.connect(shard_path(current_month()))
+    traced = sqlite3.connect(shard_path(current_month()), factory=metrics.TracedConnection)
+    query = lambda db: lambda: db.execute('SELECT post_id, post_title FROM posts WHERE post_id = ?', (1,)).fetchone()
+    noop = lambda: None
+    result = interleaved({'context': (noop, request(False)), 'hooks': (noop, request(True)),
+                          'profiler': (noop, profiled), 'nothing': (noop, noop),
+                          'plain': (noop, query(plain)), 'traced': (noop, query(traced))}, args.rounds, args.repeat)
+    us = {name: value * 1000 for name, value in result.items()}
+    print(f'median of {args.rounds} shuffled rounds of {args.repeat} calls')
+    print(f"request hooks     {us['hooks'] - us['context']:6.2f} us per request   (request context alone {us['context']:.1f} us)")
+    print(f"profiler          {us['profiler'] - us['nothing']:6.2f} us per request   (sampler thread off the request path)")
+    print(f"traced statement  {us['traced'] - us['plain']:6.2f} us per statement (plain statement {us['plain']:.1f} us)")
+    print('BLOG_METRICS=0 registers no hooks and opens plain sqlite3 connections, so nothing above is paid')
+
+
+class DirectWriter:
+    """Commits each post in its own transaction on the caller's thread, as create_post did before the group committer."""
+
+    def __init__(self, posts):
+        self.posts = posts
+
+    def submit(self, item):
+        result = self.posts.commit_posts([item])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def bench_writes(args):
+    from methods import POSTS
+    from group_commit import GroupCommitter
+    from models import BlogError
+    seed_posts(100)
+    variants = {'per-request': lambda posts: DirectWriter(posts)}
+    for window in args.windows:
+        variants[f'group {window:g} ms'] = lambda posts, window=window: GroupCommitter(posts.commit_posts, window=window / 1000)
+    print(f'{args.posts} create_post calls per run, Markdown rendered on the calling thread')
+    for writers in args.writers:
+        for name, make_writer in variants.items():
+            posts = POSTS()
+            posts.writer = make_writer(posts)
+            # with the feeds materialized every post also updates them
+            posts.get_feed()
+            posts.get_feed('author0')
+            counter = iter(range(args.posts))
+            lock = threading.Lock()
+            latencies, errors = [], []
+
+            def worker(n):
+                while True:
+                    with lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    started = time.perf_counter()
+                    try:
+                        posts.create_post(f'Burst post {i}', LOAD_MARKDOWN[i % len(LOAD_MARKDOWN)], f'author{n % 10}', LOAD_TAGS[i % len(LOAD_TAGS)])
+                    except BlogError as e:
+                        errors.append(e.msg)
+                    else:
+                        latencies.append(time.perf_counter() - started)
+
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(writers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            line = (f'{writers:3d} writers  {name:<12} {len(latencies) / elapsed:7.0f} posts/s   '
+                    f'p50 {percentile(latencies, 50) * 1000:7.1f} ms   p99 {percentile(latencies, 99) * 1000:7.1f} ms   '
+                    f'{len(errors)} errors')
+            stats = getattr(posts.writer, 'stats', None)
+            if stats:
+                line += f"   {stats['items'] / max(stats['batches'], 1):.1f} posts per commit"
+                posts.writer.close()
+            print(line)
+
+
+def bench_transfer(args):
+    """Export a synthetic data set, then import it into empty shards with each worker count."""
+    from db import ConnectionPool
+    from methods import POSTS, migrate_posts_schema
+    from shards import ShardCatalog, migrate_index_schema, POSTS_DATABASE_DIR
+    from search import SearchIndex
+    from tags import TagIndex
+    from feeds import FeedIndex
+    from transfer import Importer, export_posts, export_chunks, read_records
+    generate_dataset(args.posts, args.months, args.users)
+    posts = POSTS()
+    for fmt, name in (('ndjson', 'posts.ndjson'), ('markdown', 'posts.tar')):
+        started = time.perf_counter()
+        with open(name, 'wb') as out:
+            for chunk in export_chunks(export_posts(posts), fmt):
+                out.write(chunk)
+        elapsed = time.perf_counter() - started
+        print(f'export {fmt:<8} {args.posts / elapsed:8.0f} posts/s   {os.path.getsize(name) / 1024 / 1024:7.1f} MiB')
+    for workers in args.workers:
+        for fmt, name in (('ndjson', 'posts.ndjson'), ('markdown', 'posts.tar')):
+            shutil.rmtree(POSTS_DATABASE_DIR)
+            os.makedirs(POSTS_DATABASE_DIR)
+            # new pools, since the shared ones remember which files already have their schema
+            index_pool = ConnectionPool(schema=migrate_index_schema)
+            posts = POSTS(ConnectionPool(schema=migrate_posts_schema), ShardCatalog(index_pool), SearchIndex(index_pool),
+                          TagIndex(index_pool), feeds=FeedIndex(index_pool))
+            started = time.perf_counter()
+            with open(name, 'rb') as stream:
+                summary = Importer(posts, workers=workers, batch_size=args.batch_size).run(read_records(stream, fmt))
+            elapsed = time.perf_counter() - started
+            print(f'import {fmt:<8} {workers:2d} workers {summary["imported"] / elapsed:8.0f} posts/s   '
+                  f'{elapsed:6.1f} s   1M posts in ~{1e6 / (summary["imported"] / elapsed) / 60:.1f} min')
+
+
+class DirectCounter:
+    """Writes every view in its own transaction on the request thread, like a plain `views = views + 1`."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def hit(self, post_id):
+        from shards import index_path
+        with self.pool.connection(index_path()) as db:
+            db.execute("""INSERT INTO post_views (post_id, views, rank) VALUES (?, 1, 0)
+                          ON CONFLICT(post_id) DO UPDATE SET views = views + 1""", (post_id,))
+            db.commit()
+
+
+class NoCounter:
+    def hit(self, post_id):
+        pass
+
+
+def bench_views(args):
+    """/post/<postid> with views not counted, counted per request, and counted in memory and flushed."""
+    from counters import ViewCounter
+    from shards import index_connections
+    post_ids = seed_posts(args.posts)
+    app = make_app()
+    from routes import posts
+    paths = [f'/post/{post_id}' for post_id in post_ids]
+    variants = {'not counted': NoCounter, 'per request': lambda: DirectCounter(index_connections),
+                'counter': lambda: ViewCounter(interval=args.interval)}
+    client = app.test_client()
+    lookups = iter(range(10 ** 9))
+    # a page is cached after its first view, so this is the cheapest read the counting can slow down
+    latency = interleaved({name: (lambda make=make: setattr(posts, 'views', make()), lambda: client.get(paths[next(lookups) % len(paths)]))
+                           for name, make in variants.items()}, args.rounds, args.repeat)
+    for threads in args.threads:
+        for name, make in variants.items():
+            posts.views = make()
+            rps, errors = run_requests(app, paths, args.requests, threads)
+            line = f'{threads:3d} threads  {name:<12} {rps:8.0f} req/s   ({errors} errors)'
+            if threads == 1:
+                line += f'   median {latency[name]:.3f} ms per request'
+            print(line)
+    counter = ViewCounter(interval=3600)
+    for post_id in post_ids:
+        for _ in range(3):
+            counter.hit(post_id)
+    started = time.perf_counter()
+    counter.flush()
+    print(f'flush of {len(post_ids) * 3} views on {len(post_ids)} posts: {(time.perf_counter() - started) * 1000:.1f} ms')
+    posts.views = counter
+    print(f"/popular: {timed(lambda: client.get('/popular').get_data(), args.repeat):.3f} ms per request")
+    counter.close()
+
+
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get('/')
+assert response.status_code == 200, response.status_code
+answered = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'first response': answered - created, 'modules': len(sys.modules)}))
+"""
+
+
+def bench_startup(args):
+    """Import-to-first-response of a fresh process, as each worker or test run pays it."""
+    seed_posts(20)
+    make_app()
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import sys; sys.path.insert(0, sys.argv[1]); '
+                    'from routes import migrate_all; migrate_all()', APP_DIR], check=True)
+    print(f'flask migrate, nothing to apply: {(time.perf_counter() - started) * 1000:.1f} ms (once per deploy)')
+    runs = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        probe = subprocess.run([sys.executable, '-c', STARTUP_PROBE, APP_DIR], check=True, capture_output=True, text=True)
+        timings = json.loads(probe.stdout)
+        timings['process'] = time.perf_counter() - started
+        runs.append(timings)
+    for name in ('import', 'create_app', 'first response', 'process'):
+        ordered = sorted(run[name] * 1000 for run in runs)
+        print(f'{name:<15} p50 {percentile(ordered, 50):7.1f} ms   p95 {percentile(ordered, 95):7.1f} ms')
+    print(f'{runs[0]["modules"]} modules loaded')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    reads = commands.add_parser('reads', help='requests/sec for /get_posts and /post/<postid>')
+    reads.add_argument('--posts', type=int, default=200)
+    reads.add_argument('--requests', type=int, default=2000)
+    reads.add_argument('--threads', type=int, default=8)
+    reads.set_defaults(func=bench_reads)
+    payloads = commands.add_parser('payloads', help='serialization cost of /get_posts payloads')
+    payloads.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    payloads.add_argument('--repeat', type=int, default=5)
+    payloads.set_defaults(func=bench_payloads)
+    load = commands.add_parser('load', help='latency and throughput of the hot routes on a synthetic data set')
+    load.add_argument('--posts', type=int, default=10000, help='e.g. 10000, 100000 or 1000000')
+    load.add_argument('--months', type=int, default=24, help='monthly shards to spread the posts over')
+    load.add_argument('--users', type=int, default=1000)
+    load.add_argument('--index', action='store_true', help='also build the tag and search indexes')
+    load.add_argument('--server', choices=['client', 'wsgi'], default='client')
+    load.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--scenarios', nargs='+', default=['get_posts', 'post', 'get_user_post', 'login', 'create_post'],
+                      choices=['get_posts', 'get_posts_excerpt', 'post', 'get_user_post', 'login', 'create_post'])
+    load.add_argument('--output', help='also write the results to this JSON file')
+    load.set_defaults(func=bench_load)
+    login = commands.add_parser('login', help='/login throughput at several password hashing costs')
+    login.add_argument('--costs', type=int, nargs='+', default=[12, 14, 15], help='log2 of the scrypt work factor')
+    login.add_argument('--requests', type=int, default=200)
+    login.add_argument('--concurrency', type=int, default=16)
+    login.set_defaults(func=bench_login)
+    users = commands.add_parser('users', help='User.db lookups before and after the index migration')
+    users.add_argument('--users', type=int, default=100000, help='e.g. 1000000')
+    users.add_argument('--repeat', type=int, default=2000)
+    users.add_argument('--repeat-scan', type=int, default=20, help='lookups timed before the indexes exist')
+    users.set_defaults(func=bench_users)
+    bulk = commands.add_parser('bulk', help='admin approve/deny/delete one ID per request against the bulk endpoints')
+    bulk.add_argument('--pending', type=int, default=10000)
+    bulk.add_argument('--batch', type=int, default=1000, help='IDs per bulk request')
+    bulk.add_argument('--single', type=int, default=500, help='IDs handled one request at a time for comparison')
+    bulk.set_defaults(func=bench_bulk)
+    scaling = commands.add_parser('scaling', help='throughput under gunicorn at several worker counts')
+    scaling.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    scaling.add_argument('--threads', type=int, default=4)
+    scaling.add_argument('--posts', type=int, default=10000)
+    scaling.add_argument('--months', type=int, default=24)
+    scaling.add_argument('--users', type=int, default=1000)
+    scaling.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    scaling.add_argument('--concurrency', type=int, default=32)
+    scaling.add_argument('--scenarios', nargs='+', default=['get_posts', 'post'],
+                         choices=['get_posts', 'get_posts_excerpt', 'post', 'get_user_post', 'login'])
+    scaling.set_defaults(func=bench_scaling)
+    feed = commands.add_parser('feed', help='first page from the materialized feeds against merging the shards')
+    feed.add_argument('--posts', type=int, default=100000)
+    feed.add_argument('--months', type=int, default=48)
+    feed.add_argument('--users', type=int, default=1000)
+    feed.add_argument('--limit', type=int, default=20)
+    feed.add_argument('--repeat', type=int, default=200)
+    feed.set_defaults(func=bench_feed)
+    archive = commands.add_parser('archive', help='reads from live monthly shards against compacted read-only archives')
+    archive.add_argument('--posts', type=int, default=100000)
+    archive.add_argument('--months', type=int, default=48)
+    archive.add_argument('--users', type=int, default=1000)
+    archive.add_argument('--merge-years', action='store_true')
+    archive.add_argument('--repeat', type=int, default=2000)
+    archive.set_defaults(func=bench_archive)
+    metrics = commands.add_parser('metrics', help='per-request cost of the metrics hooks, SQL tracing and the profiler')
+    metrics.add_argument('--posts', type=int, default=1000)
+    metrics.add_argument('--repeat', type=int, default=5000)
+    metrics.add_argument('--rounds', type=int, default=15)
+    metrics.set_defaults(func=bench_metrics)
+    writes = commands.add_parser('writes', help='create_post throughput, per-request transactions against group commits')
+    writes.add_argument('--writers', type=int, nargs='+', default=[1, 8, 64])
+    writes.add_argument('--posts', type=int, default=2000)
+    writes.add_argument('--windows', type=float, nargs='+', default=[0, 2])
+    writes.set_defaults(func=bench_writes)
+    transfer = commands.add_parser('transfer', help='export and import throughput, NDJSON and Markdown tar')
+    transfer.add_argument('--posts', type=int, default=100000)
+    transfer.add_argument('--months', type=int, default=24)
+    transfer.add_argument('--users', type=int, default=1000)
+    transfer.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    transfer.add_argument('--batch-size', type=int, default=1000)
+    transfer.set_defaults(func=bench_transfer)
+    startup = commands.add_parser('startup', help='import-to-first-response time of a new process')
+    startup.add_argument('--runs', type=int, default=20)
+    startup.set_defaults(func=bench_startup)
+    views = commands.add_parser('views', help='/post/<postid> with and without view counting, flush and /popular cost')
+    views.add_argument('--posts', type=int, default=1000)
+    views.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    views.add_argument('--requests', type=int, default=4000)
+    views.add_argument('--interval', type=float, default=5.0)
+    views.add_argument('--rounds', type=int, default=9)
+    views.add_argument('--repeat', type=int, default=500)
+    views.set_defaults(func=bench_views)
+    args = parser.parse_args()
+    if getattr(args, 'output', None):
+        args.output = os.path.abspath(args.output)
+
+    workdir = setup_workdir()
+    try:
+        args.func(args)
+    finally:
+        os.chdir(APP_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import ConnectionPool
+
+
+class CachedResponse:
+    __slots__ = ('body', 'mimetype', 'etag', 'last_modified')
+
+    def __init__(self, body, mimetype, etag, last_modified):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class MemoryBackend:
+    """In-process LRU bounded by the total size of cached bodies, with a TTL."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        expires, value = self._entries.pop(key)
+        self._bytes -= len(value.body)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if len(value.body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._bytes += len(value.body)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+
+    def generation(self, name):
+        return self._generations.get(name, 0)
+
+    def bump(self, name):
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes, backend='memory')
+
+
+FILE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    mimetype TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    last_modified REAL NOT NULL,
+    expires REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS generations (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0);
+"""
+
+
+class FileBackend:
+    """SQLite file shared by every worker process on the host.
+
+    Invalidations made by one worker are seen by all of them, at the cost of
+    a local file read per lookup. Size is bounded by entry count; expired and
+    least recently stored entries are pruned every `prune_every` writes.
+    """
+
+    def __init__(self, path, max_entries=10000, ttl=300, prune_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._writes = 0
+        self._pool = ConnectionPool(schema=FILE_CACHE_SCHEMA)
+
+    def get(self, key):
+        with self._pool.connection(self.path) as db:
+            row = db.execute("SELECT * FROM entries WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return CachedResponse(bytes(row['body']), row['mimetype'], row['etag'], row['last_modified'])
+
+    def set(self, key, value):
+        with self._pool.connection(self.path) as db:
+            db.execute("INSERT OR REPLACE INTO entries (key, body, mimetype, etag, last_modified, expires) VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, value.body, value.mimetype, value.etag, value.last_modified, time.time() + self.ttl))
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                self._prune(db)
+            db.commit()
+
+    def _prune(self, db):
+        pruned = db.execute("DELETE FROM entries WHERE expires < ?", (time.time(),)).rowcount
+        pruned += db.execute("""DELETE FROM entries WHERE key IN (
+                                    SELECT key FROM entries ORDER BY expires DESC LIMIT -1 OFFSET ?)""",
+                             (self.max_entries,)).rowcount
+        self.stats['evictions'] += pruned
+
+    def delete(self, key):
+        with self._pool.connection(self.path) as db:
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            db.commit()
+
+    def generation(self, name):
+        with self._pool.connection(self.path) as db:
+            row = db.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        return row['value'] if row else 0
+
+    def bump(self, name):
+        with self._pool.connection(self.path) as db:
+            db.execute("""INSERT INTO generations (name, value) VALUES (?, 1)
+                          ON CONFLICT(name) DO UPDATE SET value = value + 1""", (name,))
+            db.commit()
+
+    def info(self):
+        with self._pool.connection(self.path) as db:
+            row = db.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(LENGTH(body)), 0) AS bytes FROM entries").fetchone()
+        return dict(self.stats, entries=row['entries'], bytes=row['bytes'], backend='file')
+
+
+class ResponseCache:
+    """Keys and invalidation rules for cached public pages.
+
+    Post pages are keyed by global post id. List pages are keyed by cursor
+    and limit under a generation number: a new post only changes the first
+    page (it is the newest post), so creating bumps "list-head" alone, while
+    a delete can shift any page and bumps both generations.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    @classmethod
+    def from_url(cls, url):
+        """'memory' (the default) or 'file:/path/to/cache.db'."""
+        if url and url.startswith('file:'):
+            path = url[len('file:'):]
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            return cls(FileBackend(path))
+        return cls(MemoryBackend())
+
+    def post_key(self, post_id):
+        return f'post:{post_id}'
+
+    def list_key(self, cursor, limit):
+        if cursor:
+            return f'list:{self.backend.generation("list")}:{cursor}:{limit}'
+        return f'list-head:{self.backend.generation("list-head")}:{limit}'
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def post_created(self, post_id):
+        self.backend.bump('list-head')
+
+    def posts_imported(self):
+        # imported posts can land on any page, not just the first
+        self.backend.bump('list-head')
+        self.backend.bump('list')
+
+    def post_deleted(self, post_id):
+        self.backend.delete(self.post_key(post_id))
+        self.backend.bump('list-head')
+        self.backend.bump('list')
+
+    def info(self):
+        return self.backend.info()
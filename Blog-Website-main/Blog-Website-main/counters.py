@@ -0,0 +1,214 @@
+import atexit
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from models import Unavailable
+from shards import index_connections, index_path
+
+# ranks measure time in half-lives from here, so a newer view always weighs more
+EPOCH = 1704067200  # 2024-01-01 UTC
+# rows of post_views kept in memory for /popular
+POPULAR_SIZE = 100
+
+
+def log2_add(a, b):
+    """log2(2 ** a + 2 ** b) without leaving the float range."""
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+class _Counts:
+    """One thread's views since the last flush; only that thread and the flusher take its lock."""
+    __slots__ = ('counts', 'lock', 'thread')
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+
+
+class ViewCounter:
+    """Per-post view counts and a decayed popularity ranking, kept off the read path.
+
+    hit() only bumps a dict owned by the calling thread, so a page view never
+    waits for another request or for the SQLite write lock. A background
+    thread swaps those dicts out every `interval` seconds and adds the
+    deltas to post_views in the index database, in one transaction however
+    many posts were viewed.
+
+    Popularity halves every `half_life` seconds. Rather than rewriting every
+    score as time passes, a view at time t is weighted 2 ** ((t - EPOCH) /
+    half_life) and a row keeps log2 of its weighted sum as `rank` (forward
+    decay): ranks compare correctly at any moment and a flush only touches
+    the posts that were viewed. A post's score now is
+    2 ** (rank - (now - EPOCH) / half_life). Ranks written under another
+    half-life do not compare with new ones.
+
+    The POPULAR_SIZE highest ranks are re-read after each flush, and by
+    top() once they are `interval` old, so /popular never sorts the table.
+    Like ActivityLog each process starts its own flusher lazily and drops
+    counts inherited across a fork.
+    """
+
+    def __init__(self, pool=None, interval=5.0, half_life=48 * 3600, size=POPULAR_SIZE):
+        self.pool = pool or index_connections
+        self.interval = interval
+        self.half_life = half_life
+        self.size = size
+        self.stats = {'flushed': 0, 'flushes': 0, 'failed': 0, 'flush_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+        # deltas a failed flush keeps for the next one
+        self._unflushed = {}
+        self._top = None
+        self._thread = None
+        self._stopping = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def hit(self, post_id):
+        self._ensure_flusher()
+        try:
+            shard = self._local.counts
+        except AttributeError:
+            shard = self._local.counts = _Counts()
+            with self._lock:
+                self._shards.append(shard)
+        with shard.lock:
+            shard.counts[post_id] = shard.counts.get(post_id, 0) + 1
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    # inherited across fork: the parent flushes its own counts
+                    self._local = threading.local()
+                    self._shards = []
+                    self._unflushed = {}
+                    self._top = None
+                self._pid = os.getpid()
+                self._stopping = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stopping,), name='view-counter', daemon=True)
+                self._thread.start()
+
+    def _run(self, stopping):
+        while not stopping.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def _collect(self):
+        with self._lock:
+            shards = list(self._shards)
+            # a finished thread counts nothing more once swapped out below
+            self._shards = [shard for shard in shards if shard.thread.is_alive()]
+        deltas, self._unflushed = self._unflushed, {}
+        for shard in shards:
+            with shard.lock:
+                counts, shard.counts = shard.counts, {}
+            for post_id, count in counts.items():
+                deltas[post_id] = deltas.get(post_id, 0) + count
+        return deltas
+
+    def flush(self):
+        """Write the views counted since the last flush and refresh the top ranks."""
+        with self._flush_lock:
+            started = time.perf_counter()
+            deltas = self._collect()
+            if deltas:
+                try:
+                    self._write(deltas, time.time())
+                except (sqlite3.Error, Unavailable):
+                    self.stats['failed'] += 1
+                    for post_id, count in deltas.items():
+                        self._unflushed[post_id] = self._unflushed.get(post_id, 0) + count
+                else:
+                    self.stats['flushed'] += sum(deltas.values())
+                    self.stats['flushes'] += 1
+            try:
+                self._refresh()
+            except (sqlite3.Error, Unavailable):
+                pass
+            self.stats['flush_seconds'] += time.perf_counter() - started
+
+    def _write(self, deltas, now):
+        weight = (now - EPOCH) / self.half_life
+        post_ids = list(deltas)
+        with self.pool.connection(index_path()) as db:
+            # other workers flush into the same rows
+            db.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(post_ids), 500):
+                chunk = post_ids[start:start + 500]
+                ranks = dict(db.execute("SELECT post_id, rank FROM post_views WHERE post_id IN (%s)" % ','.join('?' * len(chunk)), chunk).fetchall())
+                db.executemany("""INSERT INTO post_views (post_id, views, rank) VALUES (?, ?, ?)
+                                  ON CONFLICT(post_id) DO UPDATE SET views = views + excluded.views, rank = excluded.rank""",
+                               [(post_id, deltas[post_id], log2_add(ranks.get(post_id), math.log2(deltas[post_id]) + weight))
+                                for post_id in chunk])
+            db.commit()
+
+    def _refresh(self):
+        with self.pool.connection(index_path()) as db:
+            rows = db.execute("SELECT post_id, views, rank FROM post_views ORDER BY rank DESC LIMIT ?", (self.size,)).fetchall()
+        self._top = (time.monotonic(), [tuple(row) for row in rows])
+
+    def score(self, rank, now=None):
+        return 2 ** (rank - ((now or time.time()) - EPOCH) / self.half_life)
+
+    def top(self, limit=POPULAR_SIZE):
+        """[(post_id, views, score)] of the `limit` most popular posts, most popular first."""
+        top = self._top
+        if top is None or time.monotonic() - top[0] > self.interval:
+            # while a flush is writing (and will refresh), serve the ranks we have
+            if self._flush_lock.acquire(blocking=top is None):
+                try:
+                    if self._top is top:
+                        self._refresh()
+                finally:
+                    self._flush_lock.release()
+            top = self._top
+        now = time.time()
+        return [(post_id, views, self.score(rank, now)) for post_id, views, rank in top[1][:limit]]
+
+    def count(self, post_id):
+        """Views written so far plus the ones this process has not flushed yet."""
+        with self.pool.connection(index_path()) as db:
+            row = db.execute("SELECT views FROM post_views WHERE post_id = ?", (post_id,)).fetchone()
+        pending = self._unflushed.get(post_id, 0)
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            with shard.lock:
+                pending += shard.counts.get(post_id, 0)
+        return (row['views'] if row else 0) + pending
+
+    def remove(self, post_id):
+        # under the flush lock no collected deltas are on their way to post_views;
+        # dropping the pending ones keeps the next flush from writing the row back
+        with self._flush_lock:
+            self._unflushed.pop(post_id, None)
+            with self._lock:
+                shards = list(self._shards)
+            for shard in shards:
+                with shard.lock:
+                    shard.counts.pop(post_id, None)
+            with self.pool.connection(index_path()) as db:
+                db.execute("DELETE FROM post_views WHERE post_id = ?", (post_id,))
+                db.commit()
+        top = self._top
+        if top is not None:
+            self._top = (top[0], [entry for entry in top[1] if entry[0] != post_id])
+
+    def close(self, timeout=5):
+        """Flush what is counted and stop the flusher thread."""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import threading
+import queue
+import urllib.request
+from contextlib import contextmanager
+
+from metrics import connection_factory
+from models import Unavailable
+
+# applied to every pooled connection when it is opened
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA busy_timeout=5000',
+)
+
+# read-only immutable files have no journal and take no locks
+READONLY_PRAGMAS = (
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA mmap_size=67108864',
+)
+
+
+def readonly_uri(path, immutable=False):
+    """URI opening path read-only; immutable also skips locking and change detection."""
+    uri = 'file:' + urllib.request.pathname2url(os.path.abspath(path)) + '?mode=ro'
+    return uri + '&immutable=1' if immutable else uri
+
+
+class ConnectionPool:
+    """Bounded pool of sqlite3 connections, one pool per database file.
+
+    Connections are opened lazily and reused across requests. The schema
+    (an SQL script, or a callable taking the connection for migrations that
+    need to inspect the file) runs once per file for the life of the process
+    instead of on every connect.
+
+    Connections never cross a fork: a pool used in a child process first
+    forgets whatever it inherited from the parent.
+
+    A readonly pool opens files as immutable: SQLite then never locks or
+    re-checks them, which is only safe for files nothing writes to again.
+    """
+
+    def __init__(self, schema=None, max_size=8, timeout=10, readonly=False):
+        self.schema = schema
+        self.readonly = readonly
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._opened = {}
+        self._initialized = set()
+        self._pid = os.getpid()
+        self.stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0}
+
+    def after_fork(self):
+        # the parent still owns these connections, so drop them without closing
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._opened = {}
+        self._pid = os.getpid()
+        self.stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0}
+
+    def open_count(self):
+        return sum(self._opened.values())
+
+    def idle_count(self):
+        return sum(idle.qsize() for idle in list(self._idle.values()))
+
+    def _open(self, path):
+        if self.readonly:
+            conn = sqlite3.connect(readonly_uri(path, immutable=True), uri=True, check_same_thread=False, factory=connection_factory)
+        else:
+            conn = sqlite3.connect(path, check_same_thread=False, factory=connection_factory)
+        conn.row_factory = sqlite3.Row
+        for pragma in READONLY_PRAGMAS if self.readonly else PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            needs_schema = self.schema and path not in self._initialized
+            if needs_schema:
+                if callable(self.schema):
+                    self.schema(conn)
+                else:
+                    conn.executescript(self.schema)
+                conn.commit()
+                self._initialized.add(path)
+        return conn
+
+    def _checkout(self, path):
+        with self._lock:
+            idle = self._idle.setdefault(path, queue.LifoQueue())
+            can_open = self._opened.get(path, 0) < self.max_size
+            if can_open and idle.empty():
+                self._opened[path] = self._opened.get(path, 0) + 1
+            else:
+                can_open = False
+            self.stats['checkouts'] += 1
+            if not can_open and idle.empty():
+                self.stats['waits'] += 1
+        if not can_open:
+            try:
+                return idle.get(timeout=self.timeout)
+            except queue.Empty:
+                self.stats['timeouts'] += 1
+                raise Unavailable("The database is busy, try again shortly")
+        try:
+            return self._open(path)
+        except sqlite3.Error:
+            with self._lock:
+                self._opened[path] -= 1
+            raise
+
+    def _checkin(self, path, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle[path].put(conn)
+
+    @contextmanager
+    def connection(self, path):
+        if self._pid != os.getpid():
+            self.after_fork()
+        conn = self._checkout(path)
+        try:
+            yield conn
+        finally:
+            self._checkin(path, conn)
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+            self._idle.clear()
+            self._opened.clear()
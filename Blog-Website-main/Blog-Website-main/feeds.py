@@ -0,0 +1,141 @@
+from models import Post
+from shards import index_connections, index_path
+from tags import parse_tags
+
+# deeper than MAX_PAGE_SIZE so any first page, plus the row telling whether
+# there is a next one, comes from the feed
+FEED_SIZE = 200
+# reads of a feed's source before a fill gives up storing it and serves the last one
+FILL_ATTEMPTS = 3
+
+
+def feed_names(post):
+    return ['latest', f'author:{post.post_author}'] + [f'tag:{tag}' for tag in parse_tags(post.tags)]
+
+
+class FeedIndex:
+    """The newest FEED_SIZE post summaries per feed, in the shared index database.
+
+    Feeds are 'latest', 'author:<name>' and 'tag:<tag>'. A feed is filled
+    from the shards the first time it is read and kept current by add() and
+    remove() after that, so a first page is one short range scan however
+    many shards there are. A fill reads the shards before it takes the index
+    write lock and only stores what it read if no post was added or removed
+    since (feed_state.version), so a post written meanwhile is never lost or
+    resurrected.
+    """
+
+    def __init__(self, pool=None, size=FEED_SIZE):
+        self.pool = pool or index_connections
+        self.size = size
+
+    def _insert(self, db, name, post):
+        db.execute("""INSERT OR IGNORE INTO feed_posts (feed, timestamp, post_id, post_title, post_author, tags, post_excerpt)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                   (name, post.timestamp, post.post_id, post.post_title, post.post_author, post.tags, post.post_excerpt))
+
+    def _trim(self, db, name):
+        db.execute("""DELETE FROM feed_posts WHERE feed = ? AND (timestamp, post_id) <= (
+                          SELECT timestamp, post_id FROM feed_posts WHERE feed = ?
+                          ORDER BY timestamp DESC, post_id DESC LIMIT 1 OFFSET ?)""", (name, name, self.size))
+
+    def add(self, post):
+        self.add_many([post])
+
+    def add_many(self, posts):
+        with self.pool.connection(index_path()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            # feeds nobody has read yet pick the posts up when they are filled
+            names = sorted({name for post in posts for name in feed_names(post)})
+            filled = {row['feed'] for row in db.execute("SELECT feed FROM feeds WHERE feed IN (%s)" % ','.join('?' * len(names)), names)}
+            touched = set()
+            for post in posts:
+                for name in filled.intersection(feed_names(post)):
+                    self._insert(db, name, post)
+                    touched.add(name)
+            for name in touched:
+                self._trim(db, name)
+            self._changed(db)
+            db.commit()
+
+    def remove(self, post_id):
+        with self.pool.connection(index_path()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            names = [row['feed'] for row in db.execute("SELECT feed FROM feed_posts WHERE post_id = ?", (post_id,))]
+            db.execute("DELETE FROM feed_posts WHERE post_id = ?", (post_id,))
+            # a feed that was full is now missing the next older post; refill it on the next read
+            for name in names:
+                db.execute("DELETE FROM feeds WHERE feed = ? AND (SELECT COUNT(*) FROM feed_posts WHERE feed = ?) >= ?",
+                           (name, name, self.size - 1))
+            self._changed(db)
+            db.commit()
+
+    def reset(self):
+        """Forget every materialized feed, e.g. after stored excerpts were rewritten; each refills on its next read."""
+        with self.pool.connection(index_path()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM feed_posts")
+            db.execute("DELETE FROM feeds")
+            self._changed(db)
+            db.commit()
+
+    def _changed(self, db):
+        # a fill that read its source before this commits must not store what it read
+        db.execute("INSERT INTO feed_state (id, version) VALUES (1, 1) ON CONFLICT(id) DO UPDATE SET version = version + 1")
+
+    def _version(self, db):
+        rows = db.execute("SELECT version FROM feed_state").fetchall()
+        return rows[0]['version'] if rows else 0
+
+    def _fill(self, name, source):
+        """Materialize a feed; returns the posts read instead when feeds kept changing under the read."""
+        for _ in range(FILL_ATTEMPTS):
+            with self.pool.connection(index_path()) as db:
+                version = self._version(db)
+            # no connection is held meanwhile: the source checks out its own
+            posts = list(source(self.size))
+            with self.pool.connection(index_path()) as db:
+                db.execute("BEGIN IMMEDIATE")
+                if db.execute("SELECT 1 FROM feeds WHERE feed = ?", (name,)).fetchone() is None:
+                    if self._version(db) != version:
+                        db.rollback()
+                        continue
+                    for post in posts:
+                        self._insert(db, name, post)
+                    self._trim(db, name)
+                    db.execute("INSERT INTO feeds (feed) VALUES (?)", (name,))
+                db.commit()
+            return None
+        return posts
+
+    def page(self, name, limit, source):
+        """The newest `limit` (at most FEED_SIZE) posts of a feed as excerpt-only Posts.
+
+        source(n) must return the newest n posts of the feed, newest first. It
+        is only called to fill a feed that is not materialized yet, outside
+        any transaction, so it may read the shards and index.db freely; the
+        write lock is only taken to store the result.
+        """
+        with self.pool.connection(index_path()) as db:
+            rows = None
+            if db.execute("SELECT 1 FROM feeds WHERE feed = ?", (name,)).fetchone() is not None:
+                rows = self._rows(db, name, limit)
+                if any(row['post_excerpt'] is None for row in rows):
+                    # copied from posts stored before excerpts were; their shards are backfilled on open
+                    db.execute("BEGIN IMMEDIATE")
+                    db.execute("DELETE FROM feed_posts WHERE feed = ?", (name,))
+                    db.execute("DELETE FROM feeds WHERE feed = ?", (name,))
+                    self._changed(db)
+                    db.commit()
+                    rows = None
+        if rows is None:
+            posts = self._fill(name, source)
+            if posts is not None:
+                return posts[:limit]
+            with self.pool.connection(index_path()) as db:
+                rows = self._rows(db, name, limit)
+        return [Post.from_row(row, row['post_id']) for row in rows]
+
+    def _rows(self, db, name, limit):
+        return db.execute("""SELECT post_id, post_title, post_excerpt, post_author, tags, timestamp FROM feed_posts
+                             WHERE feed = ? ORDER BY timestamp DESC, post_id DESC LIMIT ?""", (name, limit)).fetchall()
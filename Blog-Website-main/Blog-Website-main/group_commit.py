@@ -0,0 +1,113 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from models import Unavailable
+
+_STOP = object()
+
+
+class GroupCommitter:
+    """Single background writer that commits queued items in groups.
+
+    SQLite has one writer at a time, so instead of every request taking the
+    write lock for its own transaction, callers put their item on a bounded
+    queue and wait. The writer thread takes the first item plus whatever else
+    is queued (up to `batch_size` items), waiting up to `window` seconds for
+    more when the previous group had company, and passes them all to
+    `commit`. That writes them in one transaction and returns one result per
+    item, or an exception instance for an item that failed on its own. If
+    `commit` raises, every caller in the group gets the error.
+
+    When `max_pending` items are already waiting, submit() waits up to
+    `wait` seconds for room and then raises Unavailable, so a burst turns
+    into 503s instead of an ever longer queue.
+
+    Like ActivityLog, each process starts its own thread lazily, so the
+    committer is safe to use after a pre-fork server forks its workers.
+    """
+
+    def __init__(self, commit, name='group-commit', window=0.001, batch_size=256, max_pending=1024, wait=2.0):
+        self.commit = commit
+        self.name = name
+        self.window = window
+        self.batch_size = batch_size
+        self.wait = wait
+        self.stats = {'items': 0, 'batches': 0, 'rejected': 0, 'commit_seconds': 0.0}
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def submit(self, item):
+        """Queue item and block until its group is committed; returns commit's result for it."""
+        self._ensure_writer()
+        future = Future()
+        try:
+            self._queue.put((item, future), timeout=self.wait)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            raise Unavailable("Too many posts are being published, try again shortly")
+        return future.result()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    # inherited across fork: the parent's waiters are not ours
+                    self._queue = queue.Queue(self._queue.maxsize)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        burst = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # a lone writer is never held back; the window only applies while groups are forming
+            deadline = time.monotonic() + (self.window if burst else 0)
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if batch[-1] is _STOP:
+                batch.pop()
+                stopping = True
+            if batch:
+                self._commit_batch(batch)
+            burst = len(batch) > 1
+
+    def _commit_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            results = self.commit([item for item, future in batch])
+        except Exception as e:
+            for item, future in batch:
+                future.set_exception(e)
+        else:
+            for (item, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        self.stats['items'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['commit_seconds'] += time.perf_counter() - started
+
+    def close(self, timeout=5):
+        """Commit what is queued and stop the writer thread."""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
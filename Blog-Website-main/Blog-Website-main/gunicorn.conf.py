@@ -0,0 +1,40 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+import os
+import signal
+import threading
+
+bind = os.environ.get('BLOG_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('BLOG_WORKERS', os.cpu_count() or 1))
+threads = int(os.environ.get('BLOG_THREADS', 4))
+worker_class = 'gthread'
+
+# build the app once in the master, then fork; run `flask migrate` before starting
+preload_app = True
+
+# on SIGTERM workers stop accepting and get this long to finish in-flight requests
+graceful_timeout = int(os.environ.get('BLOG_GRACEFUL_TIMEOUT', 30))
+timeout = 60
+# seconds a worker keeps serving with /readyz failing before it stops accepting
+drain_seconds = float(os.environ.get('BLOG_DRAIN_SECONDS', 0))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    from wsgi import init_worker
+    init_worker()
+
+
+def post_worker_init(worker):
+    handle_exit = worker.handle_exit
+
+    def drain_then_exit(sig, frame):
+        from wsgi import start_draining
+        start_draining()
+        threading.Timer(drain_seconds, handle_exit, (sig, frame)).start()
+
+    signal.signal(signal.SIGTERM, drain_then_exit)
+
+
+def worker_exit(server, worker):
+    from wsgi import shutdown_worker
+    shutdown_worker()
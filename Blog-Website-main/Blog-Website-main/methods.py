@@ -1,18 +1,38 @@
 import sqlite3
 import hashlib
-import json
-import datetime
 import os
+import itertools
+import base64
+import json
 from flask import g, current_app, session
-import mistune
+from db import ConnectionPool
+from metrics import connection_factory
+from shards import (ShardCatalog, current_month, shard_path, global_id, split_id,
+                    merge_newest_first, encode_cursor, decode_cursor, locate_month)
+from models import BlogError, BadRequest, NotFound, Unavailable, Post, PostPage, UserRecord, UserPage
+from search import SearchIndex
+from tags import TagIndex, parse_tags
+from feeds import FeedIndex, FEED_SIZE
+from activity_log import activity_log, admin_log
+from rendering import render, make_excerpt, RENDERER_VERSION
+from passwords import password_hasher
+from group_commit import GroupCommitter
+from counters import ViewCounter
+from migrations import migrate, require_current, UNIQUE_USER_COLUMNS
 
 DATABASE = 'User.db'
-POSTS_DATABASE_DIR = 'static/POSTS'
+
+# files whose schema version this process has already checked
+_checked = set()
 
 def get_db(db_name=DATABASE):
     if 'db' not in g:
-        g.db = sqlite3.connect(db_name)
+        g.db = sqlite3.connect(db_name, factory=connection_factory)
         g.db.row_factory = sqlite3.Row
+        if db_name not in _checked:
+            # migrations run once, from `flask migrate`; workers only check they have
+            require_current(g.db)
+            _checked.add(db_name)
     return g.db
 
 def close_db(e=None):
@@ -24,241 +44,548 @@ class User:
     def __init__(self):
         pass
 
+    def hash_username(self, username):
+        # a lookup key, not a secret, so it stays a plain deterministic digest
+        return hashlib.sha256(username.encode()).hexdigest()
+
     def hash_password(self, password):
-        return hashlib.sha256(password.encode()).hexdigest()
+        return password_hasher.hash(password)
 
     def register(self, username, password, email, age, phone_number):
         try:
             db = get_db()
             cursor = db.cursor()
             hashed_password = self.hash_password(password)
-            hashed_username = self.hash_password(username)
+            hashed_username = self.hash_username(username)
             
             cursor.execute("INSERT INTO pending_users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
                             (username, hashed_username, hashed_password, email, age, phone_number))
             db.commit()
             self.log_activity(f"{username} Registerd")
-            return json.dumps({"status": 200, "msg": "Registration request submitted successfully"})
         except sqlite3.IntegrityError:
-            return json.dumps({"status": 400, "msg": "Username already exists"})
+            raise BadRequest("Username already exists")
         except sqlite3.Error as e:
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
 
     def login(self, username, password):
         try:
             db = get_db()
-            cursor = db.cursor()
-            hashed_password = self.hash_password(password)
-            cursor.execute("SELECT * FROM users WHERE hashed_username = ? AND password = ?", (self.hash_password(username), hashed_password))
-            if cursor.fetchone():
-                self.log_activity(f'{username} Looged in')
-                return json.dumps({"status": 200, "msg": "Login successful"})
-            return json.dumps({"status": 400, "msg": "Invalid username or password"})
+            found = db.execute("SELECT user_id, password FROM users WHERE hashed_username = ?", (self.hash_username(username),)).fetchone()
         except sqlite3.Error as e:
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
+        # unknown users still pay for one hash so response time does not reveal them
+        stored = found['password'] if found else password_hasher.dummy_hash()
+        if not password_hasher.verify(password, stored) or found is None:
+            raise BadRequest("Invalid username or password")
+        if password_hasher.needs_rehash(found['password']):
+            upgrade_password(db, 'users', 'user_id', found['user_id'], found['password'], password)
+        self.log_activity(f'{username} Looged in')
 
     def log_activity(self, message):
-        log_file = 'log.txt'
-        with open(log_file, 'a') as f:
-            log_message = f"{datetime.datetime.now()} - {message}\n"
-            f.write(log_message)
+        activity_log.write(message=message)
 
     
    
+def upgrade_password(db, table, key, value, old_hash, password):
+    """Re-hash a password that was just verified against a legacy or cheaper hash.
+
+    The update only applies if the stored hash is still the one verified, so
+    a concurrent password reset is never overwritten.
+    """
+    try:
+        db.execute(f"UPDATE {table} SET password = ? WHERE {key} = ? AND password = ?",
+                   (password_hasher.hash(password), value, old_hash))
+        db.commit()
+    except (sqlite3.Error, BlogError) as e:
+        activity_log.write(message=f"Password upgrade failed for {table} {value}: {e}")
+
+POSTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_title TEXT NOT NULL,
+    post_content TEXT NOT NULL,
+    post_author TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_posts_timestamp ON posts (timestamp);
+CREATE INDEX IF NOT EXISTS idx_posts_author_timestamp ON posts (post_author, timestamp);
+CREATE TABLE IF NOT EXISTS deleted_posts (
+    post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_title TEXT NOT NULL,
+    post_content TEXT NOT NULL,
+    post_author TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL);
+"""
+
+# columns added after the first monthly files were created; older files get
+# them through ALTER TABLE when a process first opens them
+POSTS_COLUMNS = (
+    ('post_markdown', 'TEXT'),
+    ('post_excerpt', 'TEXT'),
+    ('render_version', 'INTEGER NOT NULL DEFAULT 0'),
+)
+# rows deleted before deleted_at existed count from the post's own timestamp
+DELETED_POSTS_COLUMNS = POSTS_COLUMNS + (
+    ('deleted_at', 'TIMESTAMP'),
+)
+
+def migrate_posts_schema(db):
+    db.executescript(POSTS_SCHEMA)
+    for table, columns in (('posts', POSTS_COLUMNS), ('deleted_posts', DELETED_POSTS_COLUMNS)):
+        existing = {row['name'] for row in db.execute(f"PRAGMA table_info({table})")}
+        for name, definition in columns:
+            if name not in existing:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    # list pages only read post_excerpt, so rows stored before it existed get
+    # one now; the partial index keeps this check free once they have
+    db.execute("CREATE INDEX IF NOT EXISTS idx_posts_missing_excerpt ON posts (post_id) WHERE post_excerpt IS NULL")
+    while True:
+        rows = db.execute("SELECT post_id, post_content FROM posts WHERE post_excerpt IS NULL LIMIT 500").fetchall()
+        if not rows:
+            break
+        db.executemany("UPDATE posts SET post_excerpt = ? WHERE post_id = ?",
+                       [(make_excerpt(row['post_content']), row['post_id']) for row in rows])
+        db.commit()
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# shared by every POSTS instance so the monthly files are opened once per process
+post_connections = ConnectionPool(schema=migrate_posts_schema)
+# archived months never change once written, so they are opened immutable
+archive_connections = ConnectionPool(readonly=True)
+
+# how long the post writer waits for more posts to commit together, and how many may queue
+WRITE_WINDOW = float(os.environ.get('BLOG_WRITE_WINDOW_MS', 1)) / 1000
+WRITE_QUEUE = int(os.environ.get('BLOG_WRITE_QUEUE', 1024))
+# views are written this often; popularity halves every BLOG_POPULAR_HALF_LIFE_HOURS
+VIEW_FLUSH_INTERVAL = float(os.environ.get('BLOG_VIEW_FLUSH_SECONDS', 5))
+POPULAR_HALF_LIFE = float(os.environ.get('BLOG_POPULAR_HALF_LIFE_HOURS', 48)) * 3600
+
+# list endpoints can skip the full HTML body and send the stored excerpt instead
+LIST_COLUMNS = {
+    'full': "post_id, post_title, post_content, post_excerpt, post_author, tags, timestamp",
+    'excerpt': "post_id, post_title, post_excerpt, post_author, tags, timestamp",
+}
+
+def list_columns(body):
+    if body not in LIST_COLUMNS:
+        raise BadRequest("body must be 'full' or 'excerpt'")
+    return LIST_COLUMNS[body]
+
 class POSTS:
-    def __init__(self):
-        self.db = None
-        self.cursor = None
-
-    def connect_to_db(self):
-        current_month = datetime.datetime.now().strftime("%Y_%m")
-        db_name = os.path.join(POSTS_DATABASE_DIR, f'Post_{current_month}.db')
-        self.db = sqlite3.connect(db_name)
-        self.db.row_factory = sqlite3.Row
-        self.cursor = self.db.cursor()
+    def __init__(self, pool=None, catalog=None, search=None, tags=None, cache=None, feeds=None, archive_pool=None, writer=None, views=None):
+        self.pool = pool or post_connections
+        self.archive_pool = archive_pool or archive_connections
+        self.catalog = catalog or ShardCatalog()
+        self.search = search or SearchIndex()
+        self.tags = tags or TagIndex()
+        self.feeds = feeds or FeedIndex()
+        # optional cache.ResponseCache to invalidate on writes
+        self.cache = cache
+        self.writer = writer or GroupCommitter(self.commit_posts, name='post-writer',
+                                               window=WRITE_WINDOW, max_pending=WRITE_QUEUE)
+        self.views = views or ViewCounter(interval=VIEW_FLUSH_INTERVAL, half_life=POPULAR_HALF_LIFE)
+
+    def connect_to_db(self, month=None):
+        return self.pool.connection(shard_path(month or current_month()))
+
+    def read_shard(self, shard):
+        return (self.archive_pool if shard.archived else self.pool).connection(shard.path)
+
+    def iter_posts(self, post_author=None, cursor=None, limit=None, body='full'):
+        """Yield posts newest first across every shard, continuing after cursor.
+
+        Each shard is read with a keyset query on (timestamp, post_id), so
+        only about `limit` rows per shard are ever materialized. With
+        body='excerpt' the rendered HTML is not read at all.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        columns = list_columns(body)
+        shards = self.catalog.shards()
+        buried = self.catalog.tombstones() if any(shard.archived for shard in shards) else set()
+
+        def stream(shard):
+            where, params = [], []
+            if post_author is not None:
+                where.append("post_author = ?")
+                params.append(post_author)
+            if after:
+                where.append("(timestamp, post_id) < (?, ?)")
+                params.extend((after[0], shard.stored_id(after[1])))
+            query = f"SELECT {columns} FROM posts"
+            if where:
+                query += " WHERE " + " AND ".join(where)
+            query += " ORDER BY timestamp DESC, post_id DESC"
+            if limit:
+                query += " LIMIT ?"
+                # tombstoned rows are still in the archive and get skipped below
+                params.append(limit + len(buried) if shard.archived else limit)
+            with self.read_shard(shard) as db:
+                for row in db.execute(query, params):
+                    post_id = row['post_id'] + shard.offset
+                    if post_id not in buried:
+                        yield Post.from_row(row, post_id)
+
+        merged = merge_newest_first([stream(shard) for shard in shards])
+        return itertools.islice(merged, limit) if limit else merged
+
+    def get_feed(self, post_author=None, tag=None, limit=DEFAULT_PAGE_SIZE):
+        """Newest posts (excerpts only) of the homepage, an author or a tag, from the materialized feed."""
+        limit = max(1, min(int(limit), FEED_SIZE))
+        if tag is not None:
+            tag = (parse_tags(tag) or [''])[0]
+            source = lambda size: self.get_posts_by_ids([ref.post_id for ref in self.tags.page([tag], limit=size)], 'excerpt')
+            name = f'tag:{tag}'
+        else:
+            source = lambda size: list(self.iter_posts(post_author, limit=size, body='excerpt'))
+            name = 'latest' if post_author is None else f'author:{post_author}'
+        try:
+            return self.feeds.page(name, limit, source)
+        except sqlite3.Error as e:
+            raise BlogError() from e
+
+    def feed_page(self, post_author=None, tag=None, limit=DEFAULT_PAGE_SIZE):
+        page = self.get_feed(post_author, tag, limit + 1)
+        # the cursor has the same form as a keyset page's, so "load more" continues from the shards
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return PostPage(page[:limit], next_cursor)
+
+    def get_page(self, post_author=None, cursor=None, limit=DEFAULT_PAGE_SIZE, body='full'):
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        if cursor is None and body == 'excerpt':
+            # first pages of excerpts are what the homepage and profiles load
+            return self.feed_page(post_author, limit=limit)
         try:
-            self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS posts (
-                post_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_title TEXT NOT NULL,
-                post_content TEXT NOT NULL,
-                post_author TEXT NOT NULL,
-                tags TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL)
-            """)
-            self.cursor.execute("""CREATE TABLE IF NOT EXISTS deleted_posts (
-                post_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_title TEXT NOT NULL,
-                post_content TEXT NOT NULL,
-                post_author TEXT NOT NULL,
-                tags TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL)
-            """)
-            self.db.commit()
+            # one extra row tells us whether there is a next page
+            page = list(self.iter_posts(post_author, cursor, limit + 1, body))
+        except ValueError as e:
+            raise BadRequest(str(e))
         except sqlite3.Error as e:
-            self.log_activity("Error initializing POSTS class: " + str(e))
+            raise BlogError() from e
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return PostPage(page[:limit], next_cursor)
 
     def create_post(self, post_title, post_content, post_author, tags):
-        self.connect_to_db()
+        # rendering happens on the request thread; only the insert waits for the writer
+        html_content, excerpt = render(post_content)
         try:
-            markdown = mistune.create_markdown()
-            html_content = markdown(post_content)
-
-            self.cursor.execute("INSERT INTO posts (post_title, post_content, post_author, tags) VALUES (?, ?, ?, ?)", 
-                                (post_title, html_content, post_author, tags))
-            self.db.commit()
-            self.log_activity(f"Post created by {post_author}")
-            return json.dumps({"status": 200, "msg": "Post created successfully"})
+            post = self.writer.submit((post_title, html_content, post_content, excerpt, RENDERER_VERSION, post_author, tags))
         except sqlite3.Error as e:
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
+        if self.cache:
+            self.cache.post_created(post.post_id)
+        self.log_activity(f"Post created by {post_author}")
+        return post.post_id
+
+    def commit_posts(self, rows):
+        """Insert rendered posts in one transaction; called by the writer with a group of create_post calls.
+
+        Returns a Post per row, or a BlogError for a row the database refused.
+        The indexes are updated for the whole group before anyone is answered,
+        so a new post is already in the feeds when its author is redirected.
+        Once the shard has committed nothing raises: a caller told its post
+        failed would post it again.
+        """
+        month = current_month()
+        self.catalog.ensure_discovered()
+        results = []
+        with self.connect_to_db(month) as db:
+            db.execute('BEGIN IMMEDIATE')
+            for row in rows:
+                try:
+                    cursor = db.execute("""INSERT INTO posts (post_title, post_content, post_markdown, post_excerpt, render_version, post_author, tags)
+                                           VALUES (?, ?, ?, ?, ?, ?, ?)""", row)
+                except sqlite3.IntegrityError as e:
+                    results.append(BadRequest(f"Post could not be saved: {e}"))
+                else:
+                    results.append(cursor.lastrowid)
+            inserted = [result for result in results if isinstance(result, int)]
+            stored = {row['post_id']: row for row in db.execute(
+                "SELECT * FROM posts WHERE post_id IN (%s)" % ','.join('?' * len(inserted)), inserted)}
+            db.commit()
+        try:
+            self.catalog.adjust(month, len(inserted))
+        except (sqlite3.Error, Unavailable) as e:
+            # post_count only has to be non-zero for the month to be listed; its next post fixes that
+            self.log_activity(f"Shard count update failed for {month} after {len(inserted)} posts: {e}")
+        results = [Post.from_row(stored[result], global_id(month, result)) if isinstance(result, int) else result
+                   for result in results]
+        self.update_indexes([result for result in results if isinstance(result, Post)])
+        return results
 
     def delete_post(self, post_id):
-        self.connect_to_db()
         try:
-            # instead of deleting the post move the post to deleted post tabel
-            self.cursor.execute('SELECT * from posts WHERE post_id = ?',(post_id,))
-            post=self.cursor.fetchone()
-            self.cursor.execute('INSERT INTO deleted_posts(post_id, post_title, post_content, post_author, tags, timestamp) VALUES(?,?,?,?,?,?)',(post['post_id'],post['post_title'],post['post_content'],post['post_author'],post['tags'],post['timestamp']))
-            self.cursor.execute("DELETE FROM posts WHERE post_id = ?", (post_id,))
-            self.db.commit()
-            self.log_activity(f"Post deleted with ID {post_id}")
-            return json.dumps({"status": 200, "msg": "Post deleted successfully"})
+            month, local_id = split_id(post_id)
+        except (ValueError, TypeError):
+            raise NotFound("Post not found")
+        try:
+            shard = self.catalog.locate(month)
+            if shard.archived:
+                self.bury_post(month, global_id(month, local_id))
+            elif not os.path.exists(shard.path):
+                # the id is client input; connecting would create the month's shard
+                raise NotFound("Post not found")
+            else:
+                with self.connect_to_db(month) as db:
+                    # compact-shards holds this lock while it archives the month
+                    db.execute('BEGIN IMMEDIATE')
+                    if self.catalog.locate(month).archived:
+                        db.rollback()
+                        return self.delete_post(post_id)
+                    # instead of deleting the post move the post to deleted post tabel
+                    post = db.execute('SELECT * from posts WHERE post_id = ?',(local_id,)).fetchone()
+                    if post is None:
+                        raise NotFound("Post not found")
+                    db.execute('INSERT INTO deleted_posts(post_id, post_title, post_content, post_markdown, post_excerpt, render_version, post_author, tags, timestamp, deleted_at) VALUES(?,?,?,?,?,?,?,?,?,CURRENT_TIMESTAMP)',(post['post_id'],post['post_title'],post['post_content'],post['post_markdown'],post['post_excerpt'],post['render_version'],post['post_author'],post['tags'],post['timestamp']))
+                    db.execute("DELETE FROM posts WHERE post_id = ?", (local_id,))
+                    db.commit()
+                self.catalog.adjust(month, -1)
         except sqlite3.Error as e:
             # print(e)
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
+        self.remove_from_indexes(global_id(month, local_id))
+        if self.cache:
+            self.cache.post_deleted(global_id(month, local_id))
+        self.log_activity(f"Post deleted with ID {post_id}")
 
-    def get_posts(self):
-        self.connect_to_db()
-        try:
-            self.cursor.execute("SELECT * FROM posts ORDER BY timestamp DESC")
-            posts = self.cursor.fetchall()
-            return json.dumps({"status": 200, "msg": "Posts fetched successfully", "data": [dict(post) for post in posts]})
-        except sqlite3.Error as e:
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+    def bury_post(self, month, post_id):
+        # archives are immutable; the next compaction moves the row to deleted_posts
+        shard = self.catalog.locate(month)
+        with self.read_shard(shard) as db:
+            exists = db.execute("SELECT 1 FROM posts WHERE post_id = ?", (shard.stored_id(post_id),)).fetchone()
+        if exists is None or not self.catalog.bury(month, post_id):
+            raise NotFound("Post not found")
+
+    def update_indexes(self, posts):
+        # the posts themselves are already committed; a missed index update is
+        # picked up again by `flask reindex-search` / `flask backfill-tags`
+        for index in (self.search, self.tags, self.feeds):
+            try:
+                index.add_many(posts)
+            except (sqlite3.Error, Unavailable) as e:
+                self.log_activity(f"{type(index).__name__} update failed for posts {', '.join(str(post.post_id) for post in posts)}: {e}")
+
+    def refresh_indexes(self, months):
+        # feeds and search keep their own copies of excerpts and bodies
+        self.search.reindex(months)
+        self.feeds.reset()
+
+    def remove_from_indexes(self, post_id):
+        for index in (self.search, self.tags, self.feeds, self.views):
+            try:
+                index.remove(post_id)
+            except (sqlite3.Error, Unavailable) as e:
+                self.log_activity(f"{type(index).__name__} update failed for post {post_id}: {e}")
+
+    def get_posts(self, cursor=None, limit=DEFAULT_PAGE_SIZE, body='full'):
+        return self.get_page(cursor=cursor, limit=limit, body=body)
 
     def get_post_by_id(self, post_id):
-        self.connect_to_db()
         try:
-            self.cursor.execute("SELECT * FROM posts WHERE post_id = ?", (post_id,))
-            post = self.cursor.fetchone()
-            if post:
-                return json.dumps({"status": 200, "msg": "Post fetched successfully", "data": dict(post)})
-            else:
-                return json.dumps({"status": 404, "msg": "Post not found"})
+            month, local_id = split_id(post_id)
+        except (ValueError, TypeError):
+            raise NotFound("Post not found")
+        post_id = global_id(month, local_id)
+        try:
+            shard = self.catalog.locate(month)
+            if not os.path.exists(shard.path) or shard.archived and self.catalog.is_buried(post_id):
+                raise NotFound("Post not found")
+            with self.read_shard(shard) as db:
+                post = db.execute("SELECT * FROM posts WHERE post_id = ?", (shard.stored_id(post_id),)).fetchone()
         except sqlite3.Error as e:
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
+        if post is None:
+            raise NotFound("Post not found")
+        return Post.from_row(post, post_id)
         
-    def get_user_posts(self, post_author):
-        self.connect_to_db()
+    def get_posts_by_ids(self, post_ids, body='full'):
+        """Fetch posts in the given order, opening each shard once."""
+        columns = list_columns(body)
+        found = {}
+        try:
+            locations = self.catalog.locations()
+            by_shard = {}
+            for post_id in post_ids:
+                month, local_id = split_id(post_id)
+                shard = locations.get(month) or locate_month(month)
+                by_shard.setdefault(shard.path, (shard, []))[1].append(shard.stored_id(global_id(month, local_id)))
+            buried = self.catalog.tombstones() if any(shard.archived for shard, _ in by_shard.values()) else set()
+            for shard, stored_ids in by_shard.values():
+                with self.read_shard(shard) as db:
+                    rows = db.execute(f"SELECT {columns} FROM posts WHERE post_id IN (%s)" % ','.join('?' * len(stored_ids)), stored_ids)
+                    for row in rows:
+                        post = Post.from_row(row, row['post_id'] + shard.offset)
+                        found[post.post_id] = post
+        except sqlite3.Error as e:
+            raise BlogError() from e
+        return [found[post_id] for post_id in post_ids if post_id in found and post_id not in buried]
+
+    def get_popular(self, limit=DEFAULT_PAGE_SIZE):
+        """[(post, views, score)] for the most popular posts, as excerpt-only Posts."""
         try:
-            self.cursor.execute("SELECT * FROM posts WHERE post_author = ? ORDER BY timestamp DESC", (post_author,))
-            posts = self.cursor.fetchall()
-            self.log_activity(f"Posts fetched for {post_author}")
-            return json.dumps({"status": 200, "msg": "Posts fetched successfully", "data": [dict(post) for post in posts]})
+            ranked = self.views.top(limit)
         except sqlite3.Error as e:
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
+        found = {post.post_id: post for post in self.get_posts_by_ids([post_id for post_id, _, _ in ranked], body='excerpt')}
+        return [(found[post_id], views, score) for post_id, views, score in ranked if post_id in found]
+
+    def get_tagged_posts(self, tags, match_all=False, cursor=None, limit=DEFAULT_PAGE_SIZE, body='full'):
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        normalized = parse_tags(','.join(tags))
+        if cursor is None and body == 'excerpt' and len(normalized) == 1:
+            return self.feed_page(tag=normalized[0], limit=limit)
+        try:
+            after = decode_cursor(cursor) if cursor else None
+            refs = self.tags.page(tags, match_all, after, limit + 1)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        except sqlite3.Error as e:
+            raise BlogError() from e
+        next_cursor = encode_cursor(refs[limit - 1]) if len(refs) > limit else None
+        return PostPage(self.get_posts_by_ids([ref.post_id for ref in refs[:limit]], body), next_cursor)
+
+    def get_user_posts(self, post_author, cursor=None, limit=DEFAULT_PAGE_SIZE, body='full'):
+        page = self.get_page(post_author, cursor, limit, body)
+        self.log_activity(f"Posts fetched for {post_author}")
+        return page
 
     def log_activity(self, message):
-        log_file = 'log.txt'
-        with open(log_file, 'a') as f:
-            log_message = f"{datetime.datetime.now()} - {message}\n"
-            f.write(log_message)
+        activity_log.write(message=message)
+
+USER_TABLES = ('users', 'pending_users')
+# every sort and search column is indexed in both tables
+USER_SORTS = ('user_id', 'username', 'email')
+USER_SEARCH_FIELDS = ('username', 'email')
+ADMIN_PAGE_SIZE = 50
+MAX_BULK_IDS = 10000
+
+def encode_user_cursor(value, user_id):
+    return base64.urlsafe_b64encode(json.dumps([value, user_id]).encode()).decode()
+
+def decode_user_cursor(token):
+    try:
+        value, user_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return value, int(user_id)
+    except (ValueError, TypeError, UnicodeError):
+        raise BadRequest('Invalid cursor')
 
 class Admin:
-    def __init__(self, app=None):
-        if app:
-            with app.app_context():
-                self.ensure_admin_table()
-
-    def log_activity(self, admin_username, action, status):
-        log_file = 'admin_log.txt'
-        with open(log_file, 'a') as f:
-            log_message = f"{datetime.datetime.now()} - Admin: {admin_username} - Action: {action} - Status: {status}\n"
-            f.write(log_message)
-
-    def ensure_admin_table(self):
-        db = get_db('User.db')
-        cursor = db.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admin_users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL
-        )
-        """)
-        self.log_activity('System', 'Initialize Admin Table', 'Success')
-        cursor.execute("""CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                hashed_username TEXT NOT NULL,
-                password TEXT NOT NULL,
-                email TEXT NOT NULL,
-                age INTEGER NOT NULL,
-                phone_number TEXT NOT NULL)
-            """)
-        self.log_activity('System', 'Initialize Users Table', 'Success')
-        cursor.execute("""CREATE TABLE IF NOT EXISTS pending_users (
-                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                hashed_username TEXT NOT NULL,
-                password TEXT NOT NULL,
-                email TEXT NOT NULL,
-                age INTEGER NOT NULL,
-                phone_number TEXT NOT NULL)
-            """)
-        db.commit()
-        self.log_activity('System', 'Initialize Pending Users Table', 'Success')
-        cursor.execute("SELECT COUNT(*) FROM admin_users")
-        if cursor.fetchone()[0] == 0:
-            self.create_default_admin()
+    def log_activity(self, admin_username, action, status, **details):
+        admin_log.write(admin=admin_username, action=action, status=status, **details)
+
+    def ensure_admin_table(self, db_name=DATABASE):
+        """Migrate User.db and add the default admin if there is none; returns the versions applied."""
+        db = sqlite3.connect(db_name)
+        try:
+            applied = migrate(db)
+            for version in applied:
+                self.log_activity('System', f'Migrate User.db to version {version}', 'Success')
+            if db.execute("SELECT COUNT(*) FROM admin_users").fetchone()[0] == 0:
+                self.create_default_admin(db)
+        finally:
+            db.close()
+        return applied
 
-    def create_default_admin(self):
+    def create_default_admin(self, db):
         default_username = 'admin'
         default_password = 'admin_password'  # Replace with a secure default password
-        hashed_password = hashlib.sha256(default_password.encode()).hexdigest()
-        db = get_db('User.db')
+        hashed_password = password_hasher.hash(default_password)
         cursor = db.cursor()
         cursor.execute("INSERT INTO admin_users (username, password) VALUES (?, ?)",
                        (default_username, hashed_password))
         db.commit()
 
     def authenticate(self, username, password):
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
         db = get_db('User.db')
-        cur = db.execute('SELECT * FROM admin_users WHERE username = ? AND password = ?', (username, hashed_password))
-        self.log_activity(username, 'Login', 'Success' if cur.fetchone() else 'Failed')
+        found = db.execute('SELECT password FROM admin_users WHERE username = ?', (username,)).fetchone()
+        stored = found['password'] if found else password_hasher.dummy_hash()
+        try:
+            authenticated = password_hasher.verify(password, stored) and found is not None
+        except BlogError:
+            self.log_activity(username, 'Login', 'Failed - Hasher busy')
+            return False
+        if authenticated and password_hasher.needs_rehash(found['password']):
+            upgrade_password(db, 'admin_users', 'username', username, found['password'], password)
+        self.log_activity(username, 'Login', 'Success' if authenticated else 'Failed')
         # print(username,hashed_password )
-        return cur.fetchone()
+        return authenticated
 
     def get_registered_users(self):
         db = get_db('User.db')
         cursor = db.execute('SELECT * FROM users')
-        return cursor.fetchall()
+        return [UserRecord.from_row(row) for row in cursor]
 
     def get_pending_users(self):
         db = get_db('User.db')
         cursor = db.execute('SELECT * FROM pending_users')
-        return cursor.fetchall()
+        return [UserRecord.from_row(row) for row in cursor]
+
+    def list_users(self, table, q=None, field='username', sort='user_id', order='asc', cursor=None, limit=ADMIN_PAGE_SIZE):
+        """One page of `table` ordered by `sort`, optionally limited to a username/email prefix.
+
+        Pages continue from a (sort value, user_id) cursor, so deep pages cost
+        the same as the first one.
+        """
+        if table not in USER_TABLES:
+            raise NotFound("Unknown user list")
+        if sort not in USER_SORTS or field not in USER_SEARCH_FIELDS or order not in ('asc', 'desc'):
+            raise BadRequest("Invalid sort, order or search field")
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        where, params = [], []
+        if q:
+            # a range on the column rather than LIKE, so the index is used
+            where.append(f"{field} >= ? AND {field} < ?")
+            params.extend((q, q + '\U0010ffff'))
+        if cursor:
+            value, user_id = decode_user_cursor(cursor)
+            op = '>' if order == 'asc' else '<'
+            if sort == 'user_id':
+                where.append(f"user_id {op} ?")
+                params.append(user_id)
+            else:
+                where.append(f"({sort}, user_id) {op} (?, ?)")
+                params.extend((value, user_id))
+        query = f"SELECT * FROM {table}"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {sort} {order}" + (f", user_id {order}" if sort != 'user_id' else "") + " LIMIT ?"
+        params.append(limit + 1)
+        db = get_db('User.db')
+        try:
+            rows = db.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            raise BlogError() from e
+        users = [UserRecord.from_row(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = users[-1]
+            next_cursor = encode_user_cursor(getattr(last, sort), last.user_id)
+        return UserPage(users, next_cursor)
+
+    def user_counts(self):
+        db = get_db('User.db')
+        return {row['name']: row['total'] for row in db.execute("SELECT name, total FROM user_counts")}
 
     def approve_user(self, user_id):
         db = get_db('User.db')
         cursor = db.cursor()
-        cursor.execute('SELECT * FROM pending_users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        if user:
-            cursor.execute('SELECT * FROM users WHERE username = ? OR email = ? OR phone_number = ?', 
-                            (user['username'], user['email'], user['phone_number']))
-            if cursor.fetchone():
-                self.log_activity(session.get('admin'), f'Approve User ID {user_id}', 'Failed - User already exists')
-                return json.dumps({"status": 400, "msg": "User already exists in the system"})
-            
-            cursor.execute('INSERT INTO users (username, hashed_username, password, email, age, phone_number) VALUES (?, ?, ?, ?, ?, ?)', 
-                            (user['username'], user['hashed_username'], user['password'], user['email'], user['age'], user['phone_number']))
-            cursor.execute('DELETE FROM pending_users WHERE user_id = ?', (user_id,))
-            db.commit()
-            self.log_activity(session.get('admin'), f'Approve User ID {user_id}', 'Success')
-            return json.dumps({"status": 200, "msg": "User approved successfully"})
-        self.log_activity(session.get('admin'), f'Approve User ID {user_id}', 'Failed - User not found')
-        return json.dumps({"status": 404, "msg": "User not found"})
+        try:
+            # the unique indexes on users reject a taken username, email or phone number
+            cursor.execute("""INSERT INTO users (username, hashed_username, password, email, age, phone_number)
+                              SELECT username, hashed_username, password, email, age, phone_number
+                              FROM pending_users WHERE user_id = ?""", (user_id,))
+        except sqlite3.IntegrityError:
+            db.rollback()
+            self.log_activity(session.get('admin'), f'Approve User ID {user_id}', 'Failed - User already exists')
+            raise BadRequest("User already exists in the system")
+        if cursor.rowcount == 0:
+            self.log_activity(session.get('admin'), f'Approve User ID {user_id}', 'Failed - User not found')
+            raise NotFound("User not found")
+        cursor.execute('DELETE FROM pending_users WHERE user_id = ?', (user_id,))
+        db.commit()
+        self.log_activity(session.get('admin'), f'Approve User ID {user_id}', 'Success')
 
     def deny_user(self, user_id):
         db = get_db('User.db')
@@ -273,20 +600,123 @@ class Admin:
         # instead of deleting the user move the user to pending user tabel
         cursor.execute('SELECT * from users WHERE user_id = ?',(user_id,))
         user=cursor.fetchone()
+        if user is None:
+            raise NotFound("User not found")
         cursor.execute('INSERT INTO pending_users(user_id, username, hashed_username, password, email, age, phone_number) VALUES(?,?,?,?,?,?,?)',(user_id,user['username'],user['hashed_username'],user['password'],user['email'],user['age'],user['phone_number']))
         cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
         db.commit()
         self.log_activity(session.get('admin'), f'Delete User ID {user_id}', 'Success')
 
+    def _bulk_ids(self, user_ids):
+        if not isinstance(user_ids, list) or not user_ids:
+            raise BadRequest("user_ids must be a non-empty list")
+        if len(user_ids) > MAX_BULK_IDS:
+            raise BadRequest(f"At most {MAX_BULK_IDS} user IDs per request")
+        try:
+            # duplicates collapse, first occurrence keeps its place in the results
+            return list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        except (TypeError, ValueError):
+            raise BadRequest("user_ids must be integers")
+
+    def _bulk_finish(self, db, action, user_ids, results):
+        db.commit()
+        summary = {}
+        for result in results.values():
+            summary[result] = summary.get(result, 0) + 1
+        # one audit entry per batch rather than one per user
+        self.log_activity(session.get('admin'), f'Bulk {action} {len(user_ids)} users', 'Success', summary=summary,
+                          user_ids={result: [user_id for user_id in user_ids if results[user_id] == result] for result in summary})
+        return [{"user_id": user_id, "result": results[user_id]} for user_id in user_ids], summary
+
+    def bulk_approve(self, user_ids):
+        """Approve many pending users in one transaction.
+
+        A user is 'conflict' if its username, email or phone number is taken
+        in users or by an earlier ID in the same batch, and 'not_found' if it
+        is not pending. Returns (per-ID results, counts by result).
+        """
+        user_ids = self._bulk_ids(user_ids)
+        batch = json.dumps(user_ids)
+        db = get_db('User.db')
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("""SELECT p.user_id, p.username, p.hashed_username, p.email, p.phone_number,
+                                        EXISTS (SELECT 1 FROM users u WHERE u.username = p.username)
+                                        OR EXISTS (SELECT 1 FROM users u WHERE u.hashed_username = p.hashed_username)
+                                        OR EXISTS (SELECT 1 FROM users u WHERE u.email = p.email)
+                                        OR EXISTS (SELECT 1 FROM users u WHERE u.phone_number = p.phone_number) AS taken
+                                 FROM pending_users p WHERE p.user_id IN (SELECT value FROM json_each(?))
+                                 ORDER BY p.user_id""", (batch,)).fetchall()
+            results = dict.fromkeys(user_ids, 'not_found')
+            seen = {column: set() for column in UNIQUE_USER_COLUMNS}
+            approved = []
+            for row in rows:
+                if row['taken'] or any(row[column] in seen[column] for column in UNIQUE_USER_COLUMNS):
+                    results[row['user_id']] = 'conflict'
+                    continue
+                for column in UNIQUE_USER_COLUMNS:
+                    seen[column].add(row[column])
+                results[row['user_id']] = 'approved'
+                approved.append(row['user_id'])
+            approved = json.dumps(approved)
+            db.execute("""INSERT INTO users (username, hashed_username, password, email, age, phone_number)
+                          SELECT username, hashed_username, password, email, age, phone_number FROM pending_users
+                          WHERE user_id IN (SELECT value FROM json_each(?)) ORDER BY user_id""", (approved,))
+            db.execute("DELETE FROM pending_users WHERE user_id IN (SELECT value FROM json_each(?))", (approved,))
+        except sqlite3.Error as e:
+            db.rollback()
+            self.log_activity(session.get('admin'), f'Bulk approve {len(user_ids)} users', 'Failed - ' + str(e))
+            raise BlogError() from e
+        return self._bulk_finish(db, 'approve', user_ids, results)
+
+    def bulk_deny(self, user_ids):
+        user_ids = self._bulk_ids(user_ids)
+        db = get_db('User.db')
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            denied = {row[0] for row in db.execute("DELETE FROM pending_users WHERE user_id IN (SELECT value FROM json_each(?)) RETURNING user_id",
+                                                   (json.dumps(user_ids),))}
+        except sqlite3.Error as e:
+            db.rollback()
+            self.log_activity(session.get('admin'), f'Bulk deny {len(user_ids)} users', 'Failed - ' + str(e))
+            raise BlogError() from e
+        results = {user_id: 'denied' if user_id in denied else 'not_found' for user_id in user_ids}
+        return self._bulk_finish(db, 'deny', user_ids, results)
+
+    def bulk_delete(self, user_ids):
+        """Move many users back to pending_users, keeping their IDs.
+
+        An ID that is also in pending_users already is reported as 'conflict'
+        and left alone.
+        """
+        user_ids = self._bulk_ids(user_ids)
+        db = get_db('User.db')
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("""SELECT u.user_id, EXISTS (SELECT 1 FROM pending_users p WHERE p.user_id = u.user_id) AS taken
+                                 FROM users u WHERE u.user_id IN (SELECT value FROM json_each(?))""", (json.dumps(user_ids),)).fetchall()
+            results = dict.fromkeys(user_ids, 'not_found')
+            for row in rows:
+                results[row['user_id']] = 'conflict' if row['taken'] else 'deleted'
+            deleted = json.dumps([user_id for user_id in user_ids if results[user_id] == 'deleted'])
+            db.execute("""INSERT INTO pending_users (user_id, username, hashed_username, password, email, age, phone_number)
+                          SELECT user_id, username, hashed_username, password, email, age, phone_number FROM users
+                          WHERE user_id IN (SELECT value FROM json_each(?))""", (deleted,))
+            db.execute("DELETE FROM users WHERE user_id IN (SELECT value FROM json_each(?))", (deleted,))
+        except sqlite3.Error as e:
+            db.rollback()
+            self.log_activity(session.get('admin'), f'Bulk delete {len(user_ids)} users', 'Failed - ' + str(e))
+            raise BlogError() from e
+        return self._bulk_finish(db, 'delete', user_ids, results)
+
     def reset_password(self, username, new_password):
         try:
             db = get_db()
             cursor = db.cursor()
-            hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
+            hashed_password = password_hasher.hash(new_password)
             cursor.execute("UPDATE users SET password = ? WHERE username = ?", (hashed_password, username))
             db.commit()
             self.log_activity(username, 'Reset Password', 'Success')
-            return json.dumps({"status": 200, "msg": "Password reset successfully"})
         except sqlite3.Error as e:
             self.log_activity(username, 'Reset Password', 'Failed - ' + str(e))
-            return json.dumps({"status": 500, "msg": "Internal server error"})
+            raise BlogError() from e
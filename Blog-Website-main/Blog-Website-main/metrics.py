@@ -0,0 +1,388 @@
+"""Per-process metrics in the Prometheus text format, served at /metrics.
+
+    BLOG_METRICS=0              no request hooks, no SQL wrapper, /metrics is a 404
+    BLOG_METRICS_TOKEN=...      scrapers sending `Authorization: Bearer <token>` may read
+                                /metrics; otherwise it needs an admin session
+    BLOG_SQL_METRICS=0          keep route metrics but open plain sqlite3 connections
+    BLOG_SLOW_QUERY_MS=100      queries at least this slow go to slow_log.txt
+    BLOG_SLOW_REQUEST_MS=500    requests at least this slow go to slow_log.txt
+    BLOG_PROFILE=1              sample the stacks of slow requests into BLOG_PROFILE_DIR
+
+Every worker process keeps its own numbers, so under gunicorn with several
+workers a scrape reports the worker that answered it.
+"""
+import bisect
+import collections
+import functools
+import hmac
+import itertools
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from activity_log import ActivityLog
+
+ENABLED = os.environ.get('BLOG_METRICS', '1') != '0'
+SQL_ENABLED = ENABLED and os.environ.get('BLOG_SQL_METRICS', '1') != '0'
+SLOW_QUERY_SECONDS = float(os.environ.get('BLOG_SLOW_QUERY_MS', 100)) / 1000
+SLOW_REQUEST_SECONDS = float(os.environ.get('BLOG_SLOW_REQUEST_MS', 500)) / 1000
+PROFILE = ENABLED and os.environ.get('BLOG_PROFILE', '0') == '1'
+SCRAPE_TOKEN = os.environ.get('BLOG_METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+slow_log = ActivityLog('slow_log.txt', policy=os.environ.get('BLOG_LOG_POLICY', 'drop'))
+
+
+def scrape_allowed(authorization):
+    """True if an Authorization header carries the configured scrape token."""
+    if not SCRAPE_TOKEN:
+        return False
+    return hmac.compare_digest((authorization or '').encode(), f'Bearer {SCRAPE_TOKEN}'.encode())
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        # re-entrant: a cursor collected while this thread holds it reports its rows here
+        self._lock = threading.RLock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{format_labels(self.labels, label_values)} {value}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # per label set: a count per bucket, one for +Inf, then the sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def lines(self):
+        with self._lock:
+            series = [(label_values, list(counts)) for label_values, counts in self._series.items()]
+        for label_values, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                le = 'le="%s"' % bound
+                yield f'{self.name}_bucket{format_labels(self.labels, label_values, le)} {total}'
+            yield f'{self.name}_sum{format_labels(self.labels, label_values)} {counts[-1]}'
+            yield f'{self.name}_count{format_labels(self.labels, label_values)} {total}'
+
+
+class Collected:
+    """A counter or gauge read from somebody else's stats when scraped."""
+
+    def __init__(self, name, help, kind, labels, read):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.read = read
+
+    def lines(self):
+        for label_values, value in self.read().items():
+            yield f'{self.name}{format_labels(self.labels, label_values)} {value}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collect(self, name, help, kind, labels, read):
+        return self.add(Collected(name, help, kind, labels, read))
+
+    def render(self):
+        out = []
+        for metric in self.metrics:
+            out.append(f'# HELP {metric.name} {metric.help}')
+            out.append(f'# TYPE {metric.name} {metric.kind}')
+            out.extend(metric.lines())
+        return '\n'.join(out) + '\n'
+
+
+registry = Registry()
+request_seconds = registry.histogram('blog_request_duration_seconds', 'Time spent in Flask views.', ('route', 'method', 'status'))
+query_seconds = registry.histogram('blog_sql_query_duration_seconds', 'Time to execute an SQL statement up to its first row.',
+                                   ('query',), QUERY_BUCKETS)
+query_rows = registry.counter('blog_sql_rows_total', 'Rows fetched by or changed by SQL statements.', ('query',))
+slow_queries = registry.counter('blog_sql_slow_queries_total', 'Statements slower than BLOG_SLOW_QUERY_MS.')
+render_seconds = registry.histogram('blog_render_duration_seconds', 'Markdown rendering time per post.')
+
+
+# IN lists of any length share one label
+IN_LIST_RE = re.compile(r'\?(\s*,\s*\?)+')
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    return IN_LIST_RE.sub('?...', ' '.join(sql.split()))[:200]
+
+
+def record_query(sql, elapsed, rows):
+    query = normalize_sql(sql)
+    query_seconds.observe(elapsed, query)
+    if rows > 0:
+        query_rows.inc(query, amount=rows)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        slow_queries.inc()
+        slow_log.write(kind='query', sql=query, ms=round(elapsed * 1000, 3))
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Times each statement and counts the rows it returns or changes.
+
+    Rows of a SELECT are counted as they are fetched and reported when the
+    cursor runs its next statement or goes away.
+    """
+
+    _query = None
+    _rows = 0
+
+    def _finish(self):
+        if self._query is not None and self._rows:
+            query_rows.inc(normalize_sql(self._query), amount=self._rows)
+        self._query, self._rows = None, 0
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start, self.rowcount)
+            self._query = sql
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start, self.rowcount)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._rows += len(rows)
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self._rows += 1
+        return row
+
+    def __del__(self):
+        self._finish()
+
+
+class TracedConnection(sqlite3.Connection):
+    # Connection.execute() builds a plain cursor in C, so route it through ours
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# what sqlite3.connect(factory=...) should build
+connection_factory = TracedConnection if SQL_ENABLED else sqlite3.Connection
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads serving requests, every `interval` seconds.
+
+    The samples of a request slower than `threshold` are written to
+    `directory` as collapsed stacks ("outer;inner count" lines), the input
+    flamegraph.pl, speedscope and inferno take. The sampler thread is
+    started lazily in each process, so it survives a pre-fork server.
+    """
+
+    def __init__(self, directory, interval=0.005, threshold=SLOW_REQUEST_SECONDS):
+        self.directory = directory
+        self.interval = interval
+        self.threshold = threshold
+        self._active = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._sequence = itertools.count(1)
+
+    def _ensure_sampler(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._active = {}
+                threading.Thread(target=self._run, name='sampling-profiler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, samples in list(self._active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    samples[';'.join(reversed(stack))] += 1
+
+    def begin(self):
+        self._ensure_sampler()
+        self._active[threading.get_ident()] = collections.Counter()
+
+    def end(self, label, elapsed):
+        """Stop sampling this thread; returns the file written, if the request was slow."""
+        samples = self._active.pop(threading.get_ident(), None)
+        if not samples or elapsed < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self._sequence)}-{re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_')}.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in samples.items())
+        return path
+
+
+profiler = SamplingProfiler(os.environ.get('BLOG_PROFILE_DIR', 'profiles'),
+                            float(os.environ.get('BLOG_PROFILE_INTERVAL_MS', 5)) / 1000) if PROFILE else None
+
+
+def start_request():
+    # stored on the request context by the caller; see routes.py
+    if profiler:
+        profiler.begin()
+    return time.perf_counter()
+
+
+def finish_request(started, route, method, status):
+    elapsed = time.perf_counter() - started
+    request_seconds.observe(elapsed, route, method, status)
+    profile = profiler.end(f'{method} {route}', elapsed) if profiler else None
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        slow_log.write(kind='request', route=route, method=method, status=status, ms=round(elapsed * 1000, 3), profile=profile)
+
+
+def watch_pools(pools):
+    """Expose ConnectionPool.stats for {name: pool}."""
+    registry.collect('blog_pool_checkouts_total', 'Connections handed out by the pool.', 'counter', ('pool',),
+                     lambda: {(name,): pool.stats['checkouts'] for name, pool in pools.items()})
+    registry.collect('blog_pool_waits_total', 'Checkouts that had to wait for a free connection.', 'counter', ('pool',),
+                     lambda: {(name,): pool.stats['waits'] for name, pool in pools.items()})
+    registry.collect('blog_pool_timeouts_total', 'Checkouts that gave up waiting.', 'counter', ('pool',),
+                     lambda: {(name,): pool.stats['timeouts'] for name, pool in pools.items()})
+    registry.collect('blog_pool_connections', 'Open connections by state.', 'gauge', ('pool', 'state'),
+                     lambda: {key: value for name, pool in pools.items() for key, value in
+                              (((name, 'open'), pool.open_count()), ((name, 'idle'), pool.idle_count()))})
+
+
+def watch_cache(cache):
+    registry.collect('blog_cache_requests_total', 'Response cache lookups.', 'counter', ('result',),
+                     lambda: {(result,): cache.info()[key] for result, key in (('hit', 'hits'), ('miss', 'misses'))})
+    registry.collect('blog_cache_evictions_total', 'Entries evicted from the response cache.', 'counter', (),
+                     lambda: {(): cache.info()['evictions']})
+    registry.collect('blog_cache_bytes', 'Size of the cached responses.', 'gauge', (),
+                     lambda: {(): cache.info()['bytes']})
+
+
+def watch_logs(logs):
+    """Expose ActivityLog.stats for {name: log}."""
+    registry.collect('blog_log_records_total', 'Log records by outcome.', 'counter', ('log', 'result'),
+                     lambda: {(name, result): log.stats[result] for name, log in logs.items() for result in ('written', 'dropped')})
+    registry.collect('blog_log_write_seconds_total', 'Time the log writer threads spent writing batches.', 'counter', ('log',),
+                     lambda: {(name,): log.stats['write_seconds'] for name, log in logs.items()})
+
+
+def watch_writer(writer):
+    """Expose GroupCommitter.stats and queue depth."""
+    registry.collect('blog_write_items_total', 'Writes committed by the group committer, by outcome.', 'counter', ('result',),
+                     lambda: {('committed',): writer.stats['items'], ('rejected',): writer.stats['rejected']})
+    registry.collect('blog_write_batches_total', 'Group commits.', 'counter', (),
+                     lambda: {(): writer.stats['batches']})
+    registry.collect('blog_write_commit_seconds_total', 'Time the writer thread spent committing groups.', 'counter', (),
+                     lambda: {(): writer.stats['commit_seconds']})
+    registry.collect('blog_write_queue', 'Writes waiting for the writer thread.', 'gauge', (),
+                     lambda: {(): writer.pending()})
+
+
+def watch_views(counter):
+    """Expose ViewCounter.stats."""
+    registry.collect('blog_views_flushed_total', 'Post views written to post_views.', 'counter', (),
+                     lambda: {(): counter.stats['flushed']})
+    registry.collect('blog_view_flushes_total', 'View counter flushes, by outcome.', 'counter', ('result',),
+                     lambda: {('ok',): counter.stats['flushes'], ('failed',): counter.stats['failed']})
+    registry.collect('blog_view_flush_seconds_total', 'Time the view counter thread spent flushing.', 'counter', (),
+                     lambda: {(): counter.stats['flush_seconds']})
@@ -0,0 +1,102 @@
+"""Versioned schema changes for User.db.
+
+The version a file is at lives in PRAGMA user_version. Each migration is
+applied once, in order, in its own transaction together with the version
+bump, so a failed migration leaves the file at the previous version.
+"""
+from models import BlogError
+
+
+class MigrationError(BlogError):
+    pass
+
+
+UNIQUE_USER_COLUMNS = ('username', 'hashed_username', 'email', 'phone_number')
+
+
+def check_unique_users(db):
+    # CREATE UNIQUE INDEX would fail on existing duplicates; say which ones
+    for column in UNIQUE_USER_COLUMNS:
+        duplicates = [row[0] for row in db.execute(f"SELECT {column} FROM users GROUP BY {column} HAVING COUNT(*) > 1 LIMIT 10")]
+        if duplicates:
+            raise MigrationError(f"users.{column} has duplicate values, resolve them before migrating: {', '.join(map(str, duplicates))}")
+
+
+# (check run before the transaction or None, statements)
+USER_MIGRATIONS = [
+    # 1: the tables as Admin.ensure_admin_table first created them
+    (None, (
+        """CREATE TABLE IF NOT EXISTS admin_users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            hashed_username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            phone_number TEXT NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS pending_users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            hashed_username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            phone_number TEXT NOT NULL)""",
+    )),
+    # 2: every login, approval and password reset looks users up by one of these
+    (check_unique_users, tuple(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_users_{column} ON users ({column})" for column in UNIQUE_USER_COLUMNS
+    ) + (
+        "CREATE INDEX IF NOT EXISTS idx_pending_users_username ON pending_users (username)",
+    )),
+    # 3: totals for the admin console kept by triggers, and email search on pending users
+    (None, (
+        "CREATE INDEX IF NOT EXISTS idx_pending_users_email ON pending_users (email)",
+        """CREATE TABLE IF NOT EXISTS user_counts (
+            name TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0)""",
+        "INSERT OR REPLACE INTO user_counts (name, total) SELECT 'users', COUNT(*) FROM users",
+        "INSERT OR REPLACE INTO user_counts (name, total) SELECT 'pending_users', COUNT(*) FROM pending_users",
+    ) + tuple(
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_count_{event.lower()} AFTER {event} ON {table} BEGIN
+            UPDATE user_counts SET total = total {sign} 1 WHERE name = '{table}';
+        END"""
+        for table in ('users', 'pending_users') for event, sign in (('INSERT', '+'), ('DELETE', '-'))
+    )),
+]
+
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def require_current(db, migrations=USER_MIGRATIONS):
+    """Raise MigrationError unless every migration has been applied to the file."""
+    version = schema_version(db)
+    if version < len(migrations):
+        raise MigrationError(f"User.db is at schema version {version} of {len(migrations)}, run `flask migrate`")
+
+
+def migrate(db, migrations=USER_MIGRATIONS, target=None):
+    """Bring the file up to `target` (default: latest); returns the versions applied."""
+    target = len(migrations) if target is None else target
+    applied = []
+    for version in range(schema_version(db) + 1, target + 1):
+        check, statements = migrations[version - 1]
+        if check:
+            check(db)
+        db.commit()
+        try:
+            db.execute("BEGIN")
+            for statement in statements:
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append(version)
+    return applied
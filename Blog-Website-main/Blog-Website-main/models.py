@@ -0,0 +1,102 @@
+class BlogError(Exception):
+    """Base error raised by the data layer; routes turn it into a response."""
+    status = 500
+
+    def __init__(self, msg="Internal server error"):
+        super().__init__(msg)
+        self.msg = msg
+
+
+class BadRequest(BlogError):
+    status = 400
+
+
+class NotFound(BlogError):
+    status = 404
+
+
+class Unavailable(BlogError):
+    status = 503
+
+
+class Post:
+    __slots__ = ('post_id', 'post_title', 'post_content', 'post_excerpt', 'post_author', 'tags', 'timestamp', 'post_markdown')
+
+    def __init__(self, post_id, post_title, post_content, post_author, tags, timestamp, post_excerpt=None, post_markdown=None):
+        self.post_id = post_id
+        self.post_title = post_title
+        self.post_content = post_content
+        self.post_excerpt = post_excerpt
+        self.post_author = post_author
+        self.tags = tags
+        self.timestamp = timestamp
+        self.post_markdown = post_markdown
+
+    @classmethod
+    def from_row(cls, row, post_id):
+        # list queries may leave out the body or the Markdown source
+        columns = row.keys()
+        return cls(post_id, row['post_title'], row['post_content'] if 'post_content' in columns else None,
+                   row['post_author'], row['tags'], row['timestamp'],
+                   row['post_excerpt'] if 'post_excerpt' in columns else None,
+                   row['post_markdown'] if 'post_markdown' in columns else None)
+
+    def to_dict(self):
+        # the Markdown source stays server side; excerpt-only list queries leave out the body
+        data = {name: getattr(self, name) for name in self.__slots__ if name != 'post_markdown'}
+        if self.post_content is None:
+            del data['post_content']
+        return data
+
+
+class PostPage:
+    __slots__ = ('posts', 'next_cursor')
+
+    def __init__(self, posts, next_cursor=None):
+        self.posts = posts
+        self.next_cursor = next_cursor
+
+
+class UserPage:
+    __slots__ = ('users', 'next_cursor')
+
+    def __init__(self, users, next_cursor=None):
+        self.users = users
+        self.next_cursor = next_cursor
+
+
+class SearchHit:
+    __slots__ = ('post_id', 'post_title', 'post_author', 'tags', 'timestamp', 'snippet', 'rank')
+
+    def __init__(self, post_id, post_title, post_author, tags, timestamp, snippet, rank):
+        self.post_id = post_id
+        self.post_title = post_title
+        self.post_author = post_author
+        self.tags = tags
+        self.timestamp = timestamp
+        self.snippet = snippet
+        self.rank = rank
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class UserRecord:
+    __slots__ = ('user_id', 'username', 'hashed_username', 'password', 'email', 'age', 'phone_number')
+
+    def __init__(self, user_id, username, hashed_username, password, email, age, phone_number):
+        self.user_id = user_id
+        self.username = username
+        self.hashed_username = hashed_username
+        self.password = password
+        self.email = email
+        self.age = age
+        self.phone_number = phone_number
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*(row[name] for name in cls.__slots__))
+
+    def to_dict(self):
+        # the password hash never leaves the server
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'password'}
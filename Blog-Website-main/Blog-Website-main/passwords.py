@@ -0,0 +1,115 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from models import Unavailable
+
+# log2 of the scrypt work factor; each step doubles CPU time and memory per hash
+DEFAULT_COST = 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def is_legacy(encoded):
+    # hashes stored before the KDF are bare unsalted sha256 hex digests
+    return '$' not in encoded
+
+
+class PasswordHasher:
+    """Salted scrypt hashing run on a small dedicated thread pool.
+
+    hashlib.scrypt releases the GIL, so hashing on worker threads keeps
+    request threads free, while `workers` caps how many cores a login flood
+    can burn. At most `max_pending` hashes may be queued or running; callers
+    beyond that wait up to `wait` seconds and then get a 503 instead of
+    piling up behind the pool.
+
+    Stored format: scrypt$<cost>$<r>$<p>$<salt>$<key>. Verification reads the
+    parameters from the hash, so raising the cost only affects new hashes and
+    older ones report needs_rehash().
+    """
+
+    def __init__(self, cost=DEFAULT_COST, workers=None, max_pending=64, wait=2.0):
+        self.cost = cost
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.wait = wait
+        self.max_pending = max_pending
+        self._dummy = None
+        self.after_fork()
+
+    def after_fork(self):
+        # worker threads do not survive a fork, so a child needs its own pool
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        self._pid = os.getpid()
+
+    @classmethod
+    def from_env(cls):
+        return cls(cost=int(os.environ.get('BLOG_PASSWORD_COST', DEFAULT_COST)),
+                   workers=int(os.environ.get('BLOG_HASH_WORKERS', 0)) or None,
+                   max_pending=int(os.environ.get('BLOG_HASH_QUEUE', 64)))
+
+    def _run(self, func, *args):
+        if self._pid != os.getpid():
+            self.after_fork()
+        if not self._slots.acquire(timeout=self.wait):
+            raise Unavailable("Too many login attempts, try again shortly")
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _derive(password, salt, cost, r, p):
+        n = 1 << cost
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES, maxmem=256 * r * n + 1024 * 1024)
+
+    def _hash(self, password):
+        salt = os.urandom(SALT_BYTES)
+        key = self._derive(password, salt, self.cost, SCRYPT_R, SCRYPT_P)
+        return f'scrypt${self.cost}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(key)}'
+
+    def _verify(self, password, encoded):
+        if is_legacy(encoded):
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), encoded)
+        try:
+            scheme, cost, r, p, salt, key = encoded.split('$')
+            if scheme != 'scrypt':
+                return False
+            derived = self._derive(password, base64.b64decode(salt), int(cost), int(r), int(p))
+        except ValueError:
+            return False
+        return hmac.compare_digest(derived, base64.b64decode(key))
+
+    def hash(self, password):
+        return self._run(self._hash, password)
+
+    def verify(self, password, encoded):
+        if is_legacy(encoded):
+            # a single sha256 is cheaper than the hand-off to the pool
+            return self._verify(password, encoded)
+        return self._run(self._verify, password, encoded)
+
+    def dummy_hash(self):
+        """A valid hash of a random password, verified against for unknown users."""
+        if self._dummy is None:
+            self._dummy = self._hash(_b64(os.urandom(SALT_BYTES)))
+        return self._dummy
+
+    def needs_rehash(self, encoded):
+        if is_legacy(encoded):
+            return True
+        parts = encoded.split('$')
+        return parts[0] != 'scrypt' or int(parts[1]) < self.cost
+
+
+password_hasher = PasswordHasher.from_env()
@@ -0,0 +1,83 @@
+import html
+import re
+import sqlite3
+import time
+
+from metrics import render_seconds
+
+# bump whenever the renderer settings below change; `flask rerender-posts`
+# re-renders every stored post whose render_version is older
+RENDERER_VERSION = 1
+EXCERPT_LENGTH = 280
+
+_markdown = None
+
+
+def markdown(source):
+    # mistune is only needed once somebody publishes, so it is imported then;
+    # the parser is built once per process and is safe to share between threads
+    global _markdown
+    if _markdown is None:
+        import mistune
+        _markdown = mistune.create_markdown()
+    return _markdown(source)
+
+
+# mistune escapes raw HTML and every < in text, so a tag is always a whole <...>
+TAG_RE = re.compile(r'<!--.*?-->|<[^>]*>', re.S)
+
+
+def strip_html(body):
+    """Plain text of a rendered post body."""
+    return ' '.join(html.unescape(TAG_RE.sub(' ', body)).split())
+
+
+def make_excerpt(html, length=EXCERPT_LENGTH):
+    text = strip_html(html)
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0] + '...'
+
+
+def render(source):
+    """Return (html, excerpt) for a post's Markdown source."""
+    started = time.perf_counter()
+    html = markdown(source)
+    excerpt = make_excerpt(html)
+    render_seconds.observe(time.perf_counter() - started)
+    return html, excerpt
+
+
+def rerender_shard(path, batch_size=500):
+    """Bring every post in one monthly file up to RENDERER_VERSION.
+
+    Runs in a worker process, so it opens its own connection. Posts stored
+    before the Markdown source was kept only get their excerpt filled in.
+    Returns (rendered, excerpted) counts.
+    """
+    db = sqlite3.connect(path, timeout=30)
+    db.row_factory = sqlite3.Row
+    rendered = excerpted = 0
+    try:
+        last_id = 0
+        while True:
+            batch = db.execute("""SELECT post_id, post_content, post_markdown FROM posts
+                                  WHERE post_id > ? AND render_version < ? ORDER BY post_id LIMIT ?""",
+                               (last_id, RENDERER_VERSION, batch_size)).fetchall()
+            if not batch:
+                break
+            for post in batch:
+                if post['post_markdown'] is not None:
+                    html, excerpt = render(post['post_markdown'])
+                    db.execute("UPDATE posts SET post_content = ?, post_excerpt = ?, render_version = ? WHERE post_id = ?",
+                               (html, excerpt, RENDERER_VERSION, post['post_id']))
+                    rendered += 1
+                else:
+                    db.execute("UPDATE posts SET post_excerpt = ?, render_version = ? WHERE post_id = ?",
+                               (make_excerpt(post['post_content']), RENDERER_VERSION, post['post_id']))
+                    excerpted += 1
+            db.commit()
+            last_id = batch[-1]['post_id']
+    finally:
+        db.close()
+    return rendered, excerpted
@@ -1,19 +1,89 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-from methods import User, POSTS, Admin, close_db
-import json
+from flask import (Blueprint, current_app, render_template, request, redirect, url_for, flash, session, jsonify, Response,
+                   stream_with_context, make_response, send_from_directory, abort, g)
+from werkzeug.local import LocalProxy
+from methods import (User, POSTS, Admin, get_db, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, ADMIN_PAGE_SIZE,
+                     post_connections, archive_connections)
+from models import BlogError
+from shards import encode_cursor, canonical_id, current_month, shard_path, index_path, index_connections
+from cache import ResponseCache, CachedResponse
+from activity_log import activity_log, admin_log
+import metrics
 from functools import wraps
+import hashlib
+import os
+import time
+import datetime
+import email.utils
+import threading
+import click
 
-app = Flask(__name__)
-app.teardown_appcontext(close_db)
-app.secret_key = 'secret'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# every view, filter and command, registered on the app by create_app(). Commands
+# stay top level (`flask migrate`, not `flask blog migrate`).
+bp = Blueprint('blog', __name__, cli_group=None)
+
+
+def lazy(build):
+    """A proxy for build()'s result, built on first use instead of at import, once per process."""
+    lock = threading.Lock()
+    built = []
+
+    def get():
+        if not built:
+            with lock:
+                if not built:
+                    built.append(build())
+        return built[0]
+    return LocalProxy(get)
+
+
+def load_asset_manifest():
+    # fingerprinted names written by `flask build-assets`
+    from assets import AssetManifest
+    return AssetManifest(current_app.static_folder)
 
-user = User()
-posts = POSTS()
 
-# Initialize Admin class within app context
-admin = Admin(app)
+asset_manifest = lazy(load_asset_manifest)
+
+# BLOG_CACHE=file:/path/cache.db shares cached pages between worker processes
+response_cache = lazy(lambda: ResponseCache.from_url(os.environ.get('BLOG_CACHE', 'memory')))
+
+user = User()
+posts = lazy(lambda: POSTS(cache=response_cache._get_current_object()))
+admin = Admin()
+
+# set when the server starts a graceful shutdown; /readyz then fails so load
+# balancers stop routing here while in-flight requests finish
+draining = threading.Event()
+
+if metrics.ENABLED:
+    metrics.watch_pools({'posts': post_connections, 'archive': archive_connections, 'index': index_connections})
+    metrics.watch_cache(response_cache)
+    metrics.watch_logs({'activity': activity_log, 'admin': admin_log, 'slow': metrics.slow_log})
+    metrics.watch_writer(LocalProxy(lambda: posts.writer))
+    metrics.watch_views(LocalProxy(lambda: posts.views))
+
+    def route_label():
+        rule = request.url_rule
+        return rule.rule if rule else 'unmatched'
+
+    @bp.before_app_request
+    def start_timer():
+        g.request_started = metrics.start_request()
+
+    @bp.after_app_request
+    def record_request(response):
+        # streamed bodies are still being written at this point and are not counted
+        started = g.pop('request_started', None)
+        if started is not None:
+            metrics.finish_request(started, route_label(), request.method, response.status_code)
+        return response
+
+    @bp.teardown_app_request
+    def record_failure(exc):
+        # only requests that raised past the error handlers are still unrecorded here
+        started = g.pop('request_started', None)
+        if started is not None:
+            metrics.finish_request(started, route_label(), request.method, 500)
 
 # Example decorator to check if user is logged in
 def login_required(func):
@@ -21,78 +91,154 @@ def login_required(func):
     def wrapper(*args, **kwargs):
         if 'credentials' not in session:
             flash('Please login first', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('blog.login'))
+        return func(*args, **kwargs)
+    return wrapper
+
+def admin_api(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if 'admin' not in session:
+            return jsonify({"status": 401, "msg": "Admin access required"}), 401
         return func(*args, **kwargs)
     return wrapper
 
-@app.route('/')
+@bp.app_template_global()
+def asset_url(name):
+    built = asset_manifest.lookup(name)
+    if built is None:
+        return url_for('static', filename=name)
+    return url_for('blog.asset', filename=built)
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    # the name changes whenever the content does, so browsers may keep it forever
+    found = asset_manifest.variant(filename, request.accept_encodings.quality)
+    if found is None:
+        abort(404)
+    path, encoding, mimetype = found
+    response = send_from_directory(asset_manifest.dist, path, mimetype=mimetype, max_age=365 * 24 * 3600)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    return response
+
+@bp.app_errorhandler(BlogError)
+def blog_error(e):
+    return jsonify({"status": e.status, "msg": e.msg}), e.status
+
+def cached_response(key, build):
+    """Serve a public page from the response cache, building it on a miss.
+
+    Requests with pending flash messages bypass the cache since those are
+    rendered into the page for that session only.
+    """
+    if key is None or '_flashes' in session:
+        return build()
+    entry = response_cache.get(key)
+    if entry is None:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+        body = response.get_data()
+        entry = CachedResponse(body, response.mimetype, hashlib.sha1(body).hexdigest(), int(time.time()))
+        response_cache.set(key, entry)
+    response = current_app.response_class(entry.body, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def page_response(page):
+    return jsonify({"status": 200, "msg": "Posts fetched successfully", "data": page.posts, "next_cursor": page.next_cursor})
+
+def stream_posts(rows, limit):
+    # writes the same document shape as the paged response, one post at a time
+    yield '{"status": 200, "msg": "Posts fetched successfully", "data": ['
+    count, last = 0, None
+    for post in rows:
+        yield (',' if count else '') + current_app.json.dumps(post)
+        count, last = count + 1, post
+    next_cursor = encode_cursor(last) if limit and count == limit else None
+    yield '], "next_cursor": %s}' % current_app.json.dumps(next_cursor)
+
+def stream_response(post_author=None):
+    limit = request.args.get('limit', 0, type=int)
+    try:
+        rows = posts.iter_posts(post_author, request.args.get('cursor'), limit or None, request.args.get('body', 'full'))
+    except ValueError as e:
+        return jsonify({"status": 400, "msg": str(e)}), 400
+    return Response(stream_with_context(stream_posts(rows, limit)), mimetype='application/json')
+
+@bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     try:
     
         if 'credentials' in session:
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('blog.dashboard'))
         else:
             if request.method == 'POST':
                 username = request.form['username']
                 password = request.form['password']
-                response = user.login(username, password)
-                result = json.loads(response)
-                if result['status'] == 200:
+                try:
+                    user.login(username, password)
+                except BlogError as e:
+                    flash(e.msg, 'danger')
+                else:
                     session['credentials'] = username
                     flash('You were successfully logged in', 'success')
-                    return redirect(url_for('dashboard'))
-                else:
-                    flash(result['msg'], 'danger')
+                    return redirect(url_for('blog.dashboard'))
         return render_template('login_registration.html')
     except Exception as e:
         flash('Something went Wrong','danger')
         return redirect('/')
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register():
     username = request.form['username']
     password = request.form['password']
     email = request.form['email']
     age = request.form['age']
     phone_number = request.form['phone_number']
-    response = user.register(username, password, email, age, phone_number)
-    result = json.loads(response)
-    if result['status'] == 200:
-        flash('You were successfully registered', 'success')
-        return redirect(url_for('login'))
+    try:
+        user.register(username, password, email, age, phone_number)
+    except BlogError as e:
+        flash(e.msg, 'danger')
     else:
-        flash(result['msg'], 'danger')
-    return redirect(url_for('login'))
+        flash('You were successfully registered', 'success')
+    return redirect(url_for('blog.login'))
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 @login_required
 def dashboard():
     username = session['credentials'] 
     
     return render_template('profile.html', username=username)
 
-@app.route('/get_user_post', methods=['POST'])
+@bp.route('/get_user_post', methods=['POST'])
 def user_post():
     username = session['credentials']
-    get_posts = posts.get_user_posts(username)
-    data = json.loads(get_posts)
-    # print(data)
-    return jsonify(data)
+    if request.args.get('stream'):
+        return stream_response(username)
+    page = posts.get_user_posts(username, request.args.get('cursor'), request.args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+                                request.args.get('body', 'full'))
+    return page_response(page)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
     flash('You have been logged out', 'info')
-    return redirect(url_for('index'))
+    return redirect(url_for('blog.index'))
 
 
 
-@app.route('/create_post', methods=['GET', 'POST'])
+@bp.route('/create_post', methods=['GET', 'POST'])
 @login_required
 def create_post():
     if request.method == 'POST':
@@ -100,33 +246,154 @@ def create_post():
         post_content = request.form['post_content']
         post_author = session['credentials']
         tags = request.form['tags']
-        response = posts.create_post(post_title, post_content, post_author, tags)
-        result = json.loads(response)
-        if result['status'] == 200:
-            flash(result['msg'], 'success')
-            return redirect(url_for('dashboard'))
+        try:
+            posts.create_post(post_title, post_content, post_author, tags)
+        except BlogError as e:
+            flash(e.msg, 'danger')
+            # a 503 when the post writer is backed up tells clients and load balancers to retry
+            return render_template('create_post.html'), e.status
         else:
-            flash(result['msg'], 'danger')
+            flash('Post created successfully', 'success')
+            return redirect(url_for('blog.dashboard'))
     return render_template('create_post.html')
 
-@app.route('/get_posts')
+@bp.route('/get_posts')
 def get_posts():
-    response = posts.get_posts()
-    data = json.loads(response)
-    if data['status'] == 200:
-        return jsonify(data)
-    else:
-        return jsonify({"error": data['msg']})
+    if request.args.get('stream'):
+        return stream_response()
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    body = request.args.get('body', 'full')
+    return cached_response(response_cache.list_key(cursor, f'{limit}:{body}'),
+                           lambda: page_response(posts.get_posts(cursor, limit, body)))
     
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    if not q:
+        return jsonify({"status": 400, "msg": "Search query required"}), 400
+    hits = posts.search.search(q, limit + 1, offset)
+    next_offset = offset + limit if len(hits) > limit else None
+    return jsonify({"status": 200, "msg": "Search results", "data": hits[:limit], "next_offset": next_offset})
+
+@bp.route('/posts')
+def tagged_posts():
+    tags = request.args.getlist('tag')
+    if not tags:
+        return jsonify({"status": 400, "msg": "At least one tag is required"}), 400
+    match_all = request.args.get('mode', 'or').lower() == 'and'
+    page = posts.get_tagged_posts(tags, match_all, request.args.get('cursor'), request.args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+                                  request.args.get('body', 'full'))
+    return page_response(page)
+
+@bp.route('/tags')
+def tag_cloud():
+    return jsonify({"status": 200, "msg": "Tags fetched successfully", "data": posts.tags.counts(request.args.get('limit', type=int))})
+
 # add a route that allow us to share post using post id
-@app.route('/post/<postid>')
+@bp.route('/post/<postid>')
 def share(postid):
-    response=posts.get_post_by_id(postid)
-    data=json.loads(response)
-    # print(response.status)
-    return render_template('post.html',post=jsonify(data))
-
-@app.route('/delete_post',methods=['POST'])
+    def render():
+        try:
+            post = posts.get_post_by_id(postid)
+        except BlogError as e:
+            return render_template('post.html', post=None), e.status
+        return render_template('post.html', post=post)
+    try:
+        post_id = canonical_id(postid)
+    except ValueError:
+        return cached_response(None, render)
+    response = make_response(cached_response(response_cache.post_key(post_id), render))
+    if response.status_code in (200, 304):
+        # counted in memory and written in the background, see counters.ViewCounter
+        posts.views.hit(post_id)
+    return response
+
+@bp.route('/post/<postid>/views')
+def post_views(postid):
+    try:
+        post_id = canonical_id(postid)
+    except ValueError:
+        return jsonify({"status": 404, "msg": "Post not found"}), 404
+    return jsonify({"status": 200, "msg": "Views fetched successfully", "data": {"post_id": post_id, "views": posts.views.count(post_id)}})
+
+@bp.route('/popular')
+def popular():
+    """The most viewed posts, recent views weighing more; refreshed every few seconds."""
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    data = [dict(post.to_dict(), views=views, score=round(score, 3)) for post, views, score in posts.get_popular(limit)]
+    return jsonify({"status": 200, "msg": "Popular posts fetched successfully", "data": data})
+
+@bp.route('/healthz')
+def healthz():
+    # liveness only: the process is up and serving requests
+    return jsonify({"status": 200, "msg": "ok"})
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    if not metrics.ENABLED:
+        abort(404)
+    # route, SQL and pool numbers describe the deployment; scrapers authenticate with BLOG_METRICS_TOKEN
+    if 'admin' not in session and not metrics.scrape_allowed(request.headers.get('Authorization')):
+        return jsonify({"status": 401, "msg": "Admin access or a scrape token required"}), 401
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@bp.route('/readyz')
+def readyz():
+    """Readiness: not draining, and every database a request may need can be opened and queried."""
+    if draining.is_set():
+        return jsonify({"status": 503, "msg": "draining"}), 503
+    def check_posts():
+        with posts.connect_to_db() as db:
+            db.execute("SELECT 1 FROM posts LIMIT 1")
+    def check_index():
+        with posts.search.pool.connection(index_path()) as db:
+            db.execute("SELECT 1 FROM shards LIMIT 1")
+    checks = {}
+    for name, check in (('users', lambda: get_db().execute("SELECT 1 FROM users LIMIT 1")),
+                        ('posts', check_posts), ('index', check_index)):
+        try:
+            check()
+            checks[name] = "ok"
+        except Exception as e:
+            checks[name] = str(e)
+    ready = all(result == "ok" for result in checks.values())
+    status = 200 if ready else 503
+    return jsonify({"status": status, "msg": "ready" if ready else "not ready", "checks": checks}), status
+
+# stored timestamps are SQLite CURRENT_TIMESTAMP values, which are UTC
+def parse_timestamp(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+
+@bp.app_template_filter('rfc822')
+def rfc822(value):
+    return email.utils.format_datetime(parse_timestamp(value))
+
+@bp.app_template_filter('rfc3339')
+def rfc3339(value):
+    return parse_timestamp(value).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+@bp.route('/feed.rss', defaults={'fmt': 'rss'})
+@bp.route('/feed.atom', defaults={'fmt': 'atom'})
+def feed(fmt):
+    """RSS 2.0 / Atom of the newest posts, or of one ?author= or ?tag=."""
+    author = request.args.get('author')
+    tag = request.args.get('tag')
+    def build():
+        items = posts.get_feed(author, tag, request.args.get('limit', DEFAULT_PAGE_SIZE, type=int))
+        title = f"Posts by {author}" if author else f"Posts tagged {tag}" if tag else "Latest posts"
+        mimetype = 'application/rss+xml' if fmt == 'rss' else 'application/atom+xml'
+        return Response(render_template(f'feed.{fmt}.xml', posts=items, title=title), mimetype=mimetype)
+    return cached_response(response_cache.list_key(None, f'{fmt}:{author}:{tag}:{request.args.get("limit")}'), build)
+
+@bp.route('/cache_stats')
+@admin_api
+def cache_stats():
+    return jsonify({"status": 200, "msg": "Cache stats", "data": response_cache.info()})
+
+@bp.route('/delete_post',methods=['POST'])
 @login_required
 def delete_post():
     if request.method=="POST":
@@ -134,17 +401,15 @@ def delete_post():
         post_id=data.get('postid')
         author=data.get('author')
         if session['credentials']==author:
-            response=posts.delete_post(post_id)
-            result=json.loads(response)
-            # print(result['msg'])
-            if result['status']==200:
-                flash(result['msg'],'success')
-                return result
-            else:
-                flash(result['msg'],'danger')
-                return result
+            try:
+                posts.delete_post(post_id)
+            except BlogError as e:
+                flash(e.msg,'danger')
+                return jsonify({"status": e.status, "msg": e.msg})
+            flash('Post deleted successfully','success')
+            return jsonify({"status": 200, "msg": "Post deleted successfully"})
         flash('Login First','danger')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('blog.dashboard'))
 
     
 
@@ -152,54 +417,62 @@ def delete_post():
     
 
 # Admin routes
-@app.route('/admin_login', methods=['GET', 'POST'])
+@bp.route('/admin_login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if admin.authenticate(username, password)!="":
+        if admin.authenticate(username, password):
             session['admin'] = username
             flash('Admin login successful', 'success')
-            return redirect(url_for('admin_'))
+            return redirect(url_for('blog.admin_'))
         else:
 
             flash(f'Invalid admin credentials {password}', 'danger')
     return render_template('admin_login.html')
 
-@app.route('/admin')
+@bp.route('/admin')
 def admin_():
     if 'admin' not in session:
         flash('Admin access required', 'danger')
-        return redirect(url_for('admin_login'))
-    
-    get_users = admin.get_registered_users()
-    pending_users = admin.get_pending_users()
-    
-
-
-    # Convert rows to dictionaries
-    get_users_list = [dict(row) for row in get_users]
-    pending_users_list = [dict(row) for row in pending_users]
+        return redirect(url_for('blog.admin_login'))
     
-    return render_template('admin.html', users=get_users_list, pending_users=pending_users_list)
-
-@app.route('/approve_user', methods=['POST'])
+    # rows are fetched page by page from /admin/api/<table> by the page itself
+    return render_template('admin.html', counts=admin.user_counts())
+
+@bp.route('/admin/api/counts')
+@admin_api
+def admin_counts():
+    return jsonify({"status": 200, "msg": "Counts fetched successfully", "data": admin.user_counts()})
+
+@bp.route('/admin/api/<table>')
+@admin_api
+def admin_users(table):
+    page = admin.list_users(table, request.args.get('q', '').strip() or None, request.args.get('field', 'username'),
+                            request.args.get('sort', 'user_id'), request.args.get('order', 'asc'), request.args.get('cursor'),
+                            request.args.get('limit', ADMIN_PAGE_SIZE, type=int))
+    return jsonify({"status": 200, "msg": "Users fetched successfully", "data": page.users, "next_cursor": page.next_cursor})
+
+@bp.route('/approve_user', methods=['POST'])
 def approve_user():
     if 'admin' not in session:
         flash('Admin access required', 'danger')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('blog.admin_login'))
     data = request.get_json()
     user_id = data.get('user_id')
     if user_id:
-        admin.approve_user(user_id)
+        try:
+            admin.approve_user(user_id)
+        except BlogError as e:
+            return jsonify({"status": e.status, "msg": e.msg}), e.status
         return jsonify({"status": 200})
     return jsonify({"status": "error", "msg": "Invalid user ID"}), 400
 
-@app.route('/deny_user', methods=['POST'])
+@bp.route('/deny_user', methods=['POST'])
 def deny_user():
     if 'admin' not in session:
         flash('Admin access required', 'danger')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('blog.admin_login'))
     data = request.get_json()
     user_id = data.get('user_id')
     if user_id:
@@ -210,11 +483,11 @@ def deny_user():
             return jsonify({"status": "error", "msg": str(e)}), 500
     return jsonify({"status": "error", "msg": "Invalid user ID"}), 400
 
-@app.route('/delete_user', methods=['POST'])
+@bp.route('/delete_user', methods=['POST'])
 def delete_user():
     if 'admin' not in session:
         flash('Admin access required', 'danger')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('blog.admin_login'))
     data = request.get_json()
     user_id = data.get('user_id')
     if user_id:
@@ -225,11 +498,69 @@ def delete_user():
             return jsonify({"status": "error", "msg": str(e)}), 500
     return jsonify({"status": "error", "msg": "Invalid user ID"}), 400
 
-@app.route('/add_admin', methods=['POST'])
+def bulk_response(action, results, summary):
+    return jsonify({"status": 200, "msg": f"Bulk {action} finished", "data": results, "summary": summary})
+
+@bp.route('/approve_users', methods=['POST'])
+@admin_api
+def approve_users():
+    return bulk_response('approve', *admin.bulk_approve((request.get_json(silent=True) or {}).get('user_ids')))
+
+@bp.route('/deny_users', methods=['POST'])
+@admin_api
+def deny_users():
+    return bulk_response('deny', *admin.bulk_deny((request.get_json(silent=True) or {}).get('user_ids')))
+
+@bp.route('/delete_users', methods=['POST'])
+@admin_api
+def delete_users():
+    return bulk_response('delete', *admin.bulk_delete((request.get_json(silent=True) or {}).get('user_ids')))
+
+@bp.route('/admin/api/posts/export')
+@admin_api
+def admin_export_posts():
+    """Stream every post, or a ?since=&until=&author=&tag= range, as NDJSON or a tar of Markdown files."""
+    from transfer import FORMATS, export_posts, export_chunks
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return jsonify({"status": 400, "msg": "format must be 'ndjson' or 'markdown'"}), 400
+    rows = export_posts(posts, request.args.get('since'), request.args.get('until'),
+                        request.args.get('author'), request.args.get('tag'))
+    admin.log_activity(session.get('admin'), f'Export posts as {fmt}', 'Started', args=request.args.to_dict())
+    mimetype, name = ('application/x-ndjson', 'posts.ndjson') if fmt == 'ndjson' else ('application/x-tar', 'posts.tar')
+    response = Response(stream_with_context(export_chunks(rows, fmt)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={name}'
+    return response
+
+@bp.route('/admin/api/posts/import', methods=['POST'])
+@admin_api
+def admin_import_posts():
+    """Import an NDJSON or (optionally gzipped) Markdown tar request body.
+
+    Markdown is rendered in this worker; `flask import-posts` renders on a
+    process pool and is the way to load large files. Uploading again with
+    the same ?source= name skips the records already imported.
+    """
+    import tarfile
+    from transfer import FORMATS, Importer, read_records
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return jsonify({"status": 400, "msg": "format must be 'ndjson' or 'markdown'"}), 400
+    source = request.args.get('source')
+    importer = Importer(posts, keep_ids=request.args.get('new_ids') != '1', workers=1,
+                        source=f'upload:{source}' if source else None)
+    try:
+        summary = importer.run(read_records(request.stream, fmt))
+    except tarfile.TarError as e:
+        return jsonify({"status": 400, "msg": f"Not a tar file: {e}"}), 400
+    admin.log_activity(session.get('admin'), f'Import posts from {fmt}', 'Success', summary=summary)
+    return jsonify({"status": 200, "msg": "Import finished", "data": summary})
+
+@bp.route('/add_admin', methods=['POST'])
 def add_admin():
     if 'admin' not in session:
         flash('Admin access required', 'danger')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('blog.admin_login'))
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
@@ -242,11 +573,11 @@ def add_admin():
             return jsonify({"status": "error", "msg": str(e)}), 500
     return jsonify({"status": "error", "msg": "Username and password required"}), 400
 
-@app.route('/reset_password', methods=['POST'])
+@bp.route('/reset_password', methods=['POST'])
 def reset_password():
     if 'admin' not in session:
         flash('Admin access required', 'danger')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('blog.admin_login'))
     data = request.get_json()
     username = data.get('username')
     new_password = data.get('new_password')
@@ -258,12 +589,169 @@ def reset_password():
             return jsonify({"status": "error", "msg": str(e)}), 500
     return jsonify({"status": "error", "msg": "Username and new password required"}), 400
 
-@app.route('/logout_admin', methods=['POST'])
+@bp.route('/logout_admin', methods=['POST'])
 def logout_admin():
     session.clear()
     flash('Admin has been logged out', 'info')
-    return redirect(url_for('admin_login'))
-
-
-
-
+    return redirect(url_for('blog.admin_login'))
+
+
+def migrate_all():
+    """Bring User.db, the shard index and this month's shard up to date; returns the User.db versions applied."""
+    applied = admin.ensure_admin_table()
+    month = current_month()
+    with posts.connect_to_db(month):
+        pass
+    # recorded now, so discovery in the workers finds nothing to write
+    posts.catalog.adjust(month, 0)
+    return applied
+
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations. Run once per deploy, before starting workers."""
+    applied = migrate_all()
+    click.echo(f"User.db: applied {', '.join(map(str, applied))}" if applied else 'User.db: up to date')
+
+
+@bp.cli.command('build-assets')
+@click.option('--prune', is_flag=True, help='Delete files left over from earlier builds.')
+def build_assets(prune):
+    """Fingerprint and precompress the static files the templates use."""
+    from assets import build as build_asset_files
+    manifest = build_asset_files(current_app.static_folder, prune=prune)
+    for name, built in manifest.items():
+        click.echo(f'{name} -> {built}')
+
+
+@bp.cli.command('reindex-search')
+@click.option('--month', multiple=True, help='Only index these YYYY_MM shards.')
+@click.option('--full', is_flag=True, help='Drop the index and rebuild it from scratch.')
+@click.option('--batch-size', default=500, show_default=True)
+def reindex_search(month, full, batch_size):
+    """Backfill the search index from the monthly post databases."""
+    months = list(month) or posts.catalog.months()
+    posts.search.rebuild(months, batch_size, full,
+                         progress=lambda shard, count: click.echo(f'{shard}: indexed {count} posts'))
+
+
+@bp.cli.command('backfill-tags')
+@click.option('--month', multiple=True, help='Only backfill these YYYY_MM shards.')
+@click.option('--batch-size', default=1000, show_default=True)
+def backfill_tags(month, batch_size):
+    """Populate post_tags/tag_counts from the tags column of existing posts."""
+    months = list(month) or posts.catalog.months()
+    posts.tags.backfill(months, batch_size,
+                        progress=lambda shard, count: click.echo(f'{shard}: tagged {count} posts'))
+
+
+@bp.cli.command('rerender-posts')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Shards rendered in parallel.')
+@click.option('--batch-size', default=500, show_default=True)
+def rerender_posts(workers, batch_size):
+    """Re-render stored Markdown in every shard after renderer settings change."""
+    locations = posts.catalog.locations()
+    # archives are read-only; `flask compact-shards --rebuild` re-renders them
+    months = [month for month in posts.catalog.months() if not locations[month].archived]
+    for month in months:
+        # opening through the pool adds any missing columns to older files
+        with posts.connect_to_db(month):
+            pass
+    from concurrent.futures import ProcessPoolExecutor
+    from rendering import rerender_shard
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(rerender_shard, [shard_path(month) for month in months], [batch_size] * len(months))
+        changed = []
+        for month, (rendered, excerpted) in zip(months, results):
+            click.echo(f'{month}: re-rendered {rendered}, excerpted {excerpted}')
+            if rendered or excerpted:
+                changed.append(month)
+    if changed:
+        posts.refresh_indexes(changed)
+        click.echo(f"refreshed feeds and the search index for {', '.join(changed)}")
+
+
+@bp.cli.command('compact-shards')
+@click.option('--retention-days', default=30, show_default=True, help='Leave deleted posts untouched for this many days.')
+# archive.DELETED_POLICIES, spelled out so registering the command does not import archive
+@click.option('--deleted', type=click.Choice(('compress', 'purge', 'keep')), default='compress', show_default=True,
+              help='What to do with deleted posts past the retention window.')
+@click.option('--merge-years', is_flag=True, help='Merge the months of past years into one archive per year.')
+@click.option('--rebuild', is_flag=True, help='Rewrite archives even when nothing changed, e.g. after a renderer change.')
+@click.option('--grace-minutes', default=60, show_default=True, help='Minutes after a switch before superseded files are deleted.')
+def compact_shards(retention_days, deleted, merge_years, rebuild, grace_minutes):
+    """Move closed months into read-only archives and compact their deleted posts."""
+    from archive import Compactor, remove_retired
+    for path in remove_retired(posts.catalog, grace_minutes * 60):
+        click.echo(f'removed {path}')
+    compactor = Compactor(posts, retention_days, deleted, merge_years, rebuild)
+    rerendered = []
+    for result in compactor.run():
+        click.echo(f"{result['archive']}: {', '.join(result['months'])}, {result['posts']} posts, "
+                   f"{result.get('compressed', 0)} deleted compressed, {result.get('purged', 0)} purged, "
+                   f"{result['rendered']} re-rendered, {result['bytes_before'] // 1024} KiB -> {result['bytes_after'] // 1024} KiB")
+        if result['rendered']:
+            rerendered.extend(result['months'])
+    if rerendered:
+        posts.refresh_indexes(rerendered)
+        click.echo(f"refreshed feeds and the search index for {', '.join(rerendered)}")
+
+
+@bp.cli.command('export-posts')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+# transfer.FORMATS, spelled out like --deleted above
+@click.option('--format', 'fmt', type=click.Choice(('ndjson', 'markdown')), help='Defaults to the file extension, ndjson for -.')
+@click.option('--since', help='Export posts from this UTC day on, YYYY-MM-DD.')
+@click.option('--until', help='Export posts before this UTC day, YYYY-MM-DD.')
+@click.option('--author', help='Only posts by this author.')
+@click.option('--tag', help='Only posts with this tag.')
+def export_posts_command(output, fmt, since, until, author, tag):
+    """Stream posts to NDJSON or a tar of Markdown files (gzipped for .tar.gz/.tgz)."""
+    from transfer import export_posts, export_chunks, guess_format
+    try:
+        fmt = fmt or ('ndjson' if output == '-' else guess_format(output))
+        rows = export_posts(posts, since, until, author, tag)
+    except BlogError as e:
+        raise click.UsageError(e.msg)
+    import gzip
+    with click.open_file(output, 'wb') as out:
+        target = gzip.GzipFile(fileobj=out, mode='wb') if output.endswith(('.gz', '.tgz')) else out
+        for chunk in export_chunks(rows, fmt):
+            target.write(chunk)
+        if target is not out:
+            target.close()
+
+
+@bp.cli.command('import-posts')
+@click.argument('input_path', metavar='INPUT', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(('ndjson', 'markdown')), help='Defaults to the file extension, ndjson for -.')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Processes rendering Markdown.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--new-ids', is_flag=True, help='Give every post a new id instead of keeping the exported one.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint left by an earlier run on this file.')
+def import_posts_command(input_path, fmt, workers, batch_size, new_ids, restart):
+    """Load posts written by export-posts; an interrupted run resumes from its last batch."""
+    from transfer import Importer, read_records, guess_format
+    try:
+        fmt = fmt or ('ndjson' if input_path == '-' else guess_format(input_path))
+    except BlogError as e:
+        raise click.UsageError(e.msg)
+    importer = Importer(posts, not new_ids, workers, batch_size, None if input_path == '-' else os.path.abspath(input_path))
+    if restart:
+        importer.reset()
+    started = last_report = time.perf_counter()
+
+    def report(records, summary):
+        nonlocal last_report
+        if time.perf_counter() - last_report >= 5:
+            last_report = time.perf_counter()
+            click.echo(f"{records} records read, {summary['imported']} imported")
+
+    with click.open_file(input_path, 'rb') as stream:
+        summary = importer.run(read_records(stream, fmt), progress=report)
+    elapsed = time.perf_counter() - started
+    for error in summary['errors']:
+        click.echo(f'invalid: {error}')
+    click.echo(f"imported {summary['imported']} posts in {elapsed:.1f} s ({summary['resumed_at']} records done by an earlier run), "
+               f"{summary['existing']} already present, {summary['archived']} in archived months, {summary['invalid']} invalid")
+    posts.log_activity(f"Imported {summary['imported']} posts from {input_path}")
@@ -0,0 +1,128 @@
+import html
+import re
+import sqlite3
+
+from db import readonly_uri
+from shards import ShardCatalog, index_connections, index_path
+from models import SearchHit
+from rendering import strip_html
+
+# column weights for bm25(): title, body, tags, author
+RANK = "bm25(post_search, 10.0, 1.0, 5.0, 2.0)"
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+# snippet() marks hits with control characters; the body is user text, so it is
+# escaped before they become <mark> tags
+HIT_START, HIT_END = '\x02', '\x03'
+
+
+def match_query(q):
+    """Turn free text into an FTS5 query that ANDs every word.
+
+    Each word is quoted so characters that mean something to FTS5 in user
+    input cannot produce syntax errors; the last word also matches as a prefix.
+    """
+    terms = TERM_RE.findall(q)
+    if not terms:
+        return None
+    quoted = ['"%s"' % term for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def highlight(snippet):
+    """HTML for a snippet() result: the text escaped, the hits wrapped in <mark>."""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(HIT_START, '<mark>').replace(HIT_END, '</mark>')
+
+
+class SearchIndex:
+    """FTS5 index over every monthly shard, stored in the shared index database.
+
+    The FTS rowid is the global post id, so adding a post twice (live and
+    again from a rebuild) just replaces the row.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or index_connections
+
+    def _insert(self, db, post_id, post_title, post_content, post_author, tags, timestamp):
+        db.execute("INSERT OR REPLACE INTO post_search (rowid, post_title, body, tags, post_author, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                   (post_id, post_title, strip_html(post_content), tags, post_author, timestamp))
+
+    def add(self, post):
+        self.add_many([post])
+
+    def add_many(self, posts):
+        with self.pool.connection(index_path()) as db:
+            for post in posts:
+                self._insert(db, post.post_id, post.post_title, post.post_content, post.post_author, post.tags, post.timestamp)
+            db.commit()
+
+    def remove(self, post_id):
+        with self.pool.connection(index_path()) as db:
+            db.execute("DELETE FROM post_search WHERE rowid = ?", (post_id,))
+            db.commit()
+
+    def search(self, q, limit=20, offset=0):
+        query = match_query(q)
+        if query is None:
+            return []
+        with self.pool.connection(index_path()) as db:
+            rows = db.execute(f"""
+                SELECT rowid, post_title, post_author, tags, timestamp,
+                       snippet(post_search, 1, ?, ?, '...', 16) AS snippet,
+                       {RANK} AS rank
+                FROM post_search WHERE post_search MATCH ?
+                ORDER BY rank LIMIT ? OFFSET ?""", (HIT_START, HIT_END, query, limit, offset)).fetchall()
+        return [SearchHit(row['rowid'], row['post_title'], row['post_author'], row['tags'], row['timestamp'], highlight(row['snippet']), row['rank'])
+                for row in rows]
+
+    def reindex(self, months, batch_size=500):
+        """Index every row of `months` again, replacing rows whose body was re-rendered."""
+        with self.pool.connection(index_path()) as db:
+            db.executemany("DELETE FROM search_state WHERE month = ?", [(month,) for month in months])
+            db.commit()
+        self.rebuild(months, batch_size)
+
+    def rebuild(self, months, batch_size=500, full=False, progress=None):
+        """Index rows the index has not seen yet, shard by shard.
+
+        Progress is kept per month in search_state and every batch is its own
+        short transaction, so an interrupted run resumes where it stopped and
+        the web process is never locked out of the index for long.
+        """
+        catalog = ShardCatalog(self.pool)
+        buried = catalog.tombstones()
+        with self.pool.connection(index_path()) as db:
+            if full:
+                db.execute("DELETE FROM post_search")
+                db.execute("DELETE FROM search_state")
+                db.commit()
+            for month in months:
+                row = db.execute("SELECT last_post_id FROM search_state WHERE month = ?", (month,)).fetchone()
+                last_id = row['last_post_id'] if row else 0
+                location = catalog.locate(month)
+                low, high = location.month_range(month)
+                shard = sqlite3.connect(readonly_uri(location.path, location.archived), uri=True)
+                shard.row_factory = sqlite3.Row
+                try:
+                    while True:
+                        batch = shard.execute("SELECT * FROM posts WHERE post_id > ? AND post_id < ? ORDER BY post_id LIMIT ?",
+                                              (low + last_id, high, batch_size)).fetchall()
+                        if not batch:
+                            break
+                        for post in batch:
+                            post_id = post['post_id'] + location.offset
+                            if post_id not in buried:
+                                self._insert(db, post_id, post['post_title'], post['post_content'],
+                                             post['post_author'], post['tags'], post['timestamp'])
+                        last_id = batch[-1]['post_id'] - low
+                        db.execute("""INSERT INTO search_state (month, last_post_id) VALUES (?, ?)
+                                      ON CONFLICT(month) DO UPDATE SET last_post_id = excluded.last_post_id""", (month, last_id))
+                        db.commit()
+                        if progress:
+                            progress(month, len(batch))
+                finally:
+                    shard.close()
@@ -0,0 +1,271 @@
+import base64
+import glob
+import heapq
+import os
+import re
+import sqlite3
+import datetime
+
+from db import ConnectionPool
+
+POSTS_DATABASE_DIR = 'static/POSTS'
+INDEX_DATABASE = 'index.db'
+# read-only files that closed months are compacted into by `flask compact-shards`
+ARCHIVE_DIR = os.path.join(POSTS_DATABASE_DIR, 'archive')
+
+# post ids handed out to clients are YYYYMM * SHARD_ID_SPAN + the row id inside
+# that month's file, so an id alone says which Post_YYYY_MM.db holds the post
+SHARD_ID_SPAN = 10 ** 9
+
+SHARD_FILE_RE = re.compile(r'^Post_(\d{4}_\d{2})\.db$')
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    month TEXT PRIMARY KEY,
+    post_count INTEGER NOT NULL DEFAULT 0);
+CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(
+    post_title, body, tags, post_author, timestamp UNINDEXED,
+    tokenize='porter unicode61');
+CREATE TABLE IF NOT EXISTS search_state (
+    month TEXT PRIMARY KEY,
+    last_post_id INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS post_tags (
+    tag TEXT NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    post_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, timestamp, post_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_post_tags_post ON post_tags (post_id);
+CREATE TABLE IF NOT EXISTS tag_counts (
+    tag TEXT PRIMARY KEY,
+    post_count INTEGER NOT NULL DEFAULT 0);
+CREATE TRIGGER IF NOT EXISTS post_tags_insert AFTER INSERT ON post_tags BEGIN
+    INSERT INTO tag_counts (tag, post_count) VALUES (new.tag, 1)
+    ON CONFLICT(tag) DO UPDATE SET post_count = post_count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS post_tags_delete AFTER DELETE ON post_tags BEGIN
+    UPDATE tag_counts SET post_count = post_count - 1 WHERE tag = old.tag;
+    DELETE FROM tag_counts WHERE tag = old.tag AND post_count <= 0;
+END;
+CREATE TABLE IF NOT EXISTS feed_posts (
+    feed TEXT NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    post_id INTEGER NOT NULL,
+    post_title TEXT NOT NULL,
+    post_author TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    post_excerpt TEXT,
+    PRIMARY KEY (feed, timestamp, post_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_feed_posts_post ON feed_posts (post_id);
+CREATE TABLE IF NOT EXISTS feeds (
+    feed TEXT PRIMARY KEY,
+    filled_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS feed_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS tombstones (
+    post_id INTEGER PRIMARY KEY,
+    month TEXT NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS import_state (
+    source TEXT PRIMARY KEY,
+    records INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS post_views (
+    post_id INTEGER PRIMARY KEY,
+    views INTEGER NOT NULL DEFAULT 0,
+    rank REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_post_views_rank ON post_views (rank);
+"""
+
+# columns added to the catalog after index databases were first created
+SHARDS_COLUMNS = (
+    ('archive', 'TEXT'),
+    # unix time the month last switched to a new archive
+    ('retired_at', 'REAL'),
+)
+
+
+def migrate_index_schema(db):
+    db.executescript(INDEX_SCHEMA)
+    existing = {row['name'] for row in db.execute("PRAGMA table_info(shards)")}
+    for name, definition in SHARDS_COLUMNS:
+        if name not in existing:
+            db.execute(f"ALTER TABLE shards ADD COLUMN {name} {definition}")
+
+
+index_connections = ConnectionPool(schema=migrate_index_schema)
+
+
+def current_month():
+    return datetime.datetime.now().strftime("%Y_%m")
+
+
+def shard_path(month):
+    return os.path.join(POSTS_DATABASE_DIR, f'Post_{month}.db')
+
+
+def index_path():
+    return os.path.join(POSTS_DATABASE_DIR, INDEX_DATABASE)
+
+
+def global_id(month, local_id):
+    return int(month.replace('_', '')) * SHARD_ID_SPAN + int(local_id)
+
+
+def split_id(post_id):
+    """Return (month, local row id) for a client facing post id.
+
+    Ids below SHARD_ID_SPAN predate sharded ids and are looked up in the
+    current month, which is where they used to be served from.
+    """
+    post_id = int(post_id)
+    if post_id < SHARD_ID_SPAN:
+        return current_month(), post_id
+    shard, local_id = divmod(post_id, SHARD_ID_SPAN)
+    return f'{shard // 100:04d}_{shard % 100:02d}', local_id
+
+
+def canonical_id(post_id):
+    """The global id a (possibly legacy) client post id refers to."""
+    return global_id(*split_id(post_id))
+
+
+def encode_cursor(post):
+    raw = f"{post.timestamp}|{post.post_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(token):
+    """Return the (timestamp, post_id) a page should continue after."""
+    try:
+        timestamp, post_id = base64.urlsafe_b64decode(token.encode()).decode().rsplit('|', 1)
+        return timestamp, int(post_id)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+class Shard:
+    """The file one month's posts are read from.
+
+    A live month is its own Post_YYYY_MM.db keyed by row ids local to the
+    month. An archived month lives in a read-only file under ARCHIVE_DIR,
+    possibly shared with the rest of its year, keyed by global ids. Either
+    way a stored post_id + offset is the global id.
+    """
+    __slots__ = ('path', 'offset', 'archived')
+
+    def __init__(self, path, offset, archived=False):
+        self.path = path
+        self.offset = offset
+        self.archived = archived
+
+    def stored_id(self, post_id):
+        """The post_id column value (or keyset bound) for a global id."""
+        return post_id - self.offset
+
+    def month_range(self, month):
+        """Stored ids [low, high) that belong to month."""
+        return self.stored_id(global_id(month, 0)), self.stored_id(global_id(month, SHARD_ID_SPAN))
+
+
+def locate_month(month, archive=None):
+    if archive is None:
+        return Shard(shard_path(month), global_id(month, 0))
+    return Shard(os.path.join(ARCHIVE_DIR, archive), 0, archived=True)
+
+
+def merge_newest_first(streams):
+    """Lazily merge per-shard streams already sorted newest first."""
+    return heapq.merge(*streams, key=lambda post: (post.timestamp, post.post_id), reverse=True)
+
+
+class ShardCatalog:
+    """Tracks which monthly files hold posts so readers skip empty shards.
+
+    Counts live in the shared index database so every worker process sees
+    the same picture; files that were never recorded (created before the
+    catalog existed) are counted once on first use.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or index_connections
+        self._discovered = False
+
+    def discover(self):
+        with self.pool.connection(index_path()) as db:
+            known = {row['month'] for row in db.execute('SELECT month FROM shards')}
+            for path in glob.glob(os.path.join(POSTS_DATABASE_DIR, 'Post_*.db')):
+                match = SHARD_FILE_RE.match(os.path.basename(path))
+                if not match or match.group(1) in known:
+                    continue
+                shard = sqlite3.connect(path)
+                try:
+                    count = shard.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+                except sqlite3.OperationalError:
+                    count = 0
+                finally:
+                    shard.close()
+                db.execute('INSERT OR IGNORE INTO shards (month, post_count) VALUES (?, ?)', (match.group(1), count))
+            db.commit()
+        self._discovered = True
+
+    def ensure_discovered(self):
+        if not self._discovered:
+            self.discover()
+
+    def months(self):
+        """Months holding at least one post, newest first."""
+        self.ensure_discovered()
+        with self.pool.connection(index_path()) as db:
+            rows = db.execute('SELECT month FROM shards WHERE post_count > 0 ORDER BY month DESC').fetchall()
+        return [row['month'] for row in rows]
+
+    def locations(self):
+        """{month: Shard} for every month the catalog knows."""
+        self.ensure_discovered()
+        with self.pool.connection(index_path()) as db:
+            rows = db.execute('SELECT month, archive FROM shards').fetchall()
+        return {row['month']: locate_month(row['month'], row['archive']) for row in rows}
+
+    def locate(self, month):
+        self.ensure_discovered()
+        with self.pool.connection(index_path()) as db:
+            row = db.execute('SELECT archive FROM shards WHERE month = ?', (month,)).fetchone()
+        return locate_month(month, row['archive'] if row else None)
+
+    def shards(self):
+        """Files holding at least one post, newest first; a yearly archive is listed once."""
+        self.ensure_discovered()
+        with self.pool.connection(index_path()) as db:
+            rows = db.execute('SELECT month, archive FROM shards WHERE post_count > 0 ORDER BY month DESC').fetchall()
+        shards = {}
+        for row in rows:
+            shard = locate_month(row['month'], row['archive'])
+            shards.setdefault(shard.path, shard)
+        return list(shards.values())
+
+    def tombstones(self):
+        """Global ids of archived posts deleted since their archive was written."""
+        with self.pool.connection(index_path()) as db:
+            return {row['post_id'] for row in db.execute('SELECT post_id FROM tombstones')}
+
+    def is_buried(self, post_id):
+        with self.pool.connection(index_path()) as db:
+            return db.execute('SELECT 1 FROM tombstones WHERE post_id = ?', (post_id,)).fetchone() is not None
+
+    def bury(self, month, post_id):
+        """Delete an archived post by tombstoning it; False if it already was."""
+        with self.pool.connection(index_path()) as db:
+            buried = db.execute('INSERT OR IGNORE INTO tombstones (post_id, month) VALUES (?, ?)', (post_id, month)).rowcount
+            if buried:
+                db.execute('UPDATE shards SET post_count = MAX(post_count - 1, 0) WHERE month = ?', (month,))
+            db.commit()
+        return bool(buried)
+
+    def adjust(self, month, delta):
+        self.ensure_discovered()
+        with self.pool.connection(index_path()) as db:
+            db.execute("""INSERT INTO shards (month, post_count) VALUES (?, MAX(?, 0))
+                          ON CONFLICT(month) DO UPDATE SET post_count = MAX(post_count + ?, 0)""",
+                       (month, delta, delta))
+            db.commit()
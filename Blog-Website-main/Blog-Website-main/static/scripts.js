@@ -48,7 +48,7 @@ function approveUser(userId) {
     .then(response => response.json())
     .then(data => {
         if (data.status === 200) {
-            location.reload(); // Reload the page to see updated data
+            removeUserRows('pending_users', [userId]);
         } else {
             alert('Failed to approve user: ' + data.msg);
         }
@@ -67,7 +67,7 @@ function denyUser(userId) {
     .then(response => response.json())
     .then(data => {
         if (data.status === 200) {
-            location.reload(); // Reload the page to see updated data
+            removeUserRows('pending_users', [userId]);
         } else {
             alert('Failed to deny user: ' + data.msg);
         }
@@ -86,7 +86,7 @@ function deleteUser(userId) {
     .then(response => response.json())
     .then(data => {
         if (data.status === 200) {
-            location.reload(); // Reload the page to see updated data
+            removeUserRows('users', [userId]);
         } else {
             alert('Failed to delete user: ' + data.msg);
         }
@@ -94,6 +94,60 @@ function deleteUser(userId) {
     .catch(error => alert('Error deleting user: ' + error.message));
 }
 
+// drop handled rows from the admin tables and refresh the totals, no page reload
+function removeUserRows(table, userIds) {
+    userIds.forEach(userId => {
+        const row = document.getElementById(table + '-' + userId);
+        if (row) {
+            row.remove();
+        }
+    });
+    fetch('/admin/api/counts')
+        .then(response => response.json())
+        .then(data => {
+            Object.entries(data.data || {}).forEach(([name, total]) => {
+                const counter = document.getElementById(name + '-count');
+                if (counter) {
+                    counter.textContent = total;
+                }
+            });
+        });
+}
+
+function selectedUserIds(table) {
+    return Array.from(document.querySelectorAll('#' + table + '-rows input.user-select:checked'))
+        .map(box => parseInt(box.value, 10));
+}
+
+// action is 'approve', 'deny' or 'delete'; one request for every selected row
+function bulkUsers(action, table) {
+    const userIds = selectedUserIds(table);
+    if (!userIds.length) {
+        return;
+    }
+    fetch('/' + action + '_users', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ user_ids: userIds })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.status !== 200) {
+            alert('Failed to ' + action + ' users: ' + data.msg);
+            return;
+        }
+        const done = data.data.filter(item => ['approved', 'denied', 'deleted'].includes(item.result));
+        removeUserRows(table, done.map(item => item.user_id));
+        const failed = data.data.filter(item => !done.includes(item));
+        if (failed.length) {
+            alert(failed.length + ' users were not changed: ' + failed.map(item => item.user_id + ' (' + item.result + ')').join(', '));
+        }
+    })
+    .catch(error => alert('Error updating users: ' + error.message));
+}
+
 
     if ("serviceWorker" in navigator) {
         window.addEventListener("load", function() {
@@ -0,0 +1,120 @@
+import sqlite3
+from collections import namedtuple
+
+from db import readonly_uri
+from shards import ShardCatalog, index_connections, index_path, merge_newest_first
+
+# what the tag index knows about a post, enough to page and to fetch it
+TagRef = namedtuple('TagRef', 'post_id timestamp')
+
+
+def parse_tags(text):
+    """Normalize the free-form tags column: comma separated, case-insensitive."""
+    tags = {' '.join(tag.split()).lower() for tag in text.split(',')}
+    tags.discard('')
+    return sorted(tags)
+
+
+class TagIndex:
+    """post_tags/tag_counts tables in the shared index database.
+
+    Rows are keyed on (tag, timestamp, post_id), so listing a tag newest
+    first is a range scan and pages continue from a (timestamp, post_id)
+    cursor like the plain post list. tag_counts is kept up to date by
+    triggers on post_tags.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or index_connections
+
+    def _insert(self, db, post_id, timestamp, tags):
+        db.executemany("INSERT OR IGNORE INTO post_tags (tag, timestamp, post_id) VALUES (?, ?, ?)",
+                       [(tag, timestamp, post_id) for tag in parse_tags(tags)])
+
+    def add(self, post):
+        self.add_many([post])
+
+    def add_many(self, posts):
+        with self.pool.connection(index_path()) as db:
+            for post in posts:
+                self._insert(db, post.post_id, post.timestamp, post.tags)
+            db.commit()
+
+    def remove(self, post_id):
+        with self.pool.connection(index_path()) as db:
+            db.execute("DELETE FROM post_tags WHERE post_id = ?", (post_id,))
+            db.commit()
+
+    def counts(self, limit=None):
+        with self.pool.connection(index_path()) as db:
+            query = "SELECT tag, post_count FROM tag_counts ORDER BY post_count DESC, tag"
+            if limit:
+                rows = db.execute(query + " LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = db.execute(query).fetchall()
+        return [dict(row) for row in rows]
+
+    def page(self, tags, match_all=False, after=None, limit=20):
+        """Newest first refs of posts carrying any (or all) of `tags`."""
+        tags = parse_tags(','.join(tags))
+        if not tags:
+            return []
+        keyset = "AND (t.timestamp, t.post_id) < (?, ?)" if after else ""
+        keyset_params = list(after) if after else []
+        with self.pool.connection(index_path()) as db:
+            if match_all:
+                # drive the scan from the rarest tag and probe the others by primary key
+                counts = dict(db.execute("SELECT tag, post_count FROM tag_counts WHERE tag IN (%s)" % ','.join('?' * len(tags)), tags).fetchall())
+                if len(counts) < len(tags):
+                    return []
+                driver, *others = sorted(tags, key=counts.get)
+                probes = ''.join(" AND EXISTS (SELECT 1 FROM post_tags o WHERE o.tag = ? AND o.timestamp = t.timestamp AND o.post_id = t.post_id)"
+                                 for _ in others)
+                rows = db.execute(f"""SELECT t.post_id, t.timestamp FROM post_tags t
+                                      WHERE t.tag = ? {keyset}{probes}
+                                      ORDER BY t.timestamp DESC, t.post_id DESC LIMIT ?""",
+                                  [driver, *keyset_params, *others, limit]).fetchall()
+                return [TagRef(row['post_id'], row['timestamp']) for row in rows]
+
+            streams = []
+            for tag in tags:
+                rows = db.execute(f"""SELECT t.post_id, t.timestamp FROM post_tags t
+                                      WHERE t.tag = ? {keyset}
+                                      ORDER BY t.timestamp DESC, t.post_id DESC LIMIT ?""",
+                                  [tag, *keyset_params, limit]).fetchall()
+                streams.append([TagRef(row['post_id'], row['timestamp']) for row in rows])
+        refs = []
+        # a post carrying several of the tags shows up adjacent in the merge
+        for ref in merge_newest_first(streams):
+            if refs and refs[-1] == ref:
+                continue
+            refs.append(ref)
+            if len(refs) == limit:
+                break
+        return refs
+
+    def backfill(self, months, batch_size=1000, progress=None):
+        """Fill post_tags from the tags column of existing shards; safe to re-run."""
+        catalog = ShardCatalog(self.pool)
+        buried = catalog.tombstones()
+        with self.pool.connection(index_path()) as db:
+            for month in months:
+                location = catalog.locate(month)
+                last_id, high = location.month_range(month)
+                shard = sqlite3.connect(readonly_uri(location.path, location.archived), uri=True)
+                shard.row_factory = sqlite3.Row
+                try:
+                    while True:
+                        batch = shard.execute("SELECT post_id, tags, timestamp FROM posts WHERE post_id > ? AND post_id < ? ORDER BY post_id LIMIT ?",
+                                              (last_id, high, batch_size)).fetchall()
+                        if not batch:
+                            break
+                        for post in batch:
+                            if post['post_id'] + location.offset not in buried:
+                                self._insert(db, post['post_id'] + location.offset, post['timestamp'], post['tags'])
+                        db.commit()
+                        last_id = batch[-1]['post_id']
+                        if progress:
+                            progress(month, len(batch))
+                finally:
+                    shard.close()
@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import USER_LOOKUPS, table_scans
+from migrations import migrate
+
+
+@pytest.fixture
+def user_db(tmp_path):
+    db = sqlite3.connect(tmp_path / 'User.db')
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize('name', sorted(USER_LOOKUPS))
+def test_lookup_uses_an_index(user_db, name):
+    migrate(user_db)
+    query, params = USER_LOOKUPS[name]
+    plan, scans = table_scans(user_db, query, params(0))
+    assert not scans, f'{name}: {plan}'
+
+
+def test_unindexed_schema_is_caught(user_db):
+    # version 1 predates the indexes, so the check above has something to find
+    migrate(user_db, target=1)
+    query, params = USER_LOOKUPS['login']
+    plan, scans = table_scans(user_db, query, params(0))
+    assert scans == ['SCAN users']
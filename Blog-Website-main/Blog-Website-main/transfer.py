@@ -0,0 +1,365 @@
+"""Bulk export and import of posts.
+
+Two formats, both streamed so memory stays flat however many posts move:
+
+    ndjson     one JSON object per line
+    markdown   a tar of posts/YYYY/MM/<post_id>.md files, each with a
+               front matter block of JSON-encoded fields before the Markdown
+
+A record has post_id, post_title, post_author, tags, timestamp (UTC,
+'YYYY-MM-DD HH:MM:SS') and post_markdown. Posts stored before the Markdown
+source was kept export their HTML as post_markdown, which Markdown passes
+through unchanged.
+"""
+import datetime
+import io
+import itertools
+import json
+import os
+import sqlite3
+from collections import deque
+
+from models import BlogError, BadRequest, Post
+from rendering import render, RENDERER_VERSION
+from shards import index_path, global_id, split_id
+from tags import parse_tags
+
+FORMATS = ('ndjson', 'markdown')
+FIELDS = ('post_id', 'post_title', 'post_author', 'tags', 'timestamp', 'post_markdown')
+EXPORT_COLUMNS = "post_id, post_title, post_content, post_markdown, post_author, tags, timestamp"
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def guess_format(name):
+    if name.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    if name.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        return 'markdown'
+    raise BadRequest("format must be 'ndjson' or 'markdown'")
+
+
+def month_of(day):
+    return day[:7].replace('-', '_')
+
+
+def export_posts(posts, since=None, until=None, author=None, tag=None, batch_size=1000):
+    """Every post, oldest month first, as an iterator of Posts carrying their Markdown.
+
+    since is inclusive and until exclusive ('YYYY-MM-DD' or a full
+    timestamp, UTC). Each shard is read in keyset batches on a fresh
+    checkout, so no connection is held while the caller writes out a batch.
+    """
+    try:
+        since = normalize_timestamp(since) if since else None
+        until = normalize_timestamp(until) if until else None
+    except ValueError:
+        raise BadRequest("since and until must be dates like 2024-01-31")
+    if tag is not None:
+        tag = (parse_tags(tag) or [''])[0]
+    return _export(posts, since, until, author, tag, batch_size)
+
+
+def _export(posts, since, until, author, tag, batch_size):
+    locations = posts.catalog.locations()
+    buried = posts.catalog.tombstones() if any(shard.archived for shard in locations.values()) else set()
+    where, params = [], []
+    if since:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        where.append("timestamp < ?")
+        params.append(until)
+    if author:
+        where.append("post_author = ?")
+        params.append(author)
+    filters = ''.join(' AND ' + clause for clause in where)
+    for month in sorted(locations):
+        if (since and month < month_of(since)) or (until and month > month_of(until)):
+            continue
+        shard = locations[month]
+        if not os.path.exists(shard.path):
+            continue
+        last_id, high = shard.month_range(month)
+        while True:
+            with posts.read_shard(shard) as db:
+                rows = db.execute(f"""SELECT {EXPORT_COLUMNS} FROM posts WHERE post_id > ? AND post_id < ?{filters}
+                                      ORDER BY post_id LIMIT ?""", (last_id, high, *params, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['post_id']
+            for row in rows:
+                post_id = row['post_id'] + shard.offset
+                if post_id in buried or (tag is not None and tag not in parse_tags(row['tags'])):
+                    continue
+                post = Post.from_row(row, post_id)
+                if post.post_markdown is None:
+                    post.post_markdown = post.post_content
+                yield post
+
+
+def record(post):
+    return {name: getattr(post, name) for name in FIELDS}
+
+
+def ndjson_chunks(posts):
+    for post in posts:
+        yield (json.dumps(record(post)) + '\n').encode()
+
+
+class _Chunks(io.RawIOBase):
+    """Write-only file that collects what tarfile writes, for streaming it out."""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def markdown_document(post):
+    front = ''.join(f'{name}: {json.dumps(getattr(post, name))}\n' for name in FIELDS if name != 'post_markdown')
+    return f'---\n{front}---\n{post.post_markdown}'.encode()
+
+
+def markdown_tar_chunks(posts):
+    import tarfile
+    out = _Chunks()
+    with tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for post in posts:
+            data = markdown_document(post)
+            month, _ = split_id(post.post_id)
+            info = tarfile.TarInfo(f"posts/{month.replace('_', '/')}/{post.post_id}.md")
+            info.size = len(data)
+            info.mtime = int(datetime.datetime.strptime(post.timestamp, TIMESTAMP_FORMAT)
+                             .replace(tzinfo=datetime.timezone.utc).timestamp())
+            tar.addfile(info, io.BytesIO(data))
+            chunk = out.drain()
+            if chunk:
+                yield chunk
+    yield out.drain()
+
+
+def export_chunks(posts, fmt):
+    return ndjson_chunks(posts) if fmt == 'ndjson' else markdown_tar_chunks(posts)
+
+
+def read_ndjson(stream):
+    """Yield a dict, or a ValueError for a line that is not a JSON object, per non-blank line."""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError('not a JSON object')
+            yield data
+        except ValueError as e:
+            yield e
+
+
+def parse_markdown_document(text):
+    if not text.startswith('---\n'):
+        raise ValueError('missing front matter')
+    front, separator, body = text[4:].partition('\n---\n')
+    if not separator:
+        raise ValueError('unterminated front matter')
+    data = {'post_markdown': body}
+    for line in front.splitlines():
+        name, _, value = line.partition(':')
+        data[name.strip()] = json.loads(value)
+    return data
+
+
+def read_markdown_tar(stream):
+    """Yield a dict, or a ValueError, per .md file of a (possibly compressed) tar read front to back."""
+    import tarfile
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.md'):
+                continue
+            try:
+                yield parse_markdown_document(tar.extractfile(member).read().decode())
+            except ValueError as e:
+                yield ValueError(f'{member.name}: {e}')
+
+
+def read_records(stream, fmt):
+    return read_ndjson(stream) if fmt == 'ndjson' else read_markdown_tar(stream)
+
+
+def normalize_timestamp(value):
+    if value is None:
+        return datetime.datetime.now(datetime.timezone.utc).strftime(TIMESTAMP_FORMAT)
+    parsed = datetime.datetime.fromisoformat(str(value))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
+def validate(data):
+    """(title, markdown, author, tags, timestamp, post_id or None) for an import record."""
+    if isinstance(data, Exception):
+        raise data
+    title, author, markdown = data.get('post_title'), data.get('post_author'), data.get('post_markdown')
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError('post_title is required')
+    if not isinstance(author, str) or not author.strip():
+        raise ValueError('post_author is required')
+    if not isinstance(markdown, str):
+        raise ValueError('post_markdown is required')
+    tags = data.get('tags') or ''
+    if isinstance(tags, list):
+        tags = ', '.join(map(str, tags))
+    post_id = data.get('post_id')
+    if post_id is not None and not isinstance(post_id, int):
+        raise ValueError('post_id must be an integer')
+    return title, markdown, author, str(tags), normalize_timestamp(data.get('timestamp')), post_id
+
+
+def render_batch(rows):
+    """Runs in a worker process: (html, excerpt) per validated row."""
+    return [render(row[1]) for row in rows]
+
+
+class Importer:
+    """Loads exported posts into the monthly shards.
+
+    Records are validated and grouped into batches on the calling thread.
+    The Markdown of each batch is rendered on a process pool, with only a
+    few batches in flight so a large file never sits in memory. Rendered
+    batches are committed in input order, one transaction per month they
+    touch. Each post goes into the shard its timestamp falls in. The
+    indexes and the catalog are updated per batch.
+
+    Records keep their post_id when it belongs to the month of their
+    timestamp. An id that is already taken counts as existing and is
+    skipped, so re-importing a backup is harmless. With keep_ids=False
+    every post gets a new id. Months that are already archived are read-only
+    and their posts are skipped.
+
+    With a source name, the number of input records committed so far is
+    saved in import_state after every batch, and a later run with the same
+    source skips that many records. Only with keep_ids=False can a crash
+    between a batch's commit and its checkpoint import that batch twice.
+    """
+
+    def __init__(self, posts, keep_ids=True, workers=None, batch_size=1000, source=None):
+        self.posts = posts
+        self.keep_ids = keep_ids
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.source = source
+
+    def checkpoint(self):
+        if self.source is None:
+            return 0
+        with self.posts.catalog.pool.connection(index_path()) as db:
+            row = db.execute("SELECT records FROM import_state WHERE source = ?", (self.source,)).fetchone()
+        return row['records'] if row else 0
+
+    def save_checkpoint(self, records):
+        if self.source is None:
+            return
+        with self.posts.catalog.pool.connection(index_path()) as db:
+            db.execute("""INSERT INTO import_state (source, records) VALUES (?, ?)
+                          ON CONFLICT(source) DO UPDATE SET records = excluded.records, updated_at = CURRENT_TIMESTAMP""",
+                       (self.source, records))
+            db.commit()
+
+    def reset(self):
+        self.save_checkpoint(0)
+
+    def batches(self, records, summary):
+        """(input records consumed so far, valid rows) per batch."""
+        position = summary['resumed_at'] = self.checkpoint()
+        rows = []
+        for data in itertools.islice(records, position, None):
+            position += 1
+            try:
+                rows.append(validate(data))
+            except ValueError as e:
+                summary['invalid'] += 1
+                if len(summary['errors']) < 20:
+                    summary['errors'].append(f'record {position}: {e}')
+            if len(rows) >= self.batch_size:
+                yield position, rows
+                rows = []
+        yield position, rows
+
+    def rendered(self, batches):
+        """(position, rows, renders) in input order, rendering ahead on the process pool."""
+        if self.workers <= 1:
+            for position, rows in batches:
+                yield position, rows, render_batch(rows)
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for position, rows in batches:
+                pending.append((position, rows, pool.submit(render_batch, rows)))
+                if len(pending) > self.workers * 2:
+                    position, rows, future = pending.popleft()
+                    yield position, rows, future.result()
+            while pending:
+                position, rows, future = pending.popleft()
+                yield position, rows, future.result()
+
+    def run(self, records, progress=None):
+        summary = {'imported': 0, 'existing': 0, 'archived': 0, 'invalid': 0, 'errors': []}
+        self.posts.catalog.ensure_discovered()
+        for position, rows, renders in self.rendered(self.batches(records, summary)):
+            by_month = {}
+            for row, (html, excerpt) in zip(rows, renders):
+                by_month.setdefault(month_of(row[4]), []).append((row, html, excerpt))
+            imported = []
+            for month, items in sorted(by_month.items()):
+                imported.extend(self.insert_month(month, items, summary))
+            if imported:
+                self.posts.update_indexes(imported)
+                if self.posts.cache:
+                    self.posts.cache.posts_imported()
+            self.save_checkpoint(position)
+            summary['imported'] += len(imported)
+            if progress:
+                progress(position, summary)
+        return summary
+
+    def insert_month(self, month, items, summary):
+        posts = []
+        try:
+            # connecting would recreate the live shard of a month compact-shards retired
+            if self.posts.catalog.locate(month).archived:
+                summary['archived'] += len(items)
+                return []
+            with self.posts.connect_to_db(month) as db:
+                # compact-shards holds this lock while it archives the month
+                db.execute('BEGIN IMMEDIATE')
+                if self.posts.catalog.locate(month).archived:
+                    summary['archived'] += len(items)
+                    return []
+                for (title, markdown, author, tags, timestamp, post_id), html, excerpt in items:
+                    local_id = None
+                    if self.keep_ids and post_id is not None and split_id(post_id)[0] == month:
+                        local_id = split_id(post_id)[1]
+                    cursor = db.execute("""INSERT OR IGNORE INTO posts (post_id, post_title, post_content, post_markdown, post_excerpt,
+                                                                        render_version, post_author, tags, timestamp)
+                                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                        (local_id, title, html, markdown, excerpt, RENDERER_VERSION, author, tags, timestamp))
+                    if not cursor.rowcount:
+                        summary['existing'] += 1
+                        continue
+                    posts.append(Post(global_id(month, cursor.lastrowid), title, html, author, tags, timestamp, excerpt, markdown))
+                db.commit()
+        except sqlite3.Error as e:
+            raise BlogError(f"Import into {month} failed: {e}") from e
+        self.posts.catalog.adjust(month, len(posts))
+        return posts
@@ -0,0 +1,47 @@
+"""Production entry point, served by gunicorn with the settings in gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    BLOG_WORKERS=4 BLOG_THREADS=8 BLOG_BIND=0.0.0.0:8000 gunicorn -c gunicorn.conf.py wsgi:app
+
+Apply schema migrations first with `flask migrate`; workers only check the
+schema version. The app is built once in the master, services are created
+on first use, and each forked worker then sets up its own connections and
+threads in init_worker(). Run with BLOG_CACHE=file:/path/cache.db so workers share cached
+pages and their invalidations; the default memory cache is per worker.
+"""
+from methods import post_connections, archive_connections
+from shards import index_connections
+from passwords import password_hasher
+from activity_log import activity_log, admin_log
+from metrics import slow_log
+from app import create_app
+from routes import posts, draining
+
+app = create_app()
+
+
+def init_worker():
+    """Per-worker setup, run right after the server forks the worker."""
+    for pool in (post_connections, archive_connections, index_connections):
+        pool.after_fork()
+    password_hasher.after_fork()
+    # pay for shard discovery and the first connection before taking traffic
+    posts.catalog.ensure_discovered()
+    with posts.connect_to_db():
+        pass
+    password_hasher.dummy_hash()
+
+
+def start_draining():
+    draining.set()
+
+
+def shutdown_worker():
+    """Commit queued posts, flush views and logs and close connections once in-flight requests have drained."""
+    posts.writer.close()
+    posts.views.close()
+    for pool in (post_connections, archive_connections, index_connections):
+        pool.close_all()
+    activity_log.close()
+    admin_log.close()
+    slow_log.close()